@@ -0,0 +1,710 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import ssl
+import time
+import xmlrpc.client
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+import pyone
+from pyone.util import cast2one
+from one import TRANSIENT_ERRORS, ImageDevPrefix, ImageFormat, ImageType, build_disk_vector, build_image_template
+from states import ImageState, VMState, VMLCMState
+from template_index import TemplateIndex
+from telemetry import SPAN_KIND_CLIENT, telemetry
+from transport import CircuitBreaker, RequestNotSentError, RetryPolicy, TransportStats
+
+logger = logging.getLogger("main." + __name__)
+
+# Error codes of OpenNebula XML-RPC responses
+ONE_ERRORS = {
+    0x0100: pyone.OneAuthenticationException,
+    0x0200: pyone.OneAuthorizationException,
+    0x0400: pyone.OneNoExistsException,
+    0x0800: pyone.OneActionException,
+    0x1000: pyone.OneApiException,
+    0x2000: pyone.OneInternalException,
+}
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.used = False
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncXmlRpcTransport:
+    def __init__(self, url: str, timeout: float = 10.0, pool_size: int = 16) -> None:
+        """
+        HTTP/1.1 client for XML-RPC on asyncio streams with a pool of kept alive connections.
+        :param url: URL of the XML-RPC endpoint.
+        :param timeout: Timeout of a request in seconds.
+        :param pool_size: Maximal number of open connections, further requests wait for a free connection.
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.https = parts.scheme == "https"
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path or "/"
+        self.timeout = timeout
+        self._ssl = ssl.create_default_context() if self.https else None
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle: List[_Connection] = []
+
+    async def _connect(self) -> _Connection:
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self._ssl)
+        except OSError as e:
+            raise RequestNotSentError(f"Failed to connect to {self.host}:{self.port}: {e}") from e
+        return _Connection(reader, writer)
+
+    async def _send(self, connection: _Connection, body: bytes) -> None:
+        """
+        Write one request to the connection.
+        :raises RequestNotSentError: If the connection was closed before the whole request was written.
+        """
+        head = (f"POST {self.path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Type: text/xml\r\n"
+                f"Accept: */*\r\nContent-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n")
+        try:
+            connection.writer.write(head.encode() + body)
+            await connection.writer.drain()
+        except (ConnectionResetError, BrokenPipeError) as e:
+            # oned does not process a request with less data than its Content-Length
+            raise RequestNotSentError(f"Failed to send the request to {self.host}:{self.port}: {e}") from e
+
+    async def _receive(self, connection: _Connection) -> Tuple[int, bytes, bool]:
+        """
+        Read the response to the sent request.
+        :return: Status code, response body and True if the connection can be reused.
+        """
+        status_line = await connection.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        version, status = status_line.split(b" ", 2)[:2]
+        headers: Dict[str, str] = {}
+        while True:
+            line = await connection.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await connection.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await connection.reader.readline()
+                    break
+                chunks.append(await connection.reader.readexactly(size))
+                await connection.reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await connection.reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await connection.reader.read()
+            headers["connection"] = "close"
+        keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        return int(status), content, keep_alive
+
+    async def request(self, body: bytes) -> bytes:
+        """
+        POST the body and return the response body.
+        Only a request which was not written is sent again, a response lost after the request was sent
+        is raised as it is, oned may have processed the request.
+        :raises RequestNotSentError: If no connection could be opened or the request could not be written.
+        :raises xmlrpc.client.ProtocolError: If the server responds with an HTTP error.
+        """
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            try:
+                try:
+                    await asyncio.wait_for(self._send(connection, body), self.timeout)
+                except RequestNotSentError:
+                    if not connection.used:
+                        raise
+                    # The server closed the idle connection, send the request on a new one
+                    connection.close()
+                    connection = await self._connect()
+                    await asyncio.wait_for(self._send(connection, body), self.timeout)
+                status, content, keep_alive = await asyncio.wait_for(self._receive(connection), self.timeout)
+            except BaseException:
+                connection.close()
+                raise
+            connection.used = True
+            if keep_alive:
+                self._idle.append(connection)
+            else:
+                connection.close()
+        if status >= 400:
+            raise xmlrpc.client.ProtocolError(f"{self.host}:{self.port}{self.path}", status, "HTTP error", {})
+        return content
+
+    async def close(self) -> None:
+        for connection in self._idle:
+            connection.close()
+        self._idle = []
+
+
+class _PoolWatcher:
+    def __init__(self, name: str, fetch_range: Callable[[int, int], Any], interval: float = 1.0, max_gap: int = 64) -> None:
+        """
+        Polls the pool for all watched objects at once, every waiter is woken up from the same snapshot.
+        Hundreds of concurrent waits cost one pool call per interval.
+        :param name: Name of the pool used in log messages.
+        :param fetch_range: Coroutine function returning pool objects with ID in the inclusive range (start, end).
+        :param interval: Poll interval in seconds.
+        :param max_gap: IDs further apart than max_gap are fetched by separate pool calls.
+        """
+        self._name = name
+        self._fetch_range = fetch_range
+        self._interval = interval
+        self._max_gap = max_gap
+        # ID -> waiters (check callable, future)
+        self._waiters: Dict[int, Set[Tuple[Callable[[Any], Optional[bool]], asyncio.Future]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def wait(self, object_id: int, check: Callable[[Any], Optional[bool]], timeout: float) -> bool:
+        """
+        Wait until check returns True or False for the object, check gets None if the object does not exist.
+        :return: Result of check, False on timeout.
+        """
+        waiter = (check, asyncio.get_running_loop().create_future())
+        self._waiters.setdefault(object_id, set()).add(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(object_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[object_id]
+
+    async def _run(self) -> None:
+        while self._waiters:
+            ranges: List[List[int]] = []
+            for object_id in sorted(self._waiters):
+                if ranges and object_id - ranges[-1][1] <= self._max_gap:
+                    ranges[-1][1] = object_id
+                else:
+                    ranges.append([object_id, object_id])
+            objects: Dict[int, Any] = {}
+            try:
+                for start, end in ranges:
+                    logger.debug(f"Polling {self._name} pool for IDs {start}-{end}")
+                    for pool_object in await self._fetch_range(start, end):
+                        objects[int(pool_object.ID)] = pool_object
+            except (pyone.OneException, OSError, xmlrpc.client.Error) as e:
+                # Waits time out if the pool can not be read, transient errors are retried on the next poll
+                logger.warning(f"Failed to poll {self._name} pool: {e}")
+                await asyncio.sleep(self._interval)
+                continue
+            for object_id, waiters in list(self._waiters.items()):
+                if not any(start <= object_id <= end for start, end in ranges):
+                    # Registered during the poll, checked on the next one
+                    continue
+                for check, future in list(waiters):
+                    if future.done():
+                        continue
+                    try:
+                        result = check(objects.get(object_id))
+                    except Exception as e:
+                        # Only the waiter of the failed check fails, the others keep being polled
+                        future.set_exception(e)
+                        continue
+                    if result is not None:
+                        future.set_result(result)
+            await asyncio.sleep(self._interval)
+
+
+class AsyncOne:
+    def __init__(self, url: str, username: str, password: str, timeout: float = 10, poll_interval: float = 1.0, retries: int = 3, retry_backoff: float = 0.5, circuit_threshold: int = 5, circuit_reset_time: float = 30.0, pool_size: int = 16) -> None:
+        """
+        asyncio counterpart of One with the same methods as coroutines. A single event loop can drive many
+        deploys, state waits of all of them are answered by one pool poll per interval.
+        Must be created and used in one event loop, close it with close() or use it as an async context manager.
+        :param url: URL of the OpenNebula server.
+        :param username: Username for OpenNebula authentication.
+        :param password: Password for OpenNebula authentication.
+        :param timeout: Timeout for OpenNebula requests.
+        :param poll_interval: Interval in seconds of the pool polls answering state waits.
+        :param retries: Number of retries of a failed request, see One.
+        :param retry_backoff: Delay before the first retry in seconds, doubled after every retry.
+        :param circuit_threshold: Number of consecutive failed requests opening the circuit breaker, 0 disables it.
+        :param circuit_reset_time: Seconds after which a probe request is sent to an unavailable oned.
+        :param pool_size: Maximal number of concurrent requests and open connections.
+        """
+        logger.debug(f"Initializing asynchronous OpenNebula connection to {url} as user {username}")
+        self._session = ":".join((username, password))
+        self._transport = AsyncXmlRpcTransport(url, timeout, pool_size)
+        self.call_stats = TransportStats()
+        self._retry_policy = RetryPolicy(CircuitBreaker(circuit_threshold, circuit_reset_time), self.call_stats, retries, retry_backoff)
+        self._vm_watcher = _PoolWatcher("VM", self._get_vm_range, poll_interval)
+        self._image_watcher = _PoolWatcher("image", self._get_image_range, poll_interval)
+
+    async def __aenter__(self) -> "AsyncOne":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self._transport.close()
+
+    async def _call(self, methodname: str, *params) -> Any:
+        """
+        Send an XML-RPC request with retries and parse the response like pyone.
+        :param methodname: Method name without the "one." prefix, e.g. "vm.info".
+        :return: Bound OpenNebula object for XML responses, the plain value otherwise.
+        """
+        method = "one." + methodname
+        body = xmlrpc.client.dumps((self._session,) + tuple(cast2one(param) for param in params), method).encode("utf-8")
+        attempt = 0
+        with telemetry.span(method, kind=SPAN_KIND_CLIENT, **{"rpc.system": "xmlrpc", "rpc.method": method}) as span:
+            while True:
+                if span is not None:
+                    span.set_attribute("attempts", attempt + 1)
+                self._retry_policy.check(method)
+                start_time = time.monotonic()
+                try:
+                    content = await self._transport.request(body)
+                    try:
+                        response = xmlrpc.client.loads(content)[0][0]
+                    except xmlrpc.client.Fault as e:
+                        raise pyone.OneException(str(e))
+                    success, value, code = response[0], response[1], response[2]
+                    if not success:
+                        raise ONE_ERRORS.get(code, pyone.OneException)(value)
+                except Exception as e:
+                    delay = self._retry_policy.failed(method, time.monotonic() - start_time, e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                self._retry_policy.succeeded(method, time.monotonic() - start_time)
+                break
+        if isinstance(value, str) and value.startswith("<"):
+            return pyone.bindings.parseString(value.encode("utf-8"))
+        return value
+
+    async def _get_vm_range(self, start: int, end: int) -> List[pyone.bindings.VMSub]:
+        all_resources_filter = -2
+        any_state_except_done = -1
+        vm_pool = await self._call("vmpool.infoextended", all_resources_filter, start, end, any_state_except_done)
+        return vm_pool.VM
+
+    async def _get_image_range(self, start: int, end: int) -> List[pyone.bindings.IMAGESub]:
+        all_resources_filter = -2
+        image_pool = await self._call("imagepool.info", all_resources_filter, start, end)
+        return image_pool.IMAGE
+
+    async def get_image(self, image_id: int) -> Optional[pyone.bindings.IMAGESub]:
+        """
+        Get image information by ID.
+        :return: Image object or None if image is not found or error happened.
+        """
+        logger.debug(f"Getting image info for image ID: {image_id}")
+        try:
+            return await self._call("image.info", image_id)
+        except pyone.OneException as e:
+            logger.error(f"Failed to get image info for image ID: {image_id}, error: {str(e)}")
+            return None
+
+    async def get_image_state(self, image_id: int) -> Optional[ImageState]:
+        """
+        Get the current state of the image.
+        :return: ImageState enum value or None if image is not found or error happened.
+        """
+        image = await self.get_image(image_id)
+        if image is not None:
+            return ImageState(image.STATE)
+        logger.error(f"Failed to get image state for image ID: {image_id}")
+        return None
+
+    async def create_image(self, datastore: int, image_name: str, image_description: Optional[str] = None, image_path: Optional[str] = None, image_type: ImageType = ImageType.DATABLOCK, image_dev_prefix: Optional[ImageDevPrefix] = None, image_format: ImageFormat = ImageFormat.RAW, image_size_mb: Optional[int] = None, persistent_image: bool = False, **kwargs) -> int:
+        """
+        Creates Opennebula image with the given parameters, see One.create_image.
+        :return: Image ID if successful, -1 if an error occurred.
+        """
+        image_definition = build_image_template(image_name, image_description, image_path, image_type, image_dev_prefix, image_format, image_size_mb, persistent_image, **kwargs)
+        try:
+            logger.debug(f"Creating image in datastore {datastore} with definition: {image_definition}")
+            return await self._call("image.allocate", image_definition, datastore)
+        except pyone.OneException as e:
+            logger.error(f"Failed to create image, error: {e}")
+            return -1
+
+    async def delete_image(self, image_id: int) -> bool:
+        """
+        Delete an image by ID.
+        :return: True if successful, False if an error occurred.
+        """
+        logger.debug(f"Deleting image with ID: {image_id}")
+        try:
+            return await self._call("image.delete", image_id) != -1
+        except pyone.OneException as e:
+            logger.error(f"Failed to delete image with ID: {image_id}, error: {e}")
+            return False
+
+    async def set_image_persiency(self, image_id: int, persistent: bool) -> int:
+        """
+        Set the persisting state of an image.
+        """
+        logger.debug(f"Setting image persisting state for image ID: {image_id} to {persistent}")
+        try:
+            return await self._call("image.persistent", image_id, persistent)
+        except pyone.OneException as e:
+            logger.error(f"Failed to set image persisting state to {persistent}, image ID: {image_id} error: {e}")
+            return -1
+
+    async def clone_image(self, image_id: int, image_name: str, datastore: int = -1) -> int:
+        """
+        Clone an image.
+        :return: ID of the new image if successful, -1 if an error occurred.
+        """
+        logger.debug(f"Cloning image ID: {image_id} to {image_name} in datastore {datastore}")
+        try:
+            return await self._call("image.clone", image_id, image_name, datastore)
+        except pyone.OneException as e:
+            logger.error(f"Failed to clone image with ID: {image_id}, error: {e}")
+            return -1
+
+    async def update_image(self, image_id: int, **kwargs) -> bool:
+        """
+        Set attributes of the image template, other attributes are kept.
+        :return: True if successful, False if an error occurred.
+        """
+        image_template = "\n".join(f'{key} = "{value}"' for key, value in kwargs.items())
+        merge = 1
+        try:
+            return await self._call("image.update", image_id, image_template, merge) != -1
+        except pyone.OneException as e:
+            logger.error(f"Failed to update image with ID: {image_id}, error: {e}")
+            return False
+
+    async def find_images_by_attributes(self, filter: int, attributes: dict, page_size: int = 500) -> Optional[List[pyone.bindings.IMAGESub]]:
+        """
+        Find images by attributes of their template, see One.find_images_by_attributes.
+        :return: List of matching images, None if an error occurred.
+        """
+        logger.debug(f"Finding images by attributes: {attributes}")
+        if page_size < 2:
+            raise ValueError(f"page_size must be at least 2, got {page_size}")
+        result = list()
+        start_id = 0
+        try:
+            while True:
+                # -end is the page size if end < -1, pages start at an ID so images deleted meanwhile do not shift them
+                images = (await self._call("imagepool.info", filter, start_id, -page_size)).IMAGE
+                for image in images:
+                    if all(image.TEMPLATE.get(key) == value for key, value in attributes.items()):
+                        logger.debug(f"Found image with ID: {image.ID}")
+                        result.append(image)
+                if len(images) < page_size:
+                    break
+                start_id = int(images[-1].ID) + 1
+        except pyone.OneException as e:
+            logger.error(f"Failed to find images by attributes, error: {e}")
+            return None
+        return result
+
+    async def wait_for_image_deleted(self, image_id: int, timeout: int = 60) -> bool:
+        """
+        Wait until the image is removed from its datastore and from the image pool.
+        :return: True if the image does not exist anymore, False on timeout or if the image ended in the ERROR state.
+        """
+        logger.debug(f"Waiting for image {image_id} to be deleted")
+
+        def check(image: Optional[pyone.bindings.IMAGESub]) -> Optional[bool]:
+            if image is None:
+                return True
+            if ImageState(image.STATE) == ImageState.ERROR:
+                logger.error(f"Image {image_id} is in the ERROR state, it was not deleted")
+                return False
+            return None
+
+        if await self._image_watcher.wait(image_id, check, timeout):
+            return True
+        logger.warning(f"Image {image_id} was not deleted within {timeout} s")
+        return False
+
+    async def create_vm_template(self, template: str) -> int:
+        """
+        Create a VM template.
+        :return: Template ID if successful, -1 if an error occurred.
+        """
+        try:
+            return await self._call("template.allocate", template)
+        except pyone.OneException as e:
+            logger.error(f"Failed to create VM template, error: {e}")
+            return -1
+
+    async def get_vm_template(self, id: int) -> Optional[pyone.bindings.TEMPLATETypeSub]:
+        """
+        Get VM template information by ID.
+        :return: Template object or None if the template is not found or error happened.
+        """
+        logger.debug(f"Getting VM template with ID: {id}")
+        try:
+            return await self._call("template.info", id)
+        except pyone.OneException as e:
+            logger.error(f"Failed to get VM template with ID: {id}, error: {e}")
+            return None
+
+    async def delete_vm_template(self, template_id: int, delete_images: bool = False, retries: int = 0, backoff: float = 1.0) -> bool:
+        """
+        Delete a VM template by ID, see One.delete_vm_template.
+        :return: True if successful, False if an error occurred.
+        """
+        logger.debug(f"Deleting VM template with ID: {template_id}")
+        attempt = 0
+        while True:
+            try:
+                return await self._call("template.delete", template_id, delete_images) != -1
+            except pyone.OneNoExistsException as e:
+                if attempt > 0:
+                    # The failed attempt was processed by oned before the error
+                    logger.debug(f"VM template {template_id} was already deleted")
+                    return True
+                logger.error(f"Failed to delete VM template with ID: {template_id}: {e}")
+                return False
+            except TRANSIENT_ERRORS as e:
+                if attempt >= retries:
+                    logger.error(f"Failed to delete VM template with ID: {template_id} after {attempt + 1} attempts: {e}")
+                    return False
+                delay = backoff * 2**attempt
+                attempt += 1
+                logger.warning(f"Failed to delete VM template with ID: {template_id}: {e}, retry {attempt}/{retries} in {delay:.1f} s")
+                await asyncio.sleep(delay)
+            except pyone.OneException as e:
+                logger.error(f"Failed to delete VM template with ID: {template_id}: {e}")
+                return False
+
+    async def get_vm_templates(self, filter: int, page_size: int = 500, min_id: int = -1) -> AsyncIterator[pyone.bindings.VMTEMPLATESub]:
+        """
+        Iterate over the VM template pool page by page, see One.get_vm_templates. Raises pyone.OneException on error.
+        """
+        if page_size < 2:
+            raise ValueError(f"page_size must be at least 2, got {page_size}")
+        start_id = 0
+        while True:
+            if min_id >= 0:
+                # ID range query, used for incremental refresh, newly created templates are few
+                logger.debug(f"Getting VM templates with ID >= {min_id}")
+                templates = (await self._call("templatepool.info", filter, min_id, -1)).VMTEMPLATE
+            else:
+                # Pages start at an ID, see One.get_vm_templates
+                logger.debug(f"Getting VM templates page from ID {start_id}, page size {page_size}")
+                templates = (await self._call("templatepool.info", filter, start_id, -page_size)).VMTEMPLATE
+            for template in templates:
+                yield template
+            if min_id >= 0:
+                return
+            if len(templates) < page_size:
+                return
+            start_id = int(templates[-1].ID) + 1
+
+    async def find_templates_by_attributes(self, filter: int, attributes: dict, index: Optional[TemplateIndex] = None, page_size: int = 500) -> Optional[List[int]]:
+        """
+        Find VM templates by their attributes, see One.find_templates_by_attributes.
+        :return: IDs of the matching templates, None if an error occurred.
+        """
+        logger.debug(f"Finding VM template by attributes: {attributes}")
+        if index is not None and index.covers(attributes):
+            return await self._find_indexed_templates(filter, attributes, index, page_size)
+        result = list()
+        try:
+            # oned does not filter the template pool by attributes, only by ownership
+            async for template in self.get_vm_templates(filter, page_size):
+                if all(template.TEMPLATE.get(key) == value for key, value in attributes.items()):
+                    logger.debug(f"Found VM template with ID: {template.ID}")
+                    result.append(template.ID)
+        except pyone.OneException as e:
+            logger.error(f"Failed to find VM template by attributes, error: {e}")
+            return None
+        if len(result) == 0:
+            logger.warning(f"No VM templates found with the given attributes")
+        return result
+
+    async def _find_indexed_templates(self, filter: int, attributes: dict, index: TemplateIndex, page_size: int, verify_gap: int = 64) -> Optional[List[int]]:
+        """
+        Refresh the index and look the attributes up in it, see One._find_indexed_templates.
+        """
+        if index.filter != filter:
+            index.reset(filter)
+        result = list()
+        try:
+            async for template in self.get_vm_templates(filter, page_size, min_id=index.max_id + 1 if index.max_id >= 0 else -1):
+                index.add(template)
+            candidates = index.find(attributes)
+            # Candidates close to each other are verified by one ID range query
+            ranges: List[List[int]] = []
+            for template_id in candidates:
+                if ranges and template_id - ranges[-1][1] <= verify_gap:
+                    ranges[-1][1] = template_id
+                else:
+                    ranges.append([template_id, template_id])
+            found = dict()
+            for start, end in ranges:
+                for template in (await self._call("templatepool.info", filter, start, end)).VMTEMPLATE:
+                    index.add(template)
+                    found[int(template.ID)] = template
+            for template_id in candidates:
+                template = found.get(template_id)
+                if template is None:
+                    logger.debug(f"Indexed VM template {template_id} does not exist anymore")
+                    index.remove(template_id)
+                elif all(template.TEMPLATE.get(key) == value for key, value in attributes.items()):
+                    logger.debug(f"Found VM template with ID: {template.ID}")
+                    result.append(template.ID)
+        except pyone.OneException as e:
+            logger.error(f"Failed to find VM template by attributes, error: {e}")
+            return None
+        finally:
+            index.save()
+        if len(result) == 0:
+            logger.warning(f"No VM templates found with the given attributes")
+        return result
+
+    async def get_vm(self, vm_id: int) -> Optional[pyone.bindings.VMSub]:
+        """
+        Get VM information by ID.
+        :return: VM object or None if VM is not found or error happened.
+        """
+        logger.debug(f"Getting VM info for VM with ID: {vm_id}")
+        try:
+            return await self._call("vm.info", vm_id)
+        except pyone.OneException as e:
+            logger.error(f"Failed to get VM with ID: {vm_id}, error: {e}")
+            return None
+
+    async def get_vm_disks(self, vm_id: int) -> Optional[List[pyone.bindings.DISKTypeSub]]:
+        """
+        Get the disks of a VM by ID.
+        :return: List of disk vectors or None if VM is not found or error happened.
+        """
+        vm_info = await self.get_vm(vm_id)
+        if vm_info is None:
+            logger.error(f"Failed to get attached disks for VM with ID: {vm_id}")
+            return None
+        disks = vm_info.TEMPLATE.get("DISK")
+        if disks is None:
+            return []
+        return disks if isinstance(disks, list) else [disks]
+
+    async def get_vm_state(self, vm_id: int) -> Optional[Tuple[VMState, VMLCMState]]:
+        """
+        Get the current VMState and VMLCMState of the VM.
+        :return: Tuple of VMState and VMLCMState or None if VM is not found or error happened.
+        """
+        vm = await self.get_vm(vm_id)
+        if vm is not None:
+            return (VMState(vm.STATE), VMLCMState(vm.LCM_STATE))
+        logger.error(f"Failed to get VM state for VM ID: {vm_id}")
+        return None
+
+    async def attach_vm_image(self, vm_id: int, image_id: int, dev_prefix: Optional[ImageDevPrefix] = None, target: str = "") -> bool:
+        """
+        Attach an image to a VM.
+        :return: True if successful, False if an error occurred.
+        """
+        disk_vector = build_disk_vector(image_id, dev_prefix, target)
+        logger.debug(f"Attaching image ID: {image_id} to VM ID: {vm_id}, disk vector: {disk_vector}")
+        try:
+            return await self._call("vm.attach", vm_id, disk_vector) != -1
+        except pyone.OneException as e:
+            logger.error(f"Failed to attach image with ID: {image_id} to VM with ID: {vm_id}, error: {e}")
+            return False
+
+    async def detach_vm_image(self, vm_id: int, disk_id: int) -> bool:
+        """
+        Detach an image from a VM.
+        :param disk_id: Disk ID to detach. Not the IMAGE_ID.
+        :return: True if successful, False if an error occurred.
+        """
+        logger.debug(f"Detaching disk ID: {disk_id} from VM ID: {vm_id}")
+        try:
+            return await self._call("vm.detach", vm_id, disk_id) != -1
+        except pyone.OneException as e:
+            logger.error(f"Failed to detach disk with ID: {disk_id} from VM with ID: {vm_id}, error: {e}")
+            return False
+
+    async def get_vm_image_target(self, vm_id: int, image_id: int) -> Optional[str]:
+        """
+        Get the target of the first disk of the VM using the image.
+        :return: Target device name (e.g., "sda") or None if not found or error occured.
+        """
+        for disk in await self.get_vm_disks(vm_id) or []:
+            if disk.get("IMAGE_ID") == str(image_id):
+                return disk.get("TARGET", None)
+        return None
+
+    async def wait_for_image_state(self, image_id: int, target_state: ImageState, timeout: int = 60, fail_states: Tuple[ImageState, ...] = ()) -> bool:
+        """
+        Wait for the image to reach the target state.
+        :param fail_states: States from which the target state is not reached anymore, the wait fails immediately in them.
+        :return: True if the image reached the target state, False if timeout occurred, a fail state was reached or the image does not exist.
+        """
+        logger.debug(f"Waiting for image ID: {image_id} to reach state: {target_state.name}")
+        failed = False
+
+        def check(image: Optional[pyone.bindings.IMAGESub]) -> Optional[bool]:
+            nonlocal failed
+            if image is None:
+                logger.error(f"Image {image_id} not found while waiting for state {target_state.name}")
+                failed = True
+                return False
+            state = ImageState(image.STATE)
+            if state == target_state:
+                return True
+            if state in fail_states:
+                logger.error(f"Image ID: {image_id} reached state {state.name} instead of {target_state.name}")
+                failed = True
+                return False
+            return None
+
+        if await self._image_watcher.wait(image_id, check, timeout):
+            return True
+        if not failed:
+            logger.warning(f"Timeout waiting for image {image_id} to reach state {target_state.name}")
+        return False
+
+    async def wait_for_vm_state(self, vm_id: int, target_state: VMState | VMLCMState, timeout: int = 60) -> bool:
+        """
+        Wait for the VM to reach the target VM or LCM state.
+        :return: True if the VM reached the target state, False if timeout occurred or the VM does not exist.
+        """
+        logger.debug(f"Waiting for VM ID: {vm_id} to reach state: {target_state.name}")
+
+        def check(vm: Optional[pyone.bindings.VMSub]) -> Optional[bool]:
+            if vm is None:
+                logger.error(f"VM {vm_id} not found while waiting for state {target_state.name}")
+                return False
+            state = VMState(vm.STATE) if isinstance(target_state, VMState) else VMLCMState(vm.LCM_STATE)
+            return True if state == target_state else None
+
+        if await self._vm_watcher.wait(vm_id, check, timeout):
+            return True
+        logger.warning(f"Timeout waiting for VM {vm_id} to reach state {target_state.name}")
+        return False
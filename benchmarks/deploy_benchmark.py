@@ -0,0 +1,215 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import logging
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deploy_image import DeploySettings, deploy_images
+from metrics import get_timings_path
+from one import One
+from upload import UploadMode
+from fake_one import FakeOneServer
+from write_benchmark import create_source
+
+logger = logging.getLogger("main." + __name__)
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of the values.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize_stages(timings: List[dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Mean and maximum duration of every stage over the deploys.
+    """
+    stages: Dict[str, List[float]] = {}
+    for timing in timings:
+        for stage, seconds in timing["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {stage: {"mean_seconds": round(sum(values) / len(values), 3), "max_seconds": round(max(values), 3)}
+            for stage, values in sorted(stages.items())}
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_round(source_path: str, work_dir: str, concurrency: int, builder_vms: int, state_delay: float, hotplug_delay: float, upload_mode: UploadMode = UploadMode.HOTPLUG, udev_delay: float = 0.0) -> dict:
+    """
+    Deploy concurrency copies of the source image at once against a fresh fake OpenNebula.
+    In path and url upload mode the fake datastore copies or downloads the exports instead of the builder VMs writing them.
+    :return: Wall time, deploy latencies, per-stage durations, write or import throughput and XML-RPC call counts.
+    """
+    export_dir = os.path.join(work_dir, "export")
+    disk_dir = os.path.join(work_dir, "disks")
+    for directory in (export_dir, disk_dir):
+        os.makedirs(directory)
+    image_names = [f"bench-{index}" for index in range(concurrency)]
+    for image_name in image_names:
+        # Every deploy reads its own export, hard links keep the benchmark from needing concurrency copies
+        os.link(source_path, os.path.join(export_dir, image_name + ".qcow2"))
+    vms = {vm_id: os.path.join(work_dir, f"dev-{vm_id}") for vm_id in range(1, builder_vms + 1)}
+    server = FakeOneServer(disk_dir, vms, state_delay=state_delay, hotplug_delay=hotplug_delay, udev_delay=udev_delay)
+    server.start()
+    # The export server of the url mode listens on the loopback of the benchmark host
+    upload_port = get_free_port() if upload_mode == UploadMode.URL else 0
+    auth_path = os.path.join(work_dir, "one_auth")
+    with open(auth_path, "w") as f:
+        f.write("oneadmin:benchmark")
+    os.environ.update({
+        "ONE_XMLRPC": server.url,
+        "ONE_AUTH": auth_path,
+        "IMAGE_DATASTORE_ID": "1",
+        "VM_ID": "1",
+        "BUILDER_VMS": " ".join(f"{vm_id}={dev_dir}" for vm_id, dev_dir in vms.items()),
+        "DIR_EXPORT": export_dir,
+        "LOCK_DIR": os.path.join(work_dir, "locks"),
+        "TIMINGS_DIR": export_dir,
+        "JOURNAL_DIR": "",
+        "STREAM_INPUT": "",
+        "DEPLOY_IMAGES": ",".join(image_names),
+        "DEPLOY_SCAN_EXPORT": "false",
+        "DEPLOY_WORKERS": str(concurrency),
+        "UPLOAD_MODE": upload_mode.value,
+        "UPLOAD_SERVE_PORT": str(upload_port),
+        "UPLOAD_URL": f"http://127.0.0.1:{upload_port}/" if upload_port else "",
+        "VM_TEMPLATE_PATH": os.environ.get("VM_TEMPLATE_PATH", os.path.join(REPOSITORY_DIR, "template.tmpl")),
+    })
+    try:
+        settings = DeploySettings()
+        one = One(url=settings.one_xmlrpc, username="oneadmin", password="benchmark", timeout=settings.one_timeout,
+                  cache_ttl=settings.one_cache_ttl, retries=settings.one_retries)
+        start_time = time.monotonic()
+        results = deploy_images(one, settings, image_names)
+        wall_seconds = time.monotonic() - start_time
+    finally:
+        server.stop()
+    timings = []
+    for image_name in image_names:
+        try:
+            with open(get_timings_path(export_dir, image_name), "r") as f:
+                timings.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read stage timings of {image_name}: {e}")
+    latencies = [timing["total_seconds"] for timing in timings]
+    # The image is written by a builder VM in the write stage or imported by the datastore in the import stage
+    write_rates = [timing["image_size_mb"] / seconds for timing in timings if (seconds := timing["stages"].get("write") or timing["stages"].get("import"))]
+    image_size_mb = timings[0]["image_size_mb"] if timings else 0
+    return {
+        "upload_mode": upload_mode.value,
+        "concurrency": concurrency,
+        "builder_vms": builder_vms,
+        "deployed": sum(results.values()),
+        "failed": len(results) - sum(results.values()),
+        "wall_seconds": round(wall_seconds, 3),
+        "deploys_per_minute": round(60 * len(image_names) / wall_seconds, 2),
+        "latency_mean_seconds": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "latency_p95_seconds": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "write_mb_per_s_per_deploy": round(sum(write_rates) / len(write_rates), 1) if write_rates else None,
+        "write_mb_per_s_total": round(image_size_mb * len(timings) / wall_seconds, 1),
+        "stages": summarize_stages(timings),
+        "one_calls": dict(sorted(server.calls.items())),
+    }
+
+
+if __name__ == "__main__":
+    # Setup logging
+    DEBUG = os.environ.get("DEBUG", "false")
+    if DEBUG == "true":
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    # Init logging handler
+    logger = logging.getLogger("main")
+    logger.setLevel(log_level)
+    # Create formatter
+    log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(threadName)s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
+    # Create stream handler (console)
+    log_stream_handler = logging.StreamHandler()
+    log_stream_handler.setFormatter(log_formatter)
+    # Logs of the deployed images are only shown in debug mode or if they are warnings
+    log_stream_handler.addFilter(lambda record: DEBUG == "true" or record.name == "main" or record.levelno >= logging.WARNING)
+    # Add stream handler to logger
+    logger.addHandler(log_stream_handler)
+    # Set up environment variables
+    BENCH_DIR = os.environ.get("BENCH_DIR", "")
+    logger.debug(f"BENCH_DIR: {BENCH_DIR}")
+    BENCH_IMAGE = os.environ.get("BENCH_IMAGE", "")
+    logger.debug(f"BENCH_IMAGE: {BENCH_IMAGE}")
+    BENCH_SIZE_MB = int(os.environ.get("BENCH_SIZE_MB", "256"))
+    logger.debug(f"BENCH_SIZE_MB: {BENCH_SIZE_MB}")
+    BENCH_DATA_RATIO = float(os.environ.get("BENCH_DATA_RATIO", "0.5"))
+    logger.debug(f"BENCH_DATA_RATIO: {BENCH_DATA_RATIO}")
+    BENCH_CONCURRENCY = [int(value) for value in os.environ.get("BENCH_CONCURRENCY", "1,4,8").split(",")]
+    logger.debug(f"BENCH_CONCURRENCY: {BENCH_CONCURRENCY}")
+    BENCH_BUILDER_VMS = int(os.environ.get("BENCH_BUILDER_VMS", "1"))
+    logger.debug(f"BENCH_BUILDER_VMS: {BENCH_BUILDER_VMS}")
+    BENCH_STATE_DELAY = float(os.environ.get("BENCH_STATE_DELAY", "0.2"))
+    logger.debug(f"BENCH_STATE_DELAY: {BENCH_STATE_DELAY}")
+    BENCH_HOTPLUG_DELAY = float(os.environ.get("BENCH_HOTPLUG_DELAY", "0.5"))
+    logger.debug(f"BENCH_HOTPLUG_DELAY: {BENCH_HOTPLUG_DELAY}")
+    BENCH_UDEV_DELAY = float(os.environ.get("BENCH_UDEV_DELAY", "0"))
+    logger.debug(f"BENCH_UDEV_DELAY: {BENCH_UDEV_DELAY}")
+    BENCH_UPLOAD_MODES = [UploadMode(value) for value in os.environ.get("BENCH_UPLOAD_MODES", "hotplug,path,url").split(",")]
+    logger.debug(f"BENCH_UPLOAD_MODES: {[upload_mode.value for upload_mode in BENCH_UPLOAD_MODES]}")
+    BENCH_REPEAT = int(os.environ.get("BENCH_REPEAT", "1"))
+    logger.debug(f"BENCH_REPEAT: {BENCH_REPEAT}")
+    BENCH_OUTPUT = os.environ.get("BENCH_OUTPUT", "")
+    logger.debug(f"BENCH_OUTPUT: {BENCH_OUTPUT}")
+    work_dir = tempfile.mkdtemp(prefix="deploy-benchmark-", dir=BENCH_DIR or None)
+    try:
+        if BENCH_IMAGE:
+            # Hard links need the export on the file system of the work directory
+            source_path = os.path.join(work_dir, "source.qcow2")
+            shutil.copyfile(BENCH_IMAGE, source_path)
+        else:
+            source_path = os.path.join(work_dir, "source.raw")
+            create_source(source_path, BENCH_SIZE_MB, BENCH_DATA_RATIO)
+        results = []
+        for upload_mode in BENCH_UPLOAD_MODES:
+            for concurrency in BENCH_CONCURRENCY:
+                for repeat in range(BENCH_REPEAT):
+                    round_dir = os.path.join(work_dir, f"round-{upload_mode.value}-{concurrency}-{repeat}")
+                    result = run_round(source_path, round_dir, concurrency, BENCH_BUILDER_VMS, BENCH_STATE_DELAY, BENCH_HOTPLUG_DELAY, upload_mode, BENCH_UDEV_DELAY)
+                    shutil.rmtree(round_dir, ignore_errors=True)
+                    logger.info(f"{upload_mode.value:>7} {concurrency:>3} concurrent deploys: {result['wall_seconds']:>8.2f} s, {result['deploys_per_minute']:>7.2f} deploys/min, "
+                                f"latency mean {result['latency_mean_seconds']} s p95 {result['latency_p95_seconds']} s, "
+                                f"lock wait max {result['stages'].get('lock-wait', {}).get('max_seconds', 0)} s, "
+                                f"write {result['write_mb_per_s_per_deploy']} MB/s per deploy, {result['write_mb_per_s_total']} MB/s total, failed {result['failed']}")
+                    results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["failed"] for result in results):
+        logger.critical("Some deploys failed, see the log with DEBUG=true")
+        exit(1)
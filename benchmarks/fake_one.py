@@ -0,0 +1,405 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import shutil
+import socketserver
+import threading
+import urllib.request
+import logging
+from typing import Any, Callable, Dict, List, Optional
+from xml.sax.saxutils import escape
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+from states import ImageState, VMState, VMLCMState
+
+logger = logging.getLogger("main." + __name__)
+
+# Error codes of OpenNebula XML-RPC responses
+NO_EXISTS = 0x0400
+ACTION = 0x0800
+
+# Target names of the SCSI disks of a VM, see calculate_disk_location
+SCSI_TARGETS = [f"sd{letter}" for letter in "bcdefghijklmnopqrstuvwxyz"]
+
+
+def parse_template(template: str) -> Dict[str, str]:
+    """
+    Parse the KEY = "value" attributes of an OpenNebula template, attributes of vectors included.
+    """
+    return dict(re.findall(r'(\w+)\s*=\s*"((?:[^"\\]|\\.)*)"', template))
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+    # Keep connections alive like oned, the deployer reuses them
+    protocol_version = "HTTP/1.1"
+    rpc_paths = ("/RPC2",)
+
+
+class _ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeImage:
+    def __init__(self, image_id: int, name: str, datastore_id: int, size_mb: int, persistent: bool, attributes: Dict[str, str], path: str) -> None:
+        self.image_id = image_id
+        self.name = name
+        self.datastore_id = datastore_id
+        self.size_mb = size_mb
+        self.persistent = persistent
+        self.attributes = attributes
+        self.path = path
+        self.state = ImageState.LOCKED
+
+    def to_xml(self) -> str:
+        template = "".join(f"<{key}>{escape(value)}</{key}>" for key, value in self.attributes.items())
+        return (f"<IMAGE><ID>{self.image_id}</ID><UID>0</UID><GID>0</GID><NAME>{escape(self.name)}</NAME>"
+                f"<STATE>{self.state.value}</STATE><SIZE>{self.size_mb}</SIZE><PERSISTENT>{int(self.persistent)}</PERSISTENT>"
+                f"<DATASTORE_ID>{self.datastore_id}</DATASTORE_ID><DATASTORE>fake</DATASTORE><TEMPLATE>{template}</TEMPLATE></IMAGE>")
+
+
+class FakeVM:
+    def __init__(self, vm_id: int, dev_dir: str) -> None:
+        self.vm_id = vm_id
+        self.dev_dir = dev_dir
+        self.lcm_state = VMLCMState.RUNNING
+        # Disk ID -> (image ID, target)
+        self.disks: Dict[int, tuple] = {}
+
+    def to_xml(self) -> str:
+        disks = "".join(f"<DISK><DISK_ID>{disk_id}</DISK_ID><IMAGE_ID>{image_id}</IMAGE_ID><TARGET>{target}</TARGET></DISK>"
+                        for disk_id, (image_id, target) in sorted(self.disks.items()))
+        return (f"<VM><ID>{self.vm_id}</ID><UID>0</UID><GID>0</GID><NAME>builder-{self.vm_id}</NAME>"
+                f"<STATE>{VMState.ACTIVE.value}</STATE><LCM_STATE>{self.lcm_state.value}</LCM_STATE><TEMPLATE>{disks}</TEMPLATE></VM>")
+
+    def device_path(self, target: str) -> str:
+        return os.path.join(self.dev_dir, f"disk/by-id/scsi-0QEMU_QEMU_HARDDISK_drive-scsi0-0-{SCSI_TARGETS.index(target) + 1}-0")
+
+
+class FakeOneServer:
+    def __init__(self, disk_dir: str, vms: Dict[int, str], state_delay: float = 0.2, hotplug_delay: float = 0.5, udev_delay: float = 0.0, host: str = "127.0.0.1", port: int = 0) -> None:
+        """
+        Local stand-in for the OpenNebula XML-RPC API used by the deploy scripts. Images are sparse files in
+        disk_dir, attaching an image links its file as the by-id SCSI device of the VM. Images allocated with
+        a PATH are copied from the path or downloaded from the URL like by a file system datastore.
+        Image allocation, clones and deletes finish after state_delay, hot-plug operations after hotplug_delay.
+        Only the parts of the API and of the responses used by the scripts are implemented.
+        :param disk_dir: Directory for the image files.
+        :param vms: Builder VM ID -> directory where its devices are linked (DIR_DEV of the VM).
+        :param state_delay: Seconds an image stays LOCKED after allocation or clone.
+        :param hotplug_delay: Seconds a VM stays in HOTPLUG after an attach or detach.
+        :param udev_delay: Seconds after the end of an attach until the device is linked, like udev under load.
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 selects a free port.
+        """
+        self.disk_dir = disk_dir
+        self.state_delay = state_delay
+        self.hotplug_delay = hotplug_delay
+        self.udev_delay = udev_delay
+        self.vms = {vm_id: FakeVM(vm_id, dev_dir) for vm_id, dev_dir in vms.items()}
+        self.images: Dict[int, FakeImage] = {}
+        self.templates: Dict[int, str] = {}
+        # Number of calls of every method
+        self.calls: Dict[str, int] = {}
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self._timers: List[threading.Timer] = []
+        self._server = _ThreadingXMLRPCServer((host, port), requestHandler=_RequestHandler, logRequests=False, allow_none=True)
+        for method, function in (
+            ("image.allocate", self.image_allocate),
+            ("image.info", self.image_info),
+            ("image.delete", self.image_delete),
+            ("image.persistent", self.image_persistent),
+            ("image.clone", self.image_clone),
+            ("image.update", self.image_update),
+            ("imagepool.info", self.imagepool_info),
+            ("vm.info", self.vm_info),
+            ("vm.attach", self.vm_attach),
+            ("vm.detach", self.vm_detach),
+            ("vmpool.infoextended", self.vmpool_infoextended),
+            ("template.allocate", self.template_allocate),
+            ("template.info", self.template_info),
+            ("template.delete", self.template_delete),
+            ("templatepool.info", self.templatepool_info),
+        ):
+            self._server.register_function(self._counted(method, function), "one." + method)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/RPC2"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-one", daemon=True)
+        self._thread.start()
+        logger.debug(f"Fake OpenNebula listening on {self.url}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            for timer in self._timers:
+                timer.cancel()
+
+    def _counted(self, method: str, function: Callable) -> Callable:
+        def call(session: str, *params) -> List[Any]:
+            with self._lock:
+                self.calls[method] = self.calls.get(method, 0) + 1
+            return function(*params)
+        return call
+
+    def _later(self, delay: float, function: Callable[[], None]) -> None:
+        def run() -> None:
+            with self._lock:
+                function()
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        with self._lock:
+            self._timers = [pending for pending in self._timers if pending.is_alive()]
+            self._timers.append(timer)
+        timer.start()
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    @staticmethod
+    def _ok(value: Any) -> List[Any]:
+        return [True, value, 0]
+
+    @staticmethod
+    def _error(message: str, code: int = NO_EXISTS) -> List[Any]:
+        return [False, message, code]
+
+    def _set_image_state(self, image_id: int, state: ImageState) -> None:
+        if image_id in self.images:
+            self.images[image_id].state = state
+
+    def image_allocate(self, template: str, datastore_id: int, *args) -> List[Any]:
+        attributes = parse_template(template)
+        with self._lock:
+            image_id = self._new_id()
+            path = os.path.join(self.disk_dir, f"image-{image_id}.raw")
+            size_mb = int(attributes.get("SIZE", "1"))
+            source = attributes.get("PATH")
+            if source is None:
+                with open(path, "wb") as f:
+                    f.truncate(size_mb * 1024**2)
+            persistent = attributes.pop("PERSISTENT", "NO") == "YES"
+            name = attributes.pop("NAME", f"image-{image_id}")
+            image = self.images[image_id] = FakeImage(image_id, name, datastore_id, size_mb, persistent, attributes, path)
+        if source is not None:
+            threading.Thread(target=self._import_image, args=(image, source), name=f"import-{image_id}", daemon=True).start()
+        else:
+            self._later(self.state_delay, lambda: self._set_image_state(image_id, ImageState.READY))
+        return self._ok(image_id)
+
+    def _import_image(self, image: FakeImage, source: str) -> None:
+        try:
+            if source.startswith(("http://", "https://")):
+                with urllib.request.urlopen(source) as response, open(image.path, "wb") as f:
+                    shutil.copyfileobj(response, f, 4 * 1024**2)
+            else:
+                shutil.copyfile(source, image.path)
+        except OSError as e:
+            logger.warning(f"Fake OpenNebula failed to import image {image.image_id} from {source}: {e}")
+            with self._lock:
+                image.state = ImageState.ERROR
+            return
+        with self._lock:
+            image.size_mb = -(-os.path.getsize(image.path) // 1024**2)
+        self._later(self.state_delay, lambda: self._set_image_state(image.image_id, ImageState.READY))
+
+    def image_clone(self, image_id: int, name: str, datastore_id: int = -1) -> List[Any]:
+        with self._lock:
+            source = self.images.get(image_id)
+            if source is None:
+                return self._error(f"Error getting image [{image_id}]")
+            clone_id = self._new_id()
+            path = os.path.join(self.disk_dir, f"image-{clone_id}.raw")
+            with open(source.path, "rb") as source_file, open(path, "wb") as clone_file:
+                os.sendfile(clone_file.fileno(), source_file.fileno(), 0, os.path.getsize(source.path))
+            datastore_id = datastore_id if datastore_id >= 0 else source.datastore_id
+            self.images[clone_id] = FakeImage(clone_id, name, datastore_id, source.size_mb, False, dict(source.attributes), path)
+        self._later(self.state_delay, lambda: self._set_image_state(clone_id, ImageState.READY))
+        return self._ok(clone_id)
+
+    def image_info(self, image_id: int, *args) -> List[Any]:
+        with self._lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return self._error(f"Error getting image [{image_id}]")
+            return self._ok(image.to_xml())
+
+    def image_delete(self, image_id: int, *args) -> List[Any]:
+        with self._lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return self._error(f"Error getting image [{image_id}]")
+            if image.state not in (ImageState.READY, ImageState.ERROR):
+                return self._error(f"Image [{image_id}] is in state {image.state.name}", ACTION)
+            image.state = ImageState.DELETE
+
+        def remove() -> None:
+            self.images.pop(image_id, None)
+            try:
+                os.unlink(image.path)
+            except FileNotFoundError:
+                pass
+
+        self._later(self.state_delay, remove)
+        return self._ok(image_id)
+
+    def image_persistent(self, image_id: int, persistent: bool) -> List[Any]:
+        with self._lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return self._error(f"Error getting image [{image_id}]")
+            image.persistent = persistent
+            return self._ok(image_id)
+
+    def image_update(self, image_id: int, template: str, merge: int = 0) -> List[Any]:
+        with self._lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return self._error(f"Error getting image [{image_id}]")
+            if not merge:
+                image.attributes = {}
+            image.attributes.update(parse_template(template))
+            return self._ok(image_id)
+
+    def imagepool_info(self, filter_flag: int, start_id: int, end_id: int) -> List[Any]:
+        with self._lock:
+            images = self._select_range(self.images, start_id, end_id)
+            return self._ok("<IMAGE_POOL>" + "".join(image.to_xml() for image in images) + "</IMAGE_POOL>")
+
+    @staticmethod
+    def _select_range(objects: Dict[int, Any], start_id: int, end_id: int) -> List[Any]:
+        """
+        Select pool objects like oned, a negative end_id below -1 selects -end_id objects from start_id.
+        """
+        ids = sorted(objects)
+        if end_id < -1:
+            ids = [object_id for object_id in ids if object_id >= start_id][:-end_id]
+        else:
+            ids = [object_id for object_id in ids if (start_id < 0 or object_id >= start_id) and (end_id < 0 or object_id <= end_id)]
+        return [objects[object_id] for object_id in ids]
+
+    def vm_info(self, vm_id: int, *args) -> List[Any]:
+        with self._lock:
+            vm = self.vms.get(vm_id)
+            if vm is None:
+                return self._error(f"Error getting virtual machine [{vm_id}]")
+            return self._ok(vm.to_xml())
+
+    def vmpool_infoextended(self, filter_flag: int, start_id: int, end_id: int, state: int, *args) -> List[Any]:
+        with self._lock:
+            vms = self._select_range(self.vms, start_id, end_id)
+            return self._ok("<VM_POOL>" + "".join(vm.to_xml() for vm in vms) + "</VM_POOL>")
+
+    def vm_attach(self, vm_id: int, disk_template: str) -> List[Any]:
+        attributes = parse_template(disk_template)
+        image_id = int(attributes.get("IMAGE_ID", "-1"))
+        with self._lock:
+            vm = self.vms.get(vm_id)
+            image = self.images.get(image_id)
+            if vm is None or image is None:
+                return self._error(f"Error getting virtual machine [{vm_id}] or image [{image_id}]")
+            if vm.lcm_state != VMLCMState.RUNNING:
+                return self._error(f"Wrong state to perform action: {vm.lcm_state.name}", ACTION)
+            if image.state != ImageState.READY:
+                return self._error(f"Image [{image_id}] is in state {image.state.name}", ACTION)
+            used_targets = {target for _, target in vm.disks.values()}
+            target = attributes.get("TARGET") or next((target for target in SCSI_TARGETS if target not in used_targets), None)
+            if target is None or target in used_targets:
+                return self._error(f"No free target on virtual machine [{vm_id}]", ACTION)
+            disk_id = max(vm.disks, default=0) + 1
+            vm.disks[disk_id] = (image_id, target)
+            vm.lcm_state = VMLCMState.HOTPLUG
+            image.state = ImageState.USED_PERS if image.persistent else ImageState.USED
+
+        def link() -> None:
+            path = vm.device_path(target)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(image.path, path)
+
+        def attached() -> None:
+            if self.udev_delay > 0:
+                self._later(self.udev_delay, link)
+            else:
+                link()
+            vm.lcm_state = VMLCMState.RUNNING
+
+        self._later(self.hotplug_delay, attached)
+        return self._ok(vm_id)
+
+    def vm_detach(self, vm_id: int, disk_id: int) -> List[Any]:
+        with self._lock:
+            vm = self.vms.get(vm_id)
+            if vm is None or disk_id not in vm.disks:
+                return self._error(f"Error getting disk [{disk_id}] of virtual machine [{vm_id}]")
+            if vm.lcm_state != VMLCMState.RUNNING:
+                return self._error(f"Wrong state to perform action: {vm.lcm_state.name}", ACTION)
+            image_id, target = vm.disks.pop(disk_id)
+            vm.lcm_state = VMLCMState.HOTPLUG
+            try:
+                os.unlink(vm.device_path(target))
+            except FileNotFoundError:
+                pass
+
+        def detached() -> None:
+            self._set_image_state(image_id, ImageState.READY)
+            vm.lcm_state = VMLCMState.RUNNING
+
+        self._later(self.hotplug_delay, detached)
+        return self._ok(vm_id)
+
+    def _template_xml(self, template_id: int) -> str:
+        template = self.templates[template_id]
+        attributes = "".join(f"<{key}>{escape(value)}</{key}>" for key, value in re.findall(r'^\s*(CI_\w+)\s*=\s*"([^"]*)"', template, re.M))
+        disks = "".join(f"<DISK><IMAGE_ID>{image_id}</IMAGE_ID></DISK>" for image_id in re.findall(r'IMAGE_ID\s*=\s*"?(\d+)', template))
+        name = parse_template(template).get("NAME", f"template-{template_id}")
+        return (f"<VMTEMPLATE><ID>{template_id}</ID><UID>0</UID><GID>0</GID><UNAME>oneadmin</UNAME><GNAME>oneadmin</GNAME>"
+                f"<NAME>{escape(name)}</NAME><REGTIME>0</REGTIME><TEMPLATE>{attributes}{disks}</TEMPLATE></VMTEMPLATE>")
+
+    def template_allocate(self, template: str) -> List[Any]:
+        with self._lock:
+            template_id = self._new_id()
+            self.templates[template_id] = template
+            return self._ok(template_id)
+
+    def template_info(self, template_id: int, *args) -> List[Any]:
+        with self._lock:
+            if template_id not in self.templates:
+                return self._error(f"Error getting template [{template_id}]")
+            return self._ok(self._template_xml(template_id))
+
+    def template_delete(self, template_id: int, delete_images: bool = False) -> List[Any]:
+        with self._lock:
+            if template_id not in self.templates:
+                return self._error(f"Error getting template [{template_id}]")
+            template = self.templates.pop(template_id)
+        if delete_images:
+            for image_id in re.findall(r'IMAGE_ID\s*=\s*"?(\d+)', template):
+                self.image_delete(int(image_id))
+        return self._ok(template_id)
+
+    def templatepool_info(self, filter_flag: int, start_id: int, end_id: int) -> List[Any]:
+        with self._lock:
+            template_ids = self._select_range({template_id: template_id for template_id in self.templates}, start_id, end_id)
+            return self._ok("<VMTEMPLATE_POOL>" + "".join(self._template_xml(template_id) for template_id in template_ids) + "</VMTEMPLATE_POOL>")
@@ -0,0 +1,157 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import tempfile
+import time
+import logging
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block_writer import Extent, ZeroMode, get_image_extents, write_image_sparse
+
+logger = logging.getLogger("main." + __name__)
+
+
+def create_source(path: str, size_mb: int, data_ratio: float, run_mb: int = 8) -> List[Extent]:
+    """
+    Create a raw source image with data runs of run_mb separated by holes.
+    :param path: Path of the created file.
+    :param size_mb: Virtual size of the image in MB.
+    :param data_ratio: Fraction of the image holding data.
+    :param run_mb: Size of a data run in MB.
+    :return: Extents of the image.
+    """
+    mb = 1024**2
+    # Random content, so neither compression nor deduplication in the backend skews the results
+    block = os.urandom(mb)
+    extents: List[Extent] = []
+    data_mb = 0
+    with open(path, "wb") as f:
+        f.truncate(size_mb * mb)
+        for start_mb in range(0, size_mb, run_mb):
+            length_mb = min(run_mb, size_mb - start_mb)
+            data = data_mb < data_ratio * (start_mb + length_mb)
+            if data:
+                f.seek(start_mb * mb)
+                for _ in range(length_mb):
+                    f.write(block)
+                data_mb += length_mb
+            extents.append(Extent(start_mb * mb, length_mb * mb, data, start_mb * mb if data else None))
+    logger.info(f"Created source image {path}: {size_mb} MB, {data_mb} MB of data")
+    return extents
+
+
+def run_benchmark(image_path: str, extents: List[Extent], target: str, io_sizes_kb: List[int], queue_depths: List[int], direct: bool, zero_mode: ZeroMode, repeat: int) -> List[dict]:
+    """
+    Write the image to the target with every combination of io size and queue depth.
+    :return: List of results with the best throughput of the repeated runs.
+    """
+    virtual_size = sum(extent.length for extent in extents)
+    data_size = sum(extent.length for extent in extents if extent.data)
+    results = []
+    for io_size_kb in io_sizes_kb:
+        for queue_depth in queue_depths:
+            best = None
+            for _ in range(repeat):
+                start_time = time.monotonic()
+                if not write_image_sparse(image_path, target, extents, io_size=io_size_kb * 1024, direct=direct, zero_mode=zero_mode, queue_depth=queue_depth):
+                    logger.error(f"Write failed with io size {io_size_kb} KB and queue depth {queue_depth}")
+                    break
+                elapsed = max(time.monotonic() - start_time, 1e-9)
+                best = elapsed if best is None else min(best, elapsed)
+            if best is None:
+                continue
+            result = {
+                "io_size_kb": io_size_kb,
+                "queue_depth": queue_depth,
+                "seconds": round(best, 3),
+                "data_mb_per_s": round(data_size / 1024**2 / best, 1),
+                "effective_mb_per_s": round(virtual_size / 1024**2 / best, 1),
+            }
+            logger.info(f"io size {io_size_kb:>6} KB, queue depth {queue_depth:>3}: {result['seconds']:>8.2f} s, "
+                        f"data {result['data_mb_per_s']:>8.1f} MB/s, effective {result['effective_mb_per_s']:>8.1f} MB/s")
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    # Setup logging
+    DEBUG = os.environ.get("DEBUG", "false")
+    if DEBUG == "true":
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    # Init logging handler
+    logger = logging.getLogger("main")
+    logger.setLevel(log_level)
+    # Create formatter
+    log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(threadName)s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
+    # Create stream handler (console)
+    log_stream_handler = logging.StreamHandler()
+    log_stream_handler.setFormatter(log_formatter)
+    # Add stream handler to logger
+    logger.addHandler(log_stream_handler)
+    # Set up environment variables
+    BENCH_TARGET = os.environ.get("BENCH_TARGET", "")
+    logger.debug(f"BENCH_TARGET: {BENCH_TARGET}")
+    BENCH_IMAGE = os.environ.get("BENCH_IMAGE", "")
+    logger.debug(f"BENCH_IMAGE: {BENCH_IMAGE}")
+    BENCH_SIZE_MB = int(os.environ.get("BENCH_SIZE_MB", "1024"))
+    logger.debug(f"BENCH_SIZE_MB: {BENCH_SIZE_MB}")
+    BENCH_DATA_RATIO = float(os.environ.get("BENCH_DATA_RATIO", "0.5"))
+    logger.debug(f"BENCH_DATA_RATIO: {BENCH_DATA_RATIO}")
+    BENCH_IO_SIZES_KB = [int(value) for value in os.environ.get("BENCH_IO_SIZES_KB", "1024,4096,16384").split(",")]
+    logger.debug(f"BENCH_IO_SIZES_KB: {BENCH_IO_SIZES_KB}")
+    BENCH_QUEUE_DEPTHS = [int(value) for value in os.environ.get("BENCH_QUEUE_DEPTHS", "1,2,4,8,16").split(",")]
+    logger.debug(f"BENCH_QUEUE_DEPTHS: {BENCH_QUEUE_DEPTHS}")
+    BENCH_REPEAT = int(os.environ.get("BENCH_REPEAT", "3"))
+    logger.debug(f"BENCH_REPEAT: {BENCH_REPEAT}")
+    BENCH_OUTPUT = os.environ.get("BENCH_OUTPUT", "")
+    logger.debug(f"BENCH_OUTPUT: {BENCH_OUTPUT}")
+    WRITE_DIRECT = os.environ.get("WRITE_DIRECT", "false") == "true"
+    logger.debug(f"WRITE_DIRECT: {WRITE_DIRECT}")
+    WRITE_ZERO_MODE = ZeroMode(os.environ.get("WRITE_ZERO_MODE", ZeroMode.ZEROOUT.value))
+    logger.debug(f"WRITE_ZERO_MODE: {WRITE_ZERO_MODE.value}")
+    if not BENCH_TARGET:
+        logger.critical("BENCH_TARGET is not set, use a loop device or a scratch file")
+        exit(1)
+    source_path = None
+    if BENCH_IMAGE:
+        image_path = BENCH_IMAGE
+        extents = get_image_extents(image_path)
+        if extents is None:
+            logger.critical(f"Failed to get extents of {image_path}")
+            exit(1)
+    else:
+        source_fd, source_path = tempfile.mkstemp(prefix="write-benchmark-", suffix=".raw")
+        os.close(source_fd)
+        image_path = source_path
+        extents = create_source(source_path, BENCH_SIZE_MB, BENCH_DATA_RATIO)
+    try:
+        results = run_benchmark(image_path, extents, BENCH_TARGET, BENCH_IO_SIZES_KB, BENCH_QUEUE_DEPTHS, WRITE_DIRECT, WRITE_ZERO_MODE, BENCH_REPEAT)
+    finally:
+        if source_path is not None:
+            os.unlink(source_path)
+    if not results:
+        logger.critical("All benchmark runs failed")
+        exit(1)
+    best = max(results, key=lambda result: result["effective_mb_per_s"])
+    logger.info(f"Best: WRITE_IO_SIZE_KB={best['io_size_kb']} WRITE_QUEUE_DEPTH={best['queue_depth']} ({best['effective_mb_per_s']} MB/s)")
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, "w") as f:
+            json.dump(results, f, indent=2)
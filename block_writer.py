@@ -0,0 +1,981 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import enum
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import queue
+import stat
+import struct
+import sys
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+from qemu import get_qemu_image_map
+from qcow2 import QCOW2_MAGIC, ClusterKind, Qcow2Image, open_qcow2_image
+from metrics import ProgressReporter
+from digest import ChunkHasher, ContentDigest, DIGEST_ALGORITHM
+
+logger = logging.getLogger("main." + __name__)
+
+# ioctl request numbers from linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+# fallocate flags from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Alignment required by O_DIRECT, logical block size of the attached SCSI disks
+DIRECT_IO_ALIGNMENT = 4096
+
+
+class ZeroMode(enum.Enum):
+    ZEROOUT = "zeroout"  # BLKZEROOUT, device guarantees zeroes, thin provisioned backends unmap the range
+    DISCARD = "discard"  # BLKDISCARD, cheapest, only safe if discarded blocks read back as zeroes
+    SKIP = "skip"        # Do not touch unallocated ranges, only safe on freshly allocated zeroed datablocks
+
+
+class Extent(NamedTuple):
+    start: int             # Offset in the guest disk
+    length: int            # Length in bytes
+    data: bool             # False if the range reads as zeroes
+    offset: Optional[int]  # Offset of the data in the image file, None if not stored there plainly (compressed)
+
+
+class WriteStats:
+    def __init__(self) -> None:
+        """
+        Counters of a block device write.
+        """
+        self.start_time = time.monotonic()
+        self.end_time: Optional[float] = None
+        self.bytes_written = 0
+        self.bytes_zeroed = 0
+        self.bytes_unchanged = 0
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+        return max(end_time - self.start_time, 1e-9)
+
+    @property
+    def bytes_processed(self) -> int:
+        return self.bytes_written + self.bytes_zeroed + self.bytes_unchanged
+
+    def report(self) -> str:
+        """
+        Human readable throughput report.
+        """
+        mb = 1024**2
+        unchanged = f", unchanged {self.bytes_unchanged / mb:.1f} MB" if self.bytes_unchanged else ""
+        return (f"written {self.bytes_written / mb:.1f} MB, zeroed {self.bytes_zeroed / mb:.1f} MB{unchanged} in {self.elapsed:.1f} s, "
+                f"write throughput {self.bytes_written / mb / self.elapsed:.1f} MB/s, "
+                f"effective throughput {self.bytes_processed / mb / self.elapsed:.1f} MB/s")
+
+
+def get_image_extents(path: str) -> Optional[List[Extent]]:
+    """
+    Get the extents of the guest disk from the image allocation map.
+    qcow2 images are mapped by parsing their L1/L2 tables, other formats by qemu-img map.
+    :param path: Path to the QEMU image file.
+    :return: List of extents covering the whole virtual disk, or None if the map can not be used for direct reads
+             (error, data stored in a backing file or compressed by qemu-img in a non qcow2 image).
+    """
+    image = open_qcow2_image(path)
+    if image is not None:
+        try:
+            reason = image.unsupported_reason()
+            if reason is None:
+                extents = [Extent(run.start, run.length, run.kind in (ClusterKind.DATA, ClusterKind.COMPRESSED),
+                                  run.offset if run.kind == ClusterKind.DATA else None) for run in image.runs()]
+                logger.debug(f"qcow2 image {path} has {len(extents)} extents")
+                return extents
+            logger.info(f"Guest data of {path} can not be read directly ({reason}), using qemu-img map")
+        except ValueError as e:
+            logger.warning(f"Failed to read the cluster map of {path}, using qemu-img map: {e}")
+        finally:
+            image.close()
+    image_map = get_qemu_image_map(path)
+    if image_map is None:
+        return None
+    extents: List[Extent] = []
+    for entry in image_map:
+        data = entry.get("data", False)
+        if data and ("offset" not in entry or entry.get("depth", 0) != 0):
+            logger.warning(f"Image {path} has data which is compressed or stored in a backing file at offset {entry['start']}")
+            return None
+        extents.append(Extent(entry["start"], entry["length"], data, entry.get("offset") if data else None))
+    return extents
+
+
+class ImageReader:
+    def __init__(self, path: str, extents: List[Extent]) -> None:
+        """
+        Reads guest data of the extents. Plain data is read from the image file, compressed qcow2 clusters
+        are decompressed by the qcow2 reader.
+        :param path: Path to the QEMU image file.
+        :param extents: Extents of the image from get_image_extents.
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.image: Optional[Qcow2Image] = None
+        if any(extent.data and extent.offset is None for extent in extents):
+            try:
+                self.image = Qcow2Image(path)
+            except (OSError, ValueError):
+                os.close(self.fd)
+                raise
+
+    def read(self, buffer, extent: Extent, position: int) -> None:
+        """
+        Fill the whole buffer with data of the extent starting at the guest offset position.
+        """
+        view = memoryview(buffer)
+        if extent.offset is None:
+            try:
+                self.image.read_into(view, position)
+            except ValueError as e:
+                raise OSError(f"Failed to read {self.path} at guest offset {position}: {e}")
+            return
+        offset = extent.offset + position - extent.start
+        read = os.preadv(self.fd, [view], offset)
+        if read != len(view):
+            raise OSError(f"Short read from {self.path} at offset {offset}: {read} of {len(view)} bytes")
+
+    def close(self) -> None:
+        os.close(self.fd)
+        if self.image is not None:
+            self.image.close()
+
+
+_libc = None
+
+
+def is_zero(buffer, size: int, zero_buffer: bytes) -> bool:
+    """
+    Check if the first size bytes of the buffer are zeroes. Slicing to bytes is much faster than comparing memoryviews.
+    """
+    return buffer[:size] == (zero_buffer if size == len(zero_buffer) else zero_buffer[:size])
+
+
+def _punch_hole(fd: int, offset: int, length: int) -> bool:
+    """
+    Deallocate a range of a regular file, the range reads back as zeroes.
+    :return: True on success, False if not supported.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class BlockTarget:
+    def __init__(self, path: str, direct: bool = False) -> None:
+        """
+        Output block device (or regular file) opened for positional writes.
+        :param path: Path to the block device or file.
+        :param direct: Open with O_DIRECT to bypass the page cache. Unaligned writes use a buffered descriptor.
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.direct_fd: Optional[int] = None
+        if direct:
+            try:
+                self.direct_fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+            except OSError as e:
+                logger.warning(f"O_DIRECT not supported for {path}, using buffered writes: {e}")
+        self.is_block_device = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self._zero_supported = True
+        self._direct_read_fd: Optional[int] = None
+
+    def write(self, buffer, offset: int) -> None:
+        """
+        Write the whole buffer at the offset.
+        """
+        view = memoryview(buffer)
+        aligned = offset % DIRECT_IO_ALIGNMENT == 0 and len(view) % DIRECT_IO_ALIGNMENT == 0
+        fd = self.direct_fd if self.direct_fd is not None and aligned else self.fd
+        while len(view) > 0:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def read(self, buffer, offset: int) -> int:
+        """
+        Read into the buffer from the offset, bypassing the page cache if the target was opened with direct.
+        :return: Number of bytes read.
+        """
+        view = memoryview(buffer)
+        aligned = offset % DIRECT_IO_ALIGNMENT == 0 and len(view) % DIRECT_IO_ALIGNMENT == 0
+        fd = self.fd
+        if self.direct_fd is not None and aligned:
+            # The direct descriptor is write only, reads use a separate one opened on demand
+            if self._direct_read_fd is None:
+                self._direct_read_fd = os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+            fd = self._direct_read_fd
+        done = 0
+        while done < len(view):
+            read = os.preadv(fd, [view[done:]], offset + done)
+            if read == 0:
+                break
+            done += read
+        return done
+
+    def zero(self, offset: int, length: int, zero_mode: ZeroMode, zero_buffer: bytes) -> None:
+        """
+        Make the range read as zeroes.
+        :param zero_buffer: Buffer of zeroes used when the fast path is not supported.
+        """
+        if zero_mode == ZeroMode.SKIP:
+            return
+        if self._zero_supported:
+            try:
+                if self.is_block_device:
+                    request = BLKDISCARD if zero_mode == ZeroMode.DISCARD else BLKZEROOUT
+                    fcntl.ioctl(self.fd, request, struct.pack("QQ", offset, length))
+                    return
+                if _punch_hole(self.fd, offset, length):
+                    return
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                    raise
+                logger.warning(f"Fast zeroing not supported by {self.path}, writing zeroes: {e}")
+                self._zero_supported = False
+        end = offset + length
+        while offset < end:
+            size = min(len(zero_buffer), end - offset)
+            self.write(zero_buffer[:size], offset)
+            offset += size
+
+    def flush(self) -> None:
+        """
+        Wait until the data written so far is on the device.
+        """
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        """
+        Flush and close the target.
+        """
+        try:
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+            if self.direct_fd is not None:
+                os.close(self.direct_fd)
+            if self._direct_read_fd is not None:
+                os.close(self._direct_read_fd)
+
+
+def _split_extents(extents: List[Extent], io_size: int, start_offset: int = 0) -> Iterator[Tuple[Extent, int, int]]:
+    """
+    Split the extents into write requests.
+    :param start_offset: Guest offset of the first request, the ranges before it are skipped.
+    :return: Iterator of (extent, guest offset, size), an unallocated extent is zeroed by a single request.
+    """
+    for extent in extents:
+        end = extent.start + extent.length
+        if end <= start_offset:
+            continue
+        extent_start = max(extent.start, start_offset)
+        if not extent.data:
+            yield extent, extent_start, end - extent_start
+            continue
+        for start in range(extent_start, end, io_size):
+            yield extent, start, min(io_size, extent.start + extent.length - start)
+
+
+def write_image_sparse(input_path: str, output_path: str, extents: List[Extent], io_size: int = 4 * 1024**2, direct: bool = False, zero_mode: ZeroMode = ZeroMode.ZEROOUT, queue_depth: int = 1, progress: Optional[ProgressReporter] = None, start_offset: int = 0, checkpoint: Optional[Callable[[int], None]] = None, checkpoint_interval: int = 256 * 1024**2, hasher: Optional[ChunkHasher] = None) -> bool:
+    """
+    Write the guest disk of a QEMU image to a block device, copying only allocated extents.
+    Unallocated ranges and all-zero blocks are zeroed with zero_mode instead of being written.
+    With queue_depth above 1 the requests are issued by that many threads, each with its own buffer, so the
+    device queues are kept busy, pread and pwrite release the GIL.
+    An interrupted write can be resumed from the last offset passed to checkpoint, everything before it is
+    on the device when checkpoint is called.
+    :param input_path: Path to the QEMU image file (qcow2 or raw).
+    :param output_path: Path to the output block device.
+    :param extents: Extents of the image from get_image_extents.
+    :param io_size: Size of a single read/write request in bytes.
+    :param direct: Use O_DIRECT for the writes.
+    :param zero_mode: How to zero unallocated ranges.
+    :param queue_depth: Number of requests in flight.
+    :param progress: Optional progress reporter, updated after every request.
+    :param start_offset: Guest offset to resume the write from, must be an offset passed to checkpoint.
+    :param checkpoint: Optional callable called with the guest offset up to which the image is written.
+    :param checkpoint_interval: Minimal number of bytes between two checkpoints, every checkpoint syncs the device.
+    :param hasher: Optional hasher the written content is added to, the ranges before start_offset are not added.
+    :return: True if the image was written successfully, False otherwise.
+    """
+    queue_depth = max(1, queue_depth)
+    logger.debug(f"Writing image {input_path} to {output_path}, io size: {io_size}, direct: {direct}, zero mode: {zero_mode.value}, queue depth: {queue_depth}, start offset: {start_offset}")
+    virtual_size = sum(extent.length for extent in extents)
+    stats = WriteStats()
+    zero_buffer = bytes(io_size)
+    try:
+        reader = ImageReader(input_path, extents)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to open image {input_path}: {e}")
+        return False
+    try:
+        target = BlockTarget(output_path, direct)
+    except OSError as e:
+        logger.error(f"Failed to open block device {output_path}: {e}")
+        reader.close()
+        return False
+    requests = _split_extents(extents, io_size, start_offset)
+    # Guards the request iterator, the counters and the failure flag shared by the workers
+    lock = threading.Lock()
+    failed = threading.Event()
+    # Start offsets of the requests in flight mapped to their end, the image is written up to the lowest one
+    in_flight = {}
+    issued_end = start_offset
+    checkpointed = start_offset
+    checkpointing = False
+
+    def advance_checkpoint() -> None:
+        nonlocal checkpointed, checkpointing
+        with lock:
+            written_end = min(in_flight) if in_flight else issued_end
+            if checkpointing or written_end - checkpointed < checkpoint_interval:
+                return
+            checkpointing = True
+        try:
+            target.flush()
+            checkpoint(written_end)
+        finally:
+            with lock:
+                checkpointed = written_end
+                checkpointing = False
+
+    def worker() -> None:
+        nonlocal issued_end
+        # Anonymous mmap is page aligned as required by O_DIRECT
+        buffer = mmap.mmap(-1, io_size)
+        try:
+            while not failed.is_set():
+                with lock:
+                    request = next(requests, None)
+                    if request is not None:
+                        issued_end = request[1] + request[2]
+                        in_flight[request[1]] = issued_end
+                if request is None:
+                    return
+                extent, start, size = request
+                if not extent.data:
+                    target.zero(start, size, zero_mode, zero_buffer)
+                    zeroed, written = size, 0
+                    if hasher is not None:
+                        hasher.zero(start, size)
+                else:
+                    view = memoryview(buffer)[:size]
+                    reader.read(view, extent, start)
+                    if hasher is not None:
+                        hasher.update(start, view)
+                    if is_zero(buffer, size, zero_buffer):
+                        target.zero(start, size, zero_mode, zero_buffer)
+                        zeroed, written = size, 0
+                    else:
+                        target.write(view, start)
+                        zeroed, written = 0, size
+                with lock:
+                    del in_flight[start]
+                    stats.bytes_zeroed += zeroed
+                    stats.bytes_written += written
+                    processed = stats.bytes_processed
+                if progress is not None:
+                    progress.update(start_offset + processed)
+                if checkpoint is not None:
+                    advance_checkpoint()
+        except BaseException:
+            failed.set()
+            raise
+
+    try:
+        if target.is_block_device and target.size < virtual_size:
+            logger.error(f"Block device {output_path} has {target.size} bytes, image needs {virtual_size} bytes")
+            return False
+        if queue_depth == 1:
+            worker()
+        else:
+            with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="write") as executor:
+                futures = [executor.submit(worker) for _ in range(queue_depth)]
+            for future in futures:
+                future.result()
+        target.close()
+        target = None
+        stats.end_time = time.monotonic()
+        if progress is not None:
+            progress.finish()
+        logger.info(f"Image written to {output_path}: {stats.report()}")
+        return True
+    except OSError as e:
+        logger.error(f"Failed to write image to {output_path}: {e}")
+        return False
+    finally:
+        reader.close()
+        if target is not None:
+            try:
+                target.close()
+            except OSError as e:
+                logger.warning(f"Failed to close {output_path}: {e}")
+
+
+def _read_guest_block(reader: ImageReader, extents: List[Extent], index: int, start: int, size: int, buffer) -> Tuple[int, bool]:
+    """
+    Read a block of the guest disk into the buffer, unallocated ranges are filled with zeroes.
+    :param index: Index of the extent containing start, blocks are read in order so the search continues from it.
+    :return: Index of the extent containing the block end and True if the block has any allocated data.
+    """
+    view = memoryview(buffer)
+    end = start + size
+    position = start
+    has_data = False
+    while position < end:
+        while extents[index].start + extents[index].length <= position:
+            index += 1
+        extent = extents[index]
+        length = min(end, extent.start + extent.length) - position
+        target = view[position - start:position - start + length]
+        if extent.data:
+            reader.read(target, extent, position)
+            has_data = True
+        else:
+            target[:] = bytes(length)
+        position += length
+    return index, has_data
+
+
+def write_image_delta(input_path: str, output_path: str, extents: List[Extent], io_size: int = 4 * 1024**2, direct: bool = False, previous: Optional[ContentDigest] = None, progress: Optional[ProgressReporter] = None, hasher: Optional[ChunkHasher] = None) -> Optional[ContentDigest]:
+    """
+    Update a block device holding an older version of the image, writing only the blocks which differ.
+    Blocks are compared by their digests in the manifest of the old content if it is given, otherwise the old
+    block is read from the device and compared with the new one.
+    :param input_path: Path to the QEMU image file (qcow2 or raw).
+    :param output_path: Path to the block device with the old content.
+    :param extents: Extents of the image from get_image_extents.
+    :param io_size: Size of a compared block in bytes, also the chunk size of the returned manifest.
+    :param direct: Use O_DIRECT for reads and writes of the device.
+    :param previous: Manifest of the old content, used only if it has the same chunk size and disk size.
+    :param progress: Optional progress reporter, updated after every block.
+    :param hasher: Optional hasher the new content is added to.
+    :return: Manifest of the new content or None on error.
+    """
+    virtual_size = sum(extent.length for extent in extents)
+    if previous is not None and (previous.chunk_size != io_size or previous.size != virtual_size):
+        logger.warning(f"Chunk manifest of the old content does not match the image, comparing with the device content")
+        previous = None
+    logger.debug(f"Writing delta of image {input_path} to {output_path}, io size: {io_size}, manifest: {previous is not None}")
+    stats = WriteStats()
+    new_buffer = mmap.mmap(-1, io_size)
+    old_buffer = mmap.mmap(-1, io_size)
+    zero_buffer = bytes(io_size)
+    zero_digests = dict()
+    chunks: List[bytes] = []
+    try:
+        reader = ImageReader(input_path, extents)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to open image {input_path}: {e}")
+        return None
+    try:
+        target = BlockTarget(output_path, direct)
+    except OSError as e:
+        logger.error(f"Failed to open block device {output_path}: {e}")
+        reader.close()
+        return None
+    try:
+        if target.is_block_device and target.size < virtual_size:
+            logger.error(f"Block device {output_path} has {target.size} bytes, image needs {virtual_size} bytes")
+            return None
+        index = 0
+        for block_start in range(0, virtual_size, io_size):
+            size = min(io_size, virtual_size - block_start)
+            index, has_data = _read_guest_block(reader, extents, index, block_start, size, new_buffer)
+            new_view = memoryview(new_buffer)[:size]
+            zero = not has_data or is_zero(new_buffer, size, zero_buffer)
+            if zero:
+                if size not in zero_digests:
+                    zero_digests[size] = hashlib.new(DIGEST_ALGORITHM, zero_buffer[:size]).digest()
+                digest = zero_digests[size]
+            else:
+                digest = hashlib.new(DIGEST_ALGORITHM, new_view).digest()
+            chunks.append(digest)
+            if hasher is not None:
+                if zero:
+                    hasher.zero(block_start, size)
+                else:
+                    hasher.update(block_start, new_view)
+            if previous is not None:
+                unchanged = previous.chunks[len(chunks) - 1] == digest
+            else:
+                read = target.read(memoryview(old_buffer)[:size], block_start)
+                unchanged = read == size and old_buffer[:size] == new_buffer[:size]
+            if unchanged:
+                stats.bytes_unchanged += size
+            elif zero:
+                target.zero(block_start, size, ZeroMode.ZEROOUT, zero_buffer)
+                stats.bytes_zeroed += size
+            else:
+                target.write(new_view, block_start)
+                stats.bytes_written += size
+            if progress is not None:
+                progress.update(stats.bytes_processed)
+        target.close()
+        target = None
+        stats.end_time = time.monotonic()
+        if progress is not None:
+            progress.finish()
+        logger.info(f"Image delta written to {output_path}: {stats.report()}")
+        return ContentDigest(io_size, virtual_size, chunks)
+    except OSError as e:
+        logger.error(f"Failed to write image delta to {output_path}: {e}")
+        return None
+    finally:
+        reader.close()
+        if target is not None:
+            try:
+                target.close()
+            except OSError as e:
+                logger.warning(f"Failed to close {output_path}: {e}")
+
+
+def _read_full(fd: int, buffer) -> int:
+    """
+    Read from a pipe until the buffer is full or the stream ends.
+    :return: Number of bytes read, less than the buffer size only at the end of the stream.
+    """
+    view = memoryview(buffer)
+    done = 0
+    while done < len(view):
+        read = os.readv(fd, [view[done:]])
+        if read == 0:
+            break
+        done += read
+    return done
+
+
+def write_stream(input_path: str, output_path: str, size: int, io_size: int = 4 * 1024**2, direct: bool = False, zero_mode: ZeroMode = ZeroMode.ZEROOUT, queue_depth: int = 1, progress: Optional[ProgressReporter] = None, hasher: Optional[ChunkHasher] = None, pad_tolerance: int = 0) -> bool:
+    """
+    Write a raw disk image read sequentially from a stream (named pipe or stdin) to a block device while it is
+    being produced. Reading the stream overlaps with up to queue_depth writes, all-zero blocks are zeroed with
+    zero_mode. A stream which ends early is a failed write, e.g. of a crashed producer, unless it is shorter
+    than size by at most pad_tolerance bytes, then the rest is zeroed.
+    :param input_path: Path to the named pipe, "-" for stdin.
+    :param output_path: Path to the output block device.
+    :param size: Virtual size of the streamed disk in bytes.
+    :param io_size: Size of a single read/write request in bytes.
+    :param direct: Use O_DIRECT for the writes.
+    :param zero_mode: How to zero all-zero blocks.
+    :param queue_depth: Number of writes in flight.
+    :param progress: Optional progress reporter, updated after every request.
+    :param hasher: Optional hasher the stream is added to while it is read.
+    :param pad_tolerance: Number of missing bytes at the end of the stream which are zeroed instead of failing.
+    :return: True if the whole stream was written successfully, False otherwise.
+    """
+    queue_depth = max(1, queue_depth)
+    logger.debug(f"Writing stream {input_path} to {output_path}, size: {size}, io size: {io_size}, direct: {direct}, queue depth: {queue_depth}")
+    stats = WriteStats()
+    zero_buffer = bytes(io_size)
+    try:
+        # Opening a named pipe blocks until the producer opens it for writing
+        input_fd = os.dup(sys.stdin.fileno()) if input_path == "-" else os.open(input_path, os.O_RDONLY)
+    except OSError as e:
+        logger.error(f"Failed to open stream {input_path}: {e}")
+        return False
+    try:
+        target = BlockTarget(output_path, direct)
+    except OSError as e:
+        logger.error(f"Failed to open block device {output_path}: {e}")
+        os.close(input_fd)
+        return False
+    # One buffer is filled from the stream while the others are written
+    free_buffers: "queue.Queue[mmap.mmap]" = queue.Queue()
+    for _ in range(queue_depth + 1):
+        free_buffers.put(mmap.mmap(-1, io_size))
+    lock = threading.Lock()
+
+    def write(buffer: mmap.mmap, offset: int, length: int) -> None:
+        try:
+            if is_zero(buffer, length, zero_buffer):
+                target.zero(offset, length, zero_mode, zero_buffer)
+                zeroed, written = length, 0
+            else:
+                target.write(memoryview(buffer)[:length], offset)
+                zeroed, written = 0, length
+        finally:
+            free_buffers.put(buffer)
+        with lock:
+            stats.bytes_zeroed += zeroed
+            stats.bytes_written += written
+            processed = stats.bytes_processed
+        if progress is not None:
+            progress.update(processed)
+
+    try:
+        if target.is_block_device and target.size < size:
+            logger.error(f"Block device {output_path} has {target.size} bytes, image needs {size} bytes")
+            return False
+        offset = 0
+        with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="write") as executor:
+            pending = []
+            while True:
+                buffer = free_buffers.get()
+                # Raise errors of finished writes before reading more of the stream
+                for future in [future for future in pending if future.done()]:
+                    future.result()
+                    pending.remove(future)
+                length = _read_full(input_fd, buffer)
+                if length == 0:
+                    break
+                if offset == 0 and buffer[:len(QCOW2_MAGIC)] == QCOW2_MAGIC:
+                    logger.error(f"Stream {input_path} is a qcow2 image, only raw streams can be written while they are produced")
+                    return False
+                if offset + length > size:
+                    logger.error(f"Stream {input_path} is larger than the image size {size} bytes")
+                    return False
+                if hasher is not None:
+                    hasher.update(offset, memoryview(buffer)[:length])
+                pending.append(executor.submit(write, buffer, offset, length))
+                offset += length
+            for future in pending:
+                future.result()
+        if size - offset > pad_tolerance:
+            logger.error(f"Stream {input_path} ended after {offset} of {size} bytes")
+            return False
+        if offset < size:
+            logger.warning(f"Stream {input_path} ended after {offset} of {size} bytes, zeroing the rest")
+            target.zero(offset, size - offset, ZeroMode.ZEROOUT, zero_buffer)
+            stats.bytes_zeroed += size - offset
+            if hasher is not None:
+                hasher.zero(offset, size - offset)
+        target.close()
+        target = None
+        stats.end_time = time.monotonic()
+        if progress is not None:
+            progress.finish()
+        logger.info(f"Stream written to {output_path}: {stats.report()}")
+        return True
+    except OSError as e:
+        logger.error(f"Failed to write stream to {output_path}: {e}")
+        return False
+    finally:
+        os.close(input_fd)
+        if target is not None:
+            try:
+                target.close()
+            except OSError as e:
+                logger.warning(f"Failed to close {output_path}: {e}")
+
+
+class TeeTarget:
+    def __init__(self, path: str, direct: bool = False, progress: Optional[ProgressReporter] = None) -> None:
+        """
+        One output of a BlockTee with its own counters and failure state.
+        :param path: Path to the block device or file.
+        :param direct: Use O_DIRECT for the writes.
+        :param progress: Optional progress reporter of this output.
+        """
+        self.path = path
+        self.progress = progress
+        self.stats = WriteStats()
+        self.error: Optional[str] = None
+        self.target: Optional[BlockTarget] = None
+        try:
+            self.target = BlockTarget(path, direct)
+        except OSError as e:
+            self.fail(f"Failed to open block device: {e}")
+
+    @property
+    def alive(self) -> bool:
+        return self.error is None
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        logger.error(f"Write to {self.path} failed: {error}")
+
+
+class BlockTee:
+    def __init__(self, output_paths: List[str], size: int, io_size: int = 4 * 1024**2, direct: bool = False, zero_mode: ZeroMode = ZeroMode.ZEROOUT, queue_depth: int = 1, progresses: Optional[List[Optional[ProgressReporter]]] = None) -> None:
+        """
+        Writes every block to several block devices in parallel, so a source read once is copied to all of them.
+        A failed output is dropped, the others continue. A block is complete when all live outputs wrote it,
+        so the slowest output sets the pace and the memory use is bounded.
+        :param output_paths: Paths to the output block devices.
+        :param size: Virtual size of the written disk in bytes, smaller block devices fail immediately.
+        :param io_size: Size of the largest written block in bytes.
+        :param direct: Use O_DIRECT for the writes.
+        :param zero_mode: How to zero unallocated ranges and all-zero blocks.
+        :param queue_depth: Number of blocks written concurrently to one output.
+        :param progresses: Optional progress reporters of the outputs.
+        """
+        self.zero_mode = zero_mode
+        self.zero_buffer = bytes(io_size)
+        self.targets = [TeeTarget(path, direct, progress) for path, progress in zip(output_paths, progresses or [None] * len(output_paths))]
+        for target in self.targets:
+            if target.alive and target.target.is_block_device and target.target.size < size:
+                target.fail(f"Block device has {target.target.size} bytes, image needs {size} bytes")
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.targets) * max(1, queue_depth)), thread_name_prefix="tee")
+
+    @property
+    def alive(self) -> bool:
+        return any(target.alive for target in self.targets)
+
+    def fail_all(self, error: str) -> None:
+        with self._lock:
+            for target in self.targets:
+                if target.alive:
+                    target.fail(error)
+
+    def _apply(self, target: TeeTarget, data, offset: int, length: int, zero_mode: ZeroMode) -> None:
+        try:
+            if data is None:
+                target.target.zero(offset, length, zero_mode, self.zero_buffer)
+            else:
+                target.target.write(data, offset)
+        except OSError as e:
+            with self._lock:
+                if target.alive:
+                    target.fail(str(e))
+            return
+        with self._lock:
+            if data is None:
+                target.stats.bytes_zeroed += length
+            else:
+                target.stats.bytes_written += length
+            processed = target.stats.bytes_processed
+        if target.progress is not None:
+            target.progress.update(processed)
+
+    def _submit(self, data, offset: int, length: int, zero_mode: ZeroMode) -> bool:
+        futures = [self._executor.submit(self._apply, target, data, offset, length, zero_mode) for target in self.targets if target.alive]
+        for future in futures:
+            future.result()
+        return self.alive
+
+    def write(self, buffer, offset: int, length: int) -> bool:
+        """
+        Write the first length bytes of the buffer at the offset of all live outputs, an all-zero block is zeroed.
+        :return: False if no output is left.
+        """
+        if is_zero(buffer, length, self.zero_buffer):
+            return self._submit(None, offset, length, self.zero_mode)
+        return self._submit(memoryview(buffer)[:length], offset, length, self.zero_mode)
+
+    def zero(self, offset: int, length: int, zero_mode: Optional[ZeroMode] = None) -> bool:
+        """
+        Zero the range of all live outputs.
+        :param zero_mode: How to zero the range, zero_mode of the tee if None.
+        :return: False if no output is left.
+        """
+        return self._submit(None, offset, length, zero_mode or self.zero_mode)
+
+    def close(self) -> List[bool]:
+        """
+        Flush and close the outputs and log the throughput of every output.
+        :return: Result of every output in the order of output_paths.
+        """
+        self._executor.shutdown()
+        for target in self.targets:
+            if target.target is None:
+                continue
+            try:
+                target.target.close()
+            except OSError as e:
+                if target.alive:
+                    target.fail(f"Failed to close: {e}")
+            target.stats.end_time = time.monotonic()
+            if target.alive:
+                if target.progress is not None:
+                    target.progress.finish()
+                logger.info(f"Image written to {target.path}: {target.stats.report()}")
+        return [target.alive for target in self.targets]
+
+
+def write_image_fanout(input_path: str, output_paths: List[str], extents: List[Extent], io_size: int = 4 * 1024**2, direct: bool = False, zero_mode: ZeroMode = ZeroMode.ZEROOUT, queue_depth: int = 1, progresses: Optional[List[Optional[ProgressReporter]]] = None, hasher: Optional[ChunkHasher] = None) -> List[bool]:
+    """
+    Write the guest disk of a QEMU image to several block devices, reading the image once.
+    Like write_image_sparse, only allocated extents are read and all-zero blocks are zeroed. The outputs fail
+    independently, a read error fails all of them.
+    :param input_path: Path to the QEMU image file (qcow2 or raw).
+    :param output_paths: Paths to the output block devices.
+    :param extents: Extents of the image from get_image_extents.
+    :param io_size: Size of a single read/write request in bytes.
+    :param direct: Use O_DIRECT for the writes.
+    :param zero_mode: How to zero unallocated ranges.
+    :param queue_depth: Number of requests in flight.
+    :param progresses: Optional progress reporters of the outputs.
+    :param hasher: Optional hasher the written content is added to.
+    :return: Result of every output in the order of output_paths.
+    """
+    queue_depth = max(1, queue_depth)
+    logger.debug(f"Writing image {input_path} to {', '.join(output_paths)}, io size: {io_size}, direct: {direct}, zero mode: {zero_mode.value}, queue depth: {queue_depth}")
+    virtual_size = sum(extent.length for extent in extents)
+    try:
+        reader = ImageReader(input_path, extents)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to open image {input_path}: {e}")
+        return [False] * len(output_paths)
+    tee = BlockTee(output_paths, virtual_size, io_size, direct, zero_mode, queue_depth, progresses)
+    requests = _split_extents(extents, io_size)
+    lock = threading.Lock()
+
+    def worker() -> None:
+        buffer = mmap.mmap(-1, io_size)
+        while tee.alive:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                return
+            extent, start, size = request
+            if not extent.data:
+                tee.zero(start, size)
+                if hasher is not None:
+                    hasher.zero(start, size)
+                continue
+            try:
+                reader.read(memoryview(buffer)[:size], extent, start)
+            except OSError as e:
+                # Every output misses the block, none of them can be completed
+                tee.fail_all(f"Failed to read image {input_path}: {e}")
+                return
+            if hasher is not None:
+                hasher.update(start, memoryview(buffer)[:size])
+            tee.write(buffer, start, size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="read") as executor:
+            futures = [executor.submit(worker) for _ in range(queue_depth)]
+        for future in futures:
+            future.result()
+    finally:
+        reader.close()
+    return tee.close()
+
+
+def write_stream_fanout(input_path: str, output_paths: List[str], size: int, io_size: int = 4 * 1024**2, direct: bool = False, zero_mode: ZeroMode = ZeroMode.ZEROOUT, queue_depth: int = 1, progresses: Optional[List[Optional[ProgressReporter]]] = None, hasher: Optional[ChunkHasher] = None, pad_tolerance: int = 0) -> List[bool]:
+    """
+    Write a raw disk image read from a stream to several block devices while it is being produced,
+    see write_stream. The outputs fail independently, an invalid or short stream fails all of them.
+    :return: Result of every output in the order of output_paths.
+    """
+    queue_depth = max(1, queue_depth)
+    logger.debug(f"Writing stream {input_path} to {', '.join(output_paths)}, size: {size}, io size: {io_size}, direct: {direct}, queue depth: {queue_depth}")
+    try:
+        input_fd = os.dup(sys.stdin.fileno()) if input_path == "-" else os.open(input_path, os.O_RDONLY)
+    except OSError as e:
+        logger.error(f"Failed to open stream {input_path}: {e}")
+        return [False] * len(output_paths)
+    tee = BlockTee(output_paths, size, io_size, direct, zero_mode, queue_depth, progresses)
+    free_buffers: "queue.Queue[mmap.mmap]" = queue.Queue()
+    for _ in range(queue_depth + 1):
+        free_buffers.put(mmap.mmap(-1, io_size))
+
+    def write(buffer: mmap.mmap, offset: int, length: int) -> None:
+        try:
+            tee.write(buffer, offset, length)
+        finally:
+            free_buffers.put(buffer)
+
+    try:
+        offset = 0
+        with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="write") as executor:
+            while tee.alive:
+                buffer = free_buffers.get()
+                length = _read_full(input_fd, buffer)
+                if length == 0:
+                    break
+                if offset == 0 and buffer[:len(QCOW2_MAGIC)] == QCOW2_MAGIC:
+                    tee.fail_all(f"Stream {input_path} is a qcow2 image, only raw streams can be written while they are produced")
+                    break
+                if offset + length > size:
+                    tee.fail_all(f"Stream {input_path} is larger than the image size {size} bytes")
+                    break
+                if hasher is not None:
+                    hasher.update(offset, memoryview(buffer)[:length])
+                executor.submit(write, buffer, offset, length)
+                offset += length
+        if tee.alive and size - offset > pad_tolerance:
+            tee.fail_all(f"Stream {input_path} ended after {offset} of {size} bytes")
+        elif tee.alive and offset < size:
+            logger.warning(f"Stream {input_path} ended after {offset} of {size} bytes, zeroing the rest")
+            tee.zero(offset, size - offset, ZeroMode.ZEROOUT)
+            if hasher is not None:
+                hasher.zero(offset, size - offset)
+    except OSError as e:
+        tee.fail_all(f"Failed to read stream {input_path}: {e}")
+    finally:
+        os.close(input_fd)
+    return tee.close()
+
+
+def hash_image(input_path: str, extents: List[Extent], hasher: ChunkHasher, io_size: int = 4 * 1024**2, queue_depth: int = 1, end_offset: Optional[int] = None) -> bool:
+    """
+    Add the guest disk of a QEMU image to the hasher, for writes which do not pass the data through a hasher
+    (qemu-img convert) or only pass a part of it (a resumed sparse write). Unallocated extents are not read.
+    :param input_path: Path to the QEMU image file (qcow2 or raw).
+    :param extents: Extents of the image from get_image_extents.
+    :param hasher: Hasher the content is added to.
+    :param io_size: Size of a single read in bytes.
+    :param queue_depth: Number of reads in flight.
+    :param end_offset: Guest offset up to which the disk is added, the whole disk if None.
+    :return: True if the content was added, False if the image could not be read.
+    """
+    queue_depth = max(1, queue_depth)
+    try:
+        reader = ImageReader(input_path, extents)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to open image {input_path}: {e}")
+        return False
+    end_offset = end_offset if end_offset is not None else sum(extent.length for extent in extents)
+    requests = (request for request in _split_extents(extents, io_size) if request[1] < end_offset)
+    lock = threading.Lock()
+
+    def worker() -> None:
+        buffer = mmap.mmap(-1, io_size)
+        while True:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                return
+            extent, start, size = request
+            size = min(size, end_offset - start)
+            if not extent.data:
+                hasher.zero(start, size)
+                continue
+            view = memoryview(buffer)[:size]
+            reader.read(view, extent, start)
+            hasher.update(start, view)
+
+    try:
+        with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="hash") as executor:
+            futures = [executor.submit(worker) for _ in range(queue_depth)]
+        for future in futures:
+            future.result()
+        return True
+    except OSError as e:
+        logger.error(f"Failed to read image {input_path}: {e}")
+        return False
+    finally:
+        reader.close()
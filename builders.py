@@ -0,0 +1,171 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+import logging
+from typing import List, Optional, Set, Tuple
+from one import One
+from hotplug import HotplugCoordinator
+from waiters import AdaptivePoller
+
+logger = logging.getLogger("main." + __name__)
+
+# SCSI targets sda-sdz, see calculate_disk_location
+MAX_VM_DISKS = 26
+
+
+def parse_builder_vms(value: str, local_vm_id: int, local_dir_dev: str) -> List[Tuple[int, str]]:
+    """
+    Parse the list of builder VMs in the format "ID[=DIR_DEV],ID[=DIR_DEV],...".
+    Only the VM running the deploy job may omit DIR_DEV. The devices are found by their SCSI target, the same
+    target of another VM resolved in the local device directory is a different disk, possibly another image.
+    :param value: Comma or whitespace separated list of builder VMs.
+    :param local_vm_id: ID of the VM running the deploy job, VM_ID.
+    :param local_dir_dev: Device directory of the VM running the deploy job, DIR_DEV.
+    :return: List of tuples (VM ID, device directory).
+    :raises ValueError: If a VM other than the local one has no device directory.
+    """
+    builders = []
+    for entry in value.replace(",", " ").split():
+        vm_id, _, dir_dev = entry.partition("=")
+        if not dir_dev:
+            if int(vm_id) != local_vm_id:
+                raise ValueError(f"BUILDER_VMS entry {entry} needs the directory where the devices of VM {vm_id} are visible, e.g. {vm_id}=/host_dev")
+            dir_dev = local_dir_dev
+        builders.append((int(vm_id), dir_dev))
+    return builders
+
+
+class BuilderVM:
+    def __init__(self, vm_id: int, dir_dev: str, hotplug: HotplugCoordinator, last_io_path: str) -> None:
+        """
+        VM the images are attached to and written from.
+        :param vm_id: VM ID.
+        :param dir_dev: Directory where the block devices of the VM are visible to this process.
+        :param hotplug: Coordinator of hot-plug operations on the VM.
+        :param last_io_path: File whose modification time records the last write to the VM, shared by all jobs.
+        """
+        self.vm_id = vm_id
+        self.dir_dev = dir_dev
+        self.hotplug = hotplug
+        self.last_io_path = last_io_path
+        # IDs of the images placed on the VM by this process and not detached yet
+        self.reserved: Set[int] = set()
+
+    @property
+    def last_io(self) -> float:
+        try:
+            return os.stat(self.last_io_path).st_mtime
+        except OSError:
+            return 0.0
+
+    def touch_io(self) -> None:
+        """
+        Record that an image was written to the VM now.
+        """
+        try:
+            with open(self.last_io_path, "a"):
+                pass
+            os.utime(self.last_io_path)
+        except OSError as e:
+            logger.warning(f"Failed to record last I/O time of VM {self.vm_id}: {e}")
+
+
+class BuilderPool:
+    def __init__(self, one: One, builders: List[BuilderVM], max_disks: int = MAX_VM_DISKS) -> None:
+        """
+        Pool of builder VMs. Images are placed on the VM with the fewest attached disks,
+        ties are broken by the least recent I/O. Full VMs are skipped.
+        :param one: One instance for OpenNebula connection.
+        :param builders: Builder VMs.
+        :param max_disks: Maximal number of disks attached to one VM.
+        """
+        self.one = one
+        self.builders = builders
+        self.max_disks = max_disks
+        self._lock = threading.Lock()
+
+    def _disk_count(self, builder: BuilderVM) -> Optional[int]:
+        """
+        Number of disks attached to the VM plus the images reserved on it but not attached yet.
+        """
+        disks = self.one.get_vm_disks(builder.vm_id)
+        if disks is None:
+            return None
+        image_ids = set(builder.reserved)
+        other_disks = 0
+        for disk in disks:
+            if disk.get("IMAGE_ID") is not None:
+                image_ids.add(int(disk.get("IMAGE_ID")))
+            else:
+                other_disks += 1
+        return len(image_ids) + other_disks
+
+    def _select(self, image_id: int) -> Optional[BuilderVM]:
+        with self._lock:
+            candidates = []
+            for builder in self.builders:
+                disk_count = self._disk_count(builder)
+                if disk_count is None:
+                    logger.warning(f"Skipping builder VM {builder.vm_id}, failed to get its disks")
+                    continue
+                logger.debug(f"Builder VM {builder.vm_id}: {disk_count} disks, last I/O at {builder.last_io:.0f}")
+                if disk_count >= self.max_disks:
+                    continue
+                candidates.append((disk_count, builder.last_io, builder))
+            if not candidates:
+                return None
+            disk_count, _, builder = min(candidates, key=lambda candidate: candidate[:2])
+            builder.reserved.add(image_id)
+            logger.info(f"Placing image {image_id} on builder VM {builder.vm_id} with {disk_count} disks")
+            return builder
+
+    def reserve(self, image_id: int, timeout: float = 300) -> Optional[BuilderVM]:
+        """
+        Select a builder VM for the image and reserve a disk slot on it. Waits while all VMs are full.
+        :param image_id: ID of the image to place.
+        :param timeout: Timeout in seconds.
+        :return: Builder VM or None if no VM had a free slot within the timeout.
+        """
+        poller = AdaptivePoller(initial_interval=1.0, max_interval=10.0)
+        deadline = time.monotonic() + timeout
+        while True:
+            builder = self._select(image_id)
+            if builder is not None:
+                return builder
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.error(f"No builder VM has a free disk slot for image {image_id} within timeout: {timeout} seconds")
+                return None
+            logger.info(f"All builder VMs have {self.max_disks} disks, waiting for a free slot")
+            time.sleep(min(poller.next_interval(), remaining))
+
+    def get(self, vm_id: int) -> Optional[BuilderVM]:
+        """
+        Get the builder VM with the ID.
+        :return: Builder VM or None if the VM is not in the pool.
+        """
+        for builder in self.builders:
+            if builder.vm_id == vm_id:
+                return builder
+        return None
+
+    def release(self, builder: BuilderVM, image_id: int) -> None:
+        """
+        Release the slot of the image after it was detached.
+        """
+        with self._lock:
+            builder.reserved.discard(image_id)
@@ -0,0 +1,153 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+from one import One
+
+logger = logging.getLogger("main." + __name__)
+
+
+class PlannedImage(NamedTuple):
+    id: int
+    name: str
+    size_bytes: int
+    datastore: str  # "<ID> (<name>)"
+
+
+class TemplateDeletion:
+    def __init__(self, template_id: int) -> None:
+        """
+        Deletion of one VM template with its images and its outcome.
+        """
+        self.template_id = template_id
+        self.name = ""
+        self.images: List[PlannedImage] = []
+        self.template_deleted = False
+        # IDs of the images verified to be gone from the datastore
+        self.images_deleted: List[int] = []
+        self.error: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+
+class BulkDeleter:
+    def __init__(self, one: One, workers: int = 4, retries: int = 3, backoff: float = 1.0, wait_timeout: int = 300, dry_run: bool = False) -> None:
+        """
+        Deletes VM templates with their images concurrently and verifies that the images left their datastores.
+        The request rate is limited by the max_request_rate of the One instance.
+        :param one: One instance for OpenNebula connection.
+        :param workers: Number of templates deleted concurrently.
+        :param retries: Number of retries of a delete request after transient errors.
+        :param backoff: Delay before the first retry in seconds, doubled after every retry.
+        :param wait_timeout: Timeout in seconds for an image to be removed from its datastore.
+        :param dry_run: Only plan the deletion and report what would be freed.
+        """
+        self.one = one
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.wait_timeout = wait_timeout
+        self.dry_run = dry_run
+
+    def plan(self, template_id: int) -> TemplateDeletion:
+        """
+        Collect the images used by the template together with their size and datastore.
+        """
+        deletion = TemplateDeletion(template_id)
+        template = self.one.get_vm_template(template_id)
+        if template is None:
+            deletion.error = "failed to get the template"
+            return deletion
+        deletion.name = template.NAME
+        disks = template.TEMPLATE.get("DISK") or []
+        if not isinstance(disks, list):
+            disks = [disks]
+        for disk in disks:
+            if disk.get("IMAGE_ID") is None:
+                continue
+            image_id = int(disk.get("IMAGE_ID"))
+            image = self.one.get_image(image_id)
+            if image is None:
+                logger.warning(f"Image {image_id} of VM template {template_id} not found, it is not deleted")
+                continue
+            # SIZE is in MB
+            deletion.images.append(PlannedImage(image_id, image.NAME, int(image.SIZE) * 1024**2, f"{image.DATASTORE_ID} ({image.DATASTORE})"))
+        return deletion
+
+    def delete_one(self, template_id: int) -> TemplateDeletion:
+        """
+        Delete the template with its images and wait until the images are gone.
+        """
+        deletion = self.plan(template_id)
+        if not deletion.success:
+            return deletion
+        image_names = ", ".join(f"{image.id} ({image.name})" for image in deletion.images)
+        if self.dry_run:
+            logger.info(f"Dry run: would delete VM template {template_id} ({deletion.name}) with images: {image_names or 'none'}")
+            return deletion
+        logger.info(f"Deleting VM template {template_id} ({deletion.name}) with images: {image_names or 'none'}")
+        deletion.template_deleted = self.one.delete_vm_template(template_id, delete_images=True, retries=self.retries, backoff=self.backoff)
+        if not deletion.template_deleted:
+            deletion.error = "failed to delete the template"
+            return deletion
+        for image in deletion.images:
+            if self.one.wait_for_image_deleted(image.id, timeout=self.wait_timeout):
+                deletion.images_deleted.append(image.id)
+        if len(deletion.images_deleted) != len(deletion.images):
+            deletion.error = "some images were not removed from their datastore"
+        return deletion
+
+    def delete(self, template_ids: List[int]) -> List[TemplateDeletion]:
+        """
+        Delete the templates concurrently.
+        :param template_ids: IDs of the templates to delete.
+        :return: Outcome of every deletion in the order of template_ids.
+        """
+        workers = max(1, min(self.workers, len(template_ids)))
+        logger.info(f"Deleting {len(template_ids)} VM templates using {workers} workers{' (dry run)' if self.dry_run else ''}")
+
+        def delete(template_id: int) -> TemplateDeletion:
+            try:
+                return self.delete_one(template_id)
+            except Exception as e:
+                logger.critical(f"Exception caught while deleting VM template {template_id}: {e}")
+                deletion = TemplateDeletion(template_id)
+                deletion.error = str(e)
+                return deletion
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="delete") as executor:
+            return list(executor.map(delete, template_ids))
+
+    def report(self, deletions: List[TemplateDeletion]) -> Dict[str, int]:
+        """
+        Log the summary of the deletion and the freed space per datastore.
+        :return: Dictionary mapping datastore to freed (in dry run to be freed) bytes.
+        """
+        freed: Dict[str, int] = {}
+        for deletion in deletions:
+            for image in deletion.images:
+                if self.dry_run or image.id in deletion.images_deleted:
+                    freed[image.datastore] = freed.get(image.datastore, 0) + image.size_bytes
+        failed = [deletion for deletion in deletions if not deletion.success]
+        action = "Would delete" if self.dry_run else "Deleted"
+        logger.info(f"{action} {len(deletions) - len(failed)} of {len(deletions)} VM templates")
+        for deletion in failed:
+            logger.error(f"VM template {deletion.template_id} ({deletion.name}): {deletion.error}")
+        for datastore, size in sorted(freed.items()):
+            logger.info(f"Datastore {datastore}: {'would free' if self.dry_run else 'freed'} {size / 1024**3:.2f} GB")
+        return freed
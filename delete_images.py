@@ -16,6 +16,8 @@
 
 import os
 from one import One
+from template_index import TemplateIndex
+from bulk_delete import BulkDeleter
 import logging
 
 if __name__ == "__main__":
@@ -29,7 +31,7 @@ if __name__ == "__main__":
     logger = logging.getLogger("main")
     logger.setLevel(log_level)
     # Create formatter
-    log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
+    log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(threadName)s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
     # Create stream handler (console)
     log_stream_handler = logging.StreamHandler()
     log_stream_handler.setFormatter(log_formatter)
@@ -44,6 +46,25 @@ if __name__ == "__main__":
     logger.debug(f"CI_PIPELINE_ID: {CI_PIPELINE_ID}")
     CI_COMMIT_SHA = os.environ.get("CI_COMMIT_SHA", "")
     logger.debug(f"CI_COMMIT_SHA: {CI_COMMIT_SHA}")
+    TEMPLATE_INDEX_PATH = os.environ.get("TEMPLATE_INDEX_PATH", "")
+    logger.debug(f"TEMPLATE_INDEX_PATH: {TEMPLATE_INDEX_PATH}")
+    # At least 2, oned reads a page size of 1 as an ID range
+    TEMPLATE_PAGE_SIZE = max(int(os.environ.get("TEMPLATE_PAGE_SIZE", "500")), 2)
+    logger.debug(f"TEMPLATE_PAGE_SIZE: {TEMPLATE_PAGE_SIZE}")
+    DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", "4"))
+    logger.debug(f"DELETE_WORKERS: {DELETE_WORKERS}")
+    # Maximal number of OpenNebula requests per second, 0 for unlimited
+    DELETE_RATE = float(os.environ.get("DELETE_RATE", "10"))
+    logger.debug(f"DELETE_RATE: {DELETE_RATE}")
+    DELETE_RETRIES = int(os.environ.get("DELETE_RETRIES", "3"))
+    logger.debug(f"DELETE_RETRIES: {DELETE_RETRIES}")
+    DELETE_WAIT_TIMEOUT = int(os.environ.get("DELETE_WAIT_TIMEOUT", "300"))
+    logger.debug(f"DELETE_WAIT_TIMEOUT: {DELETE_WAIT_TIMEOUT}")
+    DRY_RUN = os.environ.get("DRY_RUN", "false") == "true"
+    logger.debug(f"DRY_RUN: {DRY_RUN}")
+    # Retries of failed XML-RPC requests, requests changing state are repeated only if they did not reach oned
+    ONE_RETRIES = int(os.environ.get("ONE_RETRIES", "3"))
+    logger.debug(f"ONE_RETRIES: {ONE_RETRIES}")
     # Read credentials from ONE_AUTH file
     try:
         logger.info(f"Reading Opennebula credentials from {ONE_AUTH}")
@@ -59,18 +80,26 @@ if __name__ == "__main__":
         exit(1)
     # Inicialize OpenNebula connection
     logger.info("Inicializing OpenNebula connection")
-    one = One(url=ONE_XMLRPC, username=username, password=password)
+    one = One(url=ONE_XMLRPC, username=username, password=password, max_request_rate=DELETE_RATE, retries=ONE_RETRIES)
     # Get all images with given CI_PIPELINE_ID
     all_resources_filter = -2
     logger.info(f"Getting all templates with CI_PIPELINE_ID: {CI_PIPELINE_ID} and CI_COMMIT_SHA: {CI_COMMIT_SHA}")
+    template_index = TemplateIndex(TEMPLATE_INDEX_PATH) if TEMPLATE_INDEX_PATH else None
     template_ids: list = one.find_templates_by_attributes(
         filter=all_resources_filter,
         attributes={
             "CI_PIPELINE_ID": CI_PIPELINE_ID,
             "CI_COMMIT_SHA": CI_COMMIT_SHA
-        }
+        },
+        index=template_index,
+        page_size=TEMPLATE_PAGE_SIZE
     )
+    if template_ids is None:
+        exit(1)
     logger.info(f"Found {len(template_ids)} matching templates")
-    for template_id in template_ids:
-        logger.info(f"Deleting template {template_id} with all images")
-        one.delete_vm_template(template_id, delete_images=True)
+    deleter = BulkDeleter(one, workers=DELETE_WORKERS, retries=DELETE_RETRIES, wait_timeout=DELETE_WAIT_TIMEOUT, dry_run=DRY_RUN)
+    deletions = deleter.delete(template_ids)
+    deleter.report(deletions)
+    one.call_stats.log_summary()
+    if not all(deletion.success for deletion in deletions):
+        exit(1)
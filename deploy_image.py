@@ -15,13 +15,1081 @@
 # limitations under the License.
 
 import os
+import re
+import glob
+import enum
+import copy
+import socket
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 from image_names import ImageNames
-from utils import detach_image_by_id, calculate_disk_location, acquire_lock, unlock
+from utils import calculate_disk_location, detach_image_by_id, read_one_credentials
+from locking import LeaseLock
+from hotplug import HotplugCoordinator
+from builders import BuilderPool, BuilderVM, parse_builder_vms
 from one import One, ImageType, ImageDevPrefix, ImageFormat
-from states import VMLCMState, ImageState
-from qemu import get_qemu_image_size_mb, convert_image_format
+from states import ImageState
+from qemu import get_qemu_image_size_mb, get_qemu_image_virtual_size, convert_image_format
+from block_writer import ZeroMode, get_image_extents, hash_image, write_image_sparse, write_image_delta, write_stream, write_image_fanout, write_stream_fanout
+from metrics import ProgressReporter, StageTimer, get_timings_path
+from digest import ChunkHasher, ContentDigest, compute_digest, verify_digest
+from journal import DeployJournal, get_journal_path
+from telemetry import telemetry
+from upload import ExportServer, UploadMode, get_upload_source
+from export_cache import ExportCache
+from devices import wait_for_device
 import logging
 
+loggger = logging.getLogger("main." + __name__)
+
+
+class DedupMode(enum.Enum):
+    OFF = "off"      # Always write the image
+    CLONE = "clone"  # Clone an existing image with the same content digest
+
+
+class DeploySettings:
+    def __init__(self) -> None:
+        """
+        Load deploy settings from environment variables.
+        """
+        self.one_xmlrpc = os.environ.get("ONE_XMLRPC", "http://localhost:2633/RPC2")
+        loggger.debug(f"ONE_XMLRPC: {self.one_xmlrpc}")
+        self.one_auth = os.environ.get("ONE_AUTH", "~/.one/one_auth")
+        loggger.debug(f"ONE_AUTH: {self.one_auth}")
+        # Optional ZeroMQ endpoint of the OpenNebula hook manager, e.g. tcp://opennebula:2101
+        self.one_events_endpoint = os.environ.get("ONE_EVENTS_ENDPOINT", "")
+        loggger.debug(f"ONE_EVENTS_ENDPOINT: {self.one_events_endpoint}")
+        # Seconds for which VM and image state is answered from a shared pool snapshot, 0 disables the cache
+        self.one_cache_ttl = float(os.environ.get("ONE_CACHE_TTL", "0.5"))
+        loggger.debug(f"ONE_CACHE_TTL: {self.one_cache_ttl}")
+        self.one_timeout = float(os.environ.get("ONE_TIMEOUT", "10"))
+        loggger.debug(f"ONE_TIMEOUT: {self.one_timeout}")
+        # Retries of failed XML-RPC requests, requests changing state are repeated only if they did not reach oned
+        self.one_retries = int(os.environ.get("ONE_RETRIES", "3"))
+        loggger.debug(f"ONE_RETRIES: {self.one_retries}")
+        # Consecutive failed requests after which requests fail immediately for ONE_CIRCUIT_RESET_TIME seconds
+        self.one_circuit_threshold = int(os.environ.get("ONE_CIRCUIT_THRESHOLD", "5"))
+        loggger.debug(f"ONE_CIRCUIT_THRESHOLD: {self.one_circuit_threshold}")
+        self.one_circuit_reset_time = float(os.environ.get("ONE_CIRCUIT_RESET_TIME", "30"))
+        loggger.debug(f"ONE_CIRCUIT_RESET_TIME: {self.one_circuit_reset_time}")
+        # One datastore ID or a list separated by commas or whitespace, the image is deployed to all of them at once
+        self.image_datastore_ids: List[int] = [int(value) for value in re.split(r"[\s,]+", os.environ.get("IMAGE_DATASTORE_ID", "-1")) if value]
+        loggger.debug(f"IMAGE_DATASTORE_ID: {self.image_datastore_ids}")
+        # Datastore of the deploy, the first one of the list
+        self.image_datastore_id: int = self.image_datastore_ids[0]
+        self.vm_id: int = int(os.environ.get("VM_ID", "-1"))
+        loggger.debug(f"VM_ID: {self.vm_id}")
+        self.ci_pipeline_id = os.environ.get("CI_PIPELINE_ID", "")
+        loggger.debug(f"CI_PIPELINE_ID: {self.ci_pipeline_id}")
+        self.ci_job_id = os.environ.get("CI_JOB_ID", "")
+        loggger.debug(f"CI_JOB_ID: {self.ci_job_id}")
+        self.ci_commit_sha = os.environ.get("CI_COMMIT_SHA", "")
+        loggger.debug(f"CI_COMMIT_SHA: {self.ci_commit_sha}")
+        self.distro_name = os.environ.get("DISTRO_NAME", "")
+        loggger.debug(f"DISTRO_NAME: {self.distro_name}")
+        self.distro_ver = os.environ.get("DISTRO_VER", "")
+        loggger.debug(f"DISTRO_VER: {self.distro_ver}")
+        self.distro_edition = os.environ.get("DISTRO_EDITION", "")
+        loggger.debug(f"DISTRO_EDITION: {self.distro_edition}")
+        self.image_name_prefix = os.environ.get("IMAGE_NAME_PREFIX", "")
+        loggger.debug(f"IMAGE_NAME_PREFIX: {self.image_name_prefix}")
+        self.image_name_suffix = os.environ.get("IMAGE_NAME_SUFFIX", "")
+        loggger.debug(f"IMAGE_NAME_SUFFIX: {self.image_name_suffix}")
+        self.architecture = os.environ.get("ARCHITECTURE", "x64")
+        loggger.debug(f"ARCHITECTURE: {self.architecture}")
+        self.language = os.environ.get("LANGUAGE", "en-US")
+        loggger.debug(f"LANGUAGE: {self.language}")
+        self.vm_template_path = os.environ.get("VM_TEMPLATE_PATH", "template.tmpl")
+        loggger.debug(f"VM_TEMPLATE_PATH: {self.vm_template_path}")
+        self.dir_export = os.environ.get("DIR_EXPORT", ".")
+        loggger.debug(f"DIR_EXPORT: {self.dir_export}")
+        self.dir_dev = os.environ.get("DIR_DEV", "/dev")
+        loggger.debug(f"DIR_DEV: {self.dir_dev}")
+        # Pool of builder VMs "ID[=DIR_DEV],...", defaults to VM_ID
+        self.builder_vms = parse_builder_vms(os.environ.get("BUILDER_VMS", ""), self.vm_id, self.dir_dev) or [(self.vm_id, self.dir_dev)]
+        loggger.debug(f"BUILDER_VMS: {self.builder_vms}")
+        # Directory with the per-VM lock queues, shared by all deploy jobs
+        self.lock_dir = os.environ.get("LOCK_DIR", "/tmp/one-locks")
+        loggger.debug(f"LOCK_DIR: {self.lock_dir}")
+        self.lock_timeout = float(os.environ.get("LOCK_TIMEOUT", "300"))
+        loggger.debug(f"LOCK_TIMEOUT: {self.lock_timeout}")
+        self.lock_lease_time = float(os.environ.get("LOCK_LEASE_TIME", "600"))
+        loggger.debug(f"LOCK_LEASE_TIME: {self.lock_lease_time}")
+        # Batch mode, list of DISTRO_NAME + DISTRO_VER + DISTRO_EDITION names separated by commas or whitespace
+        self.deploy_images = os.environ.get("DEPLOY_IMAGES", "")
+        loggger.debug(f"DEPLOY_IMAGES: {self.deploy_images}")
+        # Batch mode, deploy every qcow2 image found in DIR_EXPORT
+        self.deploy_scan_export = os.environ.get("DEPLOY_SCAN_EXPORT", "false") == "true"
+        loggger.debug(f"DEPLOY_SCAN_EXPORT: {self.deploy_scan_export}")
+        self.deploy_workers: int = int(os.environ.get("DEPLOY_WORKERS", "4"))
+        loggger.debug(f"DEPLOY_WORKERS: {self.deploy_workers}")
+        # Streaming mode, raw disk read from a named pipe ("-" for stdin) while the build job produces it
+        self.stream_input = os.environ.get("STREAM_INPUT", "")
+        loggger.debug(f"STREAM_INPUT: {self.stream_input}")
+        self.stream_size_mb: int = int(os.environ.get("STREAM_SIZE_MB", "-1"))
+        loggger.debug(f"STREAM_SIZE_MB: {self.stream_size_mb}")
+        # A stream shorter than STREAM_SIZE_MB by at most this much is padded with zeroes, a shorter one fails the deploy
+        self.stream_pad_mb: int = int(os.environ.get("STREAM_PAD_MB", "0"))
+        loggger.debug(f"STREAM_PAD_MB: {self.stream_pad_mb}")
+        # Write mode: "convert" (qemu-img convert) or "sparse" (copy only allocated extents)
+        self.write_mode = os.environ.get("WRITE_MODE", "convert")
+        loggger.debug(f"WRITE_MODE: {self.write_mode}")
+        self.write_io_size_kb: int = int(os.environ.get("WRITE_IO_SIZE_KB", "4096"))
+        loggger.debug(f"WRITE_IO_SIZE_KB: {self.write_io_size_kb}")
+        self.write_direct = os.environ.get("WRITE_DIRECT", "false") == "true"
+        loggger.debug(f"WRITE_DIRECT: {self.write_direct}")
+        self.write_zero_mode = ZeroMode(os.environ.get("WRITE_ZERO_MODE", ZeroMode.ZEROOUT.value))
+        loggger.debug(f"WRITE_ZERO_MODE: {self.write_zero_mode.value}")
+        # Number of concurrent write requests in sparse mode, keeps the virtio-scsi queues busy
+        self.write_queue_depth: int = int(os.environ.get("WRITE_QUEUE_DEPTH", "4"))
+        loggger.debug(f"WRITE_QUEUE_DEPTH: {self.write_queue_depth}")
+        # Minimal interval in seconds between two write progress lines
+        self.progress_interval = float(os.environ.get("PROGRESS_INTERVAL", "10"))
+        loggger.debug(f"PROGRESS_INTERVAL: {self.progress_interval}")
+        # Directory for the per-image stage timing summaries, next to the exported images by default
+        self.timings_dir = os.environ.get("TIMINGS_DIR", self.dir_export)
+        loggger.debug(f"TIMINGS_DIR: {self.timings_dir}")
+        # Update a clone of the previous image of the same edition instead of writing the full image
+        self.delta_mode = os.environ.get("DELTA_MODE", "false") == "true"
+        loggger.debug(f"DELTA_MODE: {self.delta_mode}")
+        # Directory with chunk digests of deployed images, the previous image is read for comparison without them
+        self.delta_manifest_dir = os.environ.get("DELTA_MANIFEST_DIR", "")
+        loggger.debug(f"DELTA_MANIFEST_DIR: {self.delta_manifest_dir}")
+        self.dedup_mode = DedupMode(os.environ.get("DEDUP_MODE", DedupMode.OFF.value))
+        loggger.debug(f"DEDUP_MODE: {self.dedup_mode.value}")
+        self.digest_chunk_size = int(os.environ.get("DIGEST_CHUNK_MB", "64")) * 1024**2
+        loggger.debug(f"DIGEST_CHUNK_MB: {self.digest_chunk_size // 1024**2}")
+        self.digest_workers = int(os.environ.get("DIGEST_WORKERS", "4"))
+        loggger.debug(f"DIGEST_WORKERS: {self.digest_workers}")
+        # Directory for the per-image deploy journals, a retried job resumes the interrupted deploys. Empty disables resuming
+        self.journal_dir = os.environ.get("JOURNAL_DIR", self.dir_export)
+        loggger.debug(f"JOURNAL_DIR: {self.journal_dir}")
+        # Bytes written between two journal checkpoints of a sparse write
+        self.journal_checkpoint_size = int(os.environ.get("JOURNAL_CHECKPOINT_MB", "256")) * 1024**2
+        loggger.debug(f"JOURNAL_CHECKPOINT_MB: {self.journal_checkpoint_size // 1024**2}")
+        # Spans and histograms of the job are appended to this file in the OTLP/JSON format. Empty disables
+        self.telemetry_otlp_file = os.environ.get("TELEMETRY_OTLP_FILE", "")
+        loggger.debug(f"TELEMETRY_OTLP_FILE: {self.telemetry_otlp_file}")
+        # Histograms of the job are written to this file in the Prometheus text format. Empty disables
+        self.telemetry_prometheus_file = os.environ.get("TELEMETRY_PROMETHEUS_FILE", "")
+        loggger.debug(f"TELEMETRY_PROMETHEUS_FILE: {self.telemetry_prometheus_file}")
+        # Upload mode: "hotplug" writes the export through a builder VM, in "path" and "url" mode the datastore imports it
+        self.upload_mode = UploadMode(os.environ.get("UPLOAD_MODE", UploadMode.HOTPLUG.value))
+        if self.stream_input and self.upload_mode != UploadMode.HOTPLUG:
+            loggger.warning(f"UPLOAD_MODE {self.upload_mode.value} can not import a stream, using hotplug")
+            self.upload_mode = UploadMode.HOTPLUG
+        loggger.debug(f"UPLOAD_MODE: {self.upload_mode.value}")
+        # Directory under which the datastore sees DIR_EXPORT in path mode
+        self.upload_path = os.environ.get("UPLOAD_PATH", os.path.abspath(self.dir_export))
+        loggger.debug(f"UPLOAD_PATH: {self.upload_path}")
+        # Port on which the deploy job serves DIR_EXPORT in url mode, 0 if DIR_EXPORT is served by another web server
+        self.upload_serve_port = int(os.environ.get("UPLOAD_SERVE_PORT", "0"))
+        loggger.debug(f"UPLOAD_SERVE_PORT: {self.upload_serve_port}")
+        # Address the deploy job serves DIR_EXPORT on, all addresses if empty
+        self.upload_serve_host = os.environ.get("UPLOAD_SERVE_HOST", "")
+        loggger.debug(f"UPLOAD_SERVE_HOST: {self.upload_serve_host}")
+        # Base URL under which the datastore downloads DIR_EXPORT in url mode
+        self.upload_url = os.environ.get("UPLOAD_URL", "") or (f"http://{self.upload_serve_host or socket.getfqdn()}:{self.upload_serve_port}/" if self.upload_serve_port else "")
+        loggger.debug(f"UPLOAD_URL: {self.upload_url}")
+        # Format the export is converted to before the import, a qcow2 export is imported as it is unless compressed
+        self.upload_format = ImageFormat(os.environ.get("UPLOAD_FORMAT", ImageFormat.QCOW2.value).upper())
+        loggger.debug(f"UPLOAD_FORMAT: {self.upload_format.value}")
+        self.upload_compress = os.environ.get("UPLOAD_COMPRESS", "false") == "true"
+        if self.upload_compress and self.upload_format != ImageFormat.QCOW2:
+            # qemu-img compresses only qcow2 images
+            loggger.warning(f"UPLOAD_COMPRESS is not supported for UPLOAD_FORMAT {self.upload_format.value}, the image is not compressed")
+            self.upload_compress = False
+        loggger.debug(f"UPLOAD_COMPRESS: {self.upload_compress}")
+        # Compression of a compressed qcow2 image: "zlib" or "zstd" (faster to decompress, needs qemu 5.1 or newer)
+        self.upload_compression_type = os.environ.get("UPLOAD_COMPRESSION_TYPE", "zlib")
+        loggger.debug(f"UPLOAD_COMPRESSION_TYPE: {self.upload_compression_type}")
+        # Cache of converted exports keyed by their content digest, shared by the jobs of the runner. Empty disables
+        self.export_cache_dir = os.environ.get("EXPORT_CACHE_DIR", os.path.join(self.dir_export, ".export-cache"))
+        loggger.debug(f"EXPORT_CACHE_DIR: {self.export_cache_dir}")
+        self.export_cache_size = int(os.environ.get("EXPORT_CACHE_MB", "20480")) * 1024**2
+        loggger.debug(f"EXPORT_CACHE_MB: {self.export_cache_size // 1024**2}")
+        # Seconds the datastore has for the import of the image
+        self.upload_timeout = float(os.environ.get("UPLOAD_TIMEOUT", "3600"))
+        loggger.debug(f"UPLOAD_TIMEOUT: {self.upload_timeout}")
+        # Read the written device back and compare it with chunk digests of the source computed during the write
+        self.verify_write = os.environ.get("VERIFY_WRITE", "false") == "true"
+        loggger.debug(f"VERIFY_WRITE: {self.verify_write}")
+        self.verify_chunk_size = int(os.environ.get("VERIFY_CHUNK_MB", "64")) * 1024**2
+        loggger.debug(f"VERIFY_CHUNK_MB: {self.verify_chunk_size // 1024**2}")
+        self.verify_workers = int(os.environ.get("VERIFY_WORKERS", "4"))
+        loggger.debug(f"VERIFY_WORKERS: {self.verify_workers}")
+        # Seconds udev has to create the device of an attached image with the size of the image
+        self.device_timeout = float(os.environ.get("DEVICE_TIMEOUT", "60"))
+        loggger.debug(f"DEVICE_TIMEOUT: {self.device_timeout}")
+        self.image_names = ImageNames(self.image_name_prefix, self.architecture, self.language, self.image_name_suffix)
+
+
+def get_images_to_deploy(settings: DeploySettings) -> List[str]:
+    """
+    Get the names of the images to deploy. Batch settings take precedence over the DISTRO_* variables.
+    A stream is always deployed as the image given by the DISTRO_* variables.
+    :param settings: Deploy settings.
+    :return: List of image names (DISTRO_NAME + DISTRO_VER + DISTRO_EDITION).
+    """
+    if settings.stream_input:
+        return [settings.distro_name + settings.distro_ver + settings.distro_edition]
+    if settings.deploy_scan_export:
+        loggger.debug(f"Scanning {settings.dir_export} for qcow2 images")
+        paths = sorted(glob.glob(os.path.join(settings.dir_export, "*.qcow2")))
+        return [os.path.basename(path)[:-len(".qcow2")] for path in paths]
+    if settings.deploy_images:
+        return [name for name in re.split(r"[\s,]+", settings.deploy_images) if name]
+    return [settings.distro_name + settings.distro_ver + settings.distro_edition]
+
+
+def get_manifest_path(settings: DeploySettings, image_id: int) -> str:
+    return os.path.join(settings.delta_manifest_dir, f"{image_id}.chunks.json")
+
+
+def get_upload_file_path(settings: DeploySettings, image_name: str) -> str:
+    """
+    Path of the export converted for the import if the export cache is disabled, next to the export.
+    Not matched by the DEPLOY_SCAN_EXPORT pattern.
+    """
+    return os.path.join(settings.dir_export, f"{get_deploy_name(settings, image_name)}.{settings.upload_format.value.lower()}.upload")
+
+
+def is_upload_file(settings: DeploySettings, path: str) -> bool:
+    """
+    Whether the datastore may download the file in url mode: an export, its conversion for the import
+    or an entry of the export cache. Files being written and lock files are not served.
+    :param path: Real path of the requested file.
+    """
+    name = os.path.basename(path)
+    if name.startswith(".") or name.endswith((".lock", ".tmp")):
+        return False
+    directory = os.path.dirname(path)
+    if directory == os.path.realpath(settings.export_cache_dir):
+        return True
+    return directory == os.path.realpath(settings.dir_export) and name.endswith((".qcow2", ".upload"))
+
+
+def is_primary_datastore(settings: DeploySettings) -> bool:
+    return settings.image_datastore_id == settings.image_datastore_ids[0]
+
+
+def get_deploy_name(settings: DeploySettings, image_name: str) -> str:
+    """
+    Name of the deploy of the image to the datastore of the settings, used for the journal and the stage timings.
+    Deploys to the first datastore are named by the image, so a single datastore deploy is named as before.
+    """
+    if is_primary_datastore(settings):
+        return image_name
+    return f"{image_name}.ds{settings.image_datastore_id}"
+
+
+def get_image_long_name(settings: DeploySettings, image_name: str) -> str:
+    """
+    Name of the image and its VM template. Names are unique per owner in OpenNebula, the images in the other
+    datastores get the datastore ID appended.
+    """
+    image_long_name = settings.image_names.get_image_name(image_name)
+    if is_primary_datastore(settings):
+        return image_long_name
+    return f"{image_long_name} ds{settings.image_datastore_id}"
+
+
+class FanoutWrite:
+    def __init__(self, settings: DeploySettings, image_name: str, image_path: str, participants: int) -> None:
+        """
+        Meeting point of the concurrent deploys of one export to several datastores. Every deploy attaches its
+        image and calls write, the last one reads the export once and writes it to the images of all of them.
+        A deploy which fails before its write, or writes its image on its own, has to leave, so the others
+        do not wait for it.
+        :param settings: Deploy settings.
+        :param image_name: Name of the image.
+        :param image_path: Path to the exported image or the stream.
+        :param participants: Number of deploys.
+        """
+        self.settings = settings
+        self.image_name = image_name
+        self.image_path = image_path
+        self._expected = participants
+        self._condition = threading.Condition()
+        # Datastore ID -> (block device path, progress reporter)
+        self._targets: Dict[int, Tuple[str, ProgressReporter]] = {}
+        self._left: set = set()
+        self._writing = False
+        self._results: Optional[Dict[int, bool]] = None
+        # The written content is hashed once for the verification of all images
+        self._hasher = create_hasher(settings, image_path) if settings.verify_write else None
+
+    def leave(self, datastore_id: int) -> None:
+        """
+        The deploy to the datastore does not take part in the write. Does nothing after it wrote.
+        """
+        with self._condition:
+            if datastore_id in self._targets or datastore_id in self._left:
+                return
+            self._left.add(datastore_id)
+            self._expected -= 1
+            self._condition.notify_all()
+
+    def write(self, datastore_id: int, block_device_path: str, progress: ProgressReporter, hasher: Optional[ChunkHasher] = None) -> bool:
+        """
+        Wait until all deploys attached their images or left, then write the export to all attached images.
+        :param hasher: Optional hasher receiving the digests of the written content.
+        :return: True if the image of the datastore was written successfully, False otherwise.
+        """
+        written = self._write_all(datastore_id, block_device_path, progress)
+        if written and hasher is not None and self._hasher is not None:
+            hasher.copy_from(self._hasher)
+        return written
+
+    def _write_all(self, datastore_id: int, block_device_path: str, progress: ProgressReporter) -> bool:
+        with self._condition:
+            self._targets[datastore_id] = (block_device_path, progress)
+            self._condition.notify_all()
+            loggger.info(f"Image {self.image_name} for datastore {datastore_id} is ready for the write, {len(self._targets)} of {self._expected} images attached")
+            while self._results is None and (self._writing or len(self._targets) < self._expected):
+                self._condition.wait()
+            if self._results is not None:
+                return self._results.get(datastore_id, False)
+            self._writing = True
+            targets = dict(self._targets)
+        results: Dict[int, bool] = {}
+        try:
+            results = self._write(targets)
+        finally:
+            with self._condition:
+                self._results = results
+                self._writing = False
+                self._condition.notify_all()
+        return results.get(datastore_id, False)
+
+    def _write(self, targets: Dict[int, Tuple[str, ProgressReporter]]) -> Dict[int, bool]:
+        settings = self.settings
+        datastore_ids = list(targets)
+        output_paths = [targets[datastore_id][0] for datastore_id in datastore_ids]
+        progresses = [targets[datastore_id][1] for datastore_id in datastore_ids]
+        loggger.info(f"Writing image {self.image_name} to the images of datastores {', '.join(map(str, datastore_ids))}")
+        io_size = settings.write_io_size_kb * 1024
+        if settings.verify_write and self._hasher is None:
+            results = [False] * len(datastore_ids)
+        elif settings.stream_input:
+            results = write_stream_fanout(self.image_path, output_paths, settings.stream_size_mb * 1024**2, io_size=io_size, direct=settings.write_direct,
+                                          zero_mode=settings.write_zero_mode, queue_depth=settings.write_queue_depth, progresses=progresses, hasher=self._hasher,
+                                          pad_tolerance=settings.stream_pad_mb * 1024**2)
+        else:
+            extents = get_image_extents(self.image_path)
+            if extents is not None:
+                results = write_image_fanout(self.image_path, output_paths, extents, io_size=io_size, direct=settings.write_direct,
+                                             zero_mode=settings.write_zero_mode, queue_depth=settings.write_queue_depth, progresses=progresses, hasher=self._hasher)
+            elif self._hasher is not None:
+                loggger.critical(f"Image {self.image_path} can not be read directly, the write can not be verified")
+                results = [False] * len(datastore_ids)
+            else:
+                loggger.warning(f"Image {self.image_path} can not be read directly, converting it for every datastore")
+                results = [convert_image_format(self.image_path, output_path, "raw", progress=progress) for output_path, progress in zip(output_paths, progresses)]
+        for datastore_id, result in zip(datastore_ids, results):
+            if not result:
+                loggger.error(f"Failed to write image {self.image_name} for datastore {datastore_id}")
+        return dict(zip(datastore_ids, results))
+
+
+def get_upload_file_format(settings: DeploySettings) -> Optional[str]:
+    """
+    Format the export is converted to for the import, e.g. "raw" or "qcow2-zstd".
+    :return: Format or None if the qcow2 export is imported as it is.
+    """
+    if settings.upload_format == ImageFormat.QCOW2 and not settings.upload_compress:
+        return None
+    if settings.upload_compress:
+        return f"{settings.upload_format.value.lower()}-{settings.upload_compression_type}"
+    return settings.upload_format.value.lower()
+
+
+def convert_for_upload(settings: DeploySettings, image_name: str, image_path: str, image_size_mb: int, output_path: str) -> bool:
+    loggger.info(f"Converting {image_path} to {get_upload_file_format(settings)} for the import")
+    progress = ProgressReporter(f"Converting {image_name}", image_size_mb * 1024**2, settings.progress_interval)
+    return convert_image_format(image_path, output_path, settings.upload_format.value.lower(), progress=progress,
+                                compress=settings.upload_compress, compression_type=settings.upload_compression_type if settings.upload_compress else None)
+
+
+def prepare_upload(settings: DeploySettings, image_name: str, image_path: str, image_size_mb: int, digest: Optional[ContentDigest], leases: contextlib.ExitStack) -> Optional[Tuple[str, ImageFormat]]:
+    """
+    Prepare the export for the import by the datastore. The export is converted to UPLOAD_FORMAT
+    and compressed if requested, otherwise the qcow2 export is imported as it is.
+    A conversion is taken from the export cache if the same export was converted before, e.g. by a failed job
+    or for another datastore. The used cache entry is kept until the leases are closed.
+    :param digest: Content digest of the export, the key of the export cache.
+    :param leases: Exit stack of the deploy, closed after the import.
+    :return: PATH or URL attribute of the image and the format of the imported file, None if an error occurred.
+    """
+    if settings.upload_mode == UploadMode.URL and not settings.upload_url:
+        loggger.critical(f"UPLOAD_URL or UPLOAD_SERVE_PORT must be set in url upload mode")
+        return None
+    location = settings.upload_url if settings.upload_mode == UploadMode.URL else settings.upload_path
+    upload_file_format = get_upload_file_format(settings)
+    if upload_file_format is None:
+        return get_upload_source(settings.upload_mode, location, os.path.basename(image_path)), ImageFormat.QCOW2
+    if digest is not None:
+        # The datastore sees the cache as a subdirectory of DIR_EXPORT
+        cache_location = os.path.relpath(settings.export_cache_dir, settings.dir_export)
+        if cache_location.startswith(os.pardir):
+            loggger.critical(f"EXPORT_CACHE_DIR must be inside DIR_EXPORT in {settings.upload_mode.value} upload mode")
+            return None
+        cache = ExportCache(settings.export_cache_dir, settings.export_cache_size)
+        entry = cache.acquire(digest.value, upload_file_format, lambda path: convert_for_upload(settings, image_name, image_path, image_size_mb, path))
+        if entry is None:
+            return None
+        leases.enter_context(entry)
+        return get_upload_source(settings.upload_mode, location, os.path.join(cache_location, os.path.basename(entry.path))), settings.upload_format
+    upload_file_path = get_upload_file_path(settings, image_name)
+    temporary_path = f"{upload_file_path}.{os.getpid()}.tmp"
+    if not convert_for_upload(settings, image_name, image_path, image_size_mb, temporary_path):
+        remove_upload_file(temporary_path)
+        return None
+    os.replace(temporary_path, upload_file_path)
+    return get_upload_source(settings.upload_mode, location, os.path.basename(upload_file_path)), settings.upload_format
+
+
+def remove_upload_file(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        loggger.warning(f"Failed to remove {path}: {e}")
+
+
+def write_image(settings: DeploySettings, image_path: str, block_device_path: str, progress: ProgressReporter, image_id: int, journal: DeployJournal, previous_image_id: Optional[int] = None, fanout: Optional[FanoutWrite] = None, hasher: Optional[ChunkHasher] = None) -> bool:
+    """
+    Write the exported image to the attached block device using the configured write mode.
+    A sparse write records checkpoints in the journal and resumes from the last one.
+    A full write of a deploy to several datastores is done together with the other datastores by the fanout.
+    :param settings: Deploy settings.
+    :param image_path: Path to the exported qcow2 image.
+    :param block_device_path: Path to the attached block device.
+    :param progress: Progress reporter of the write.
+    :param image_id: ID of the written image.
+    :param journal: Deploy journal of the image.
+    :param previous_image_id: ID of the image the device was cloned from, only changed blocks are written if set.
+    :param fanout: Shared write of the deploys to several datastores.
+    :param hasher: Optional hasher the written content is added to for the verification.
+    :return: True if the image was written successfully, False otherwise.
+    """
+    if fanout is not None:
+        if previous_image_id is None and journal.get("write_offset", 0) == 0:
+            return fanout.write(settings.image_datastore_id, block_device_path, progress, hasher)
+        # Delta writes and resumed writes differ for every datastore
+        fanout.leave(settings.image_datastore_id)
+    if settings.stream_input:
+        return write_stream(
+            settings.stream_input,
+            block_device_path,
+            settings.stream_size_mb * 1024**2,
+            io_size=settings.write_io_size_kb * 1024,
+            direct=settings.write_direct,
+            zero_mode=settings.write_zero_mode,
+            queue_depth=settings.write_queue_depth,
+            progress=progress,
+            hasher=hasher,
+            pad_tolerance=settings.stream_pad_mb * 1024**2
+        )
+    if previous_image_id is not None:
+        extents = get_image_extents(image_path)
+        if extents is not None:
+            io_size = settings.write_io_size_kb * 1024
+            previous = ContentDigest.load(get_manifest_path(settings, previous_image_id)) if settings.delta_manifest_dir else None
+            manifest = write_image_delta(image_path, block_device_path, extents, io_size=io_size, direct=settings.write_direct, previous=previous, progress=progress, hasher=hasher)
+            if manifest is not None and settings.delta_manifest_dir:
+                os.makedirs(settings.delta_manifest_dir, exist_ok=True)
+                manifest.save(get_manifest_path(settings, image_id))
+            return manifest is not None
+        loggger.warning(f"Delta write not possible for {image_path}, writing the full image")
+    if settings.write_mode == "sparse":
+        extents = get_image_extents(image_path)
+        if extents is not None:
+            start_offset = journal.get("write_offset", 0)
+            if start_offset > 0:
+                loggger.info(f"Resuming the write of {image_path} at {start_offset // 1024**2} MB")
+                # The part written by the interrupted job is hashed from the source
+                if hasher is not None and not hash_image(image_path, extents, hasher, settings.write_io_size_kb * 1024, settings.verify_workers, end_offset=start_offset):
+                    return False
+            return write_image_sparse(
+                image_path,
+                block_device_path,
+                extents,
+                io_size=settings.write_io_size_kb * 1024,
+                direct=settings.write_direct,
+                zero_mode=settings.write_zero_mode,
+                queue_depth=settings.write_queue_depth,
+                progress=progress,
+                start_offset=start_offset,
+                checkpoint=lambda offset: journal.record("checkpoint", write_offset=offset),
+                checkpoint_interval=settings.journal_checkpoint_size,
+                hasher=hasher
+            )
+        loggger.warning(f"Sparse write not possible for {image_path}, falling back to qemu-img convert")
+    if hasher is None:
+        return convert_image_format(image_path, block_device_path, "raw", progress=progress)
+    extents = get_image_extents(image_path)
+    if extents is None:
+        loggger.critical(f"Image {image_path} can not be read directly, the write can not be verified")
+        return False
+    # qemu-img does not pass the data through the hasher, the source is hashed while it is converted
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hash") as executor:
+        hashed = executor.submit(hash_image, image_path, extents, hasher, settings.write_io_size_kb * 1024, settings.verify_workers)
+        converted = convert_image_format(image_path, block_device_path, "raw", progress=progress)
+        if not hashed.result():
+            loggger.critical(f"Failed to hash image {image_path}, the write can not be verified")
+            return False
+        return converted
+
+
+def create_hasher(settings: DeploySettings, image_path: str) -> Optional[ChunkHasher]:
+    """
+    Create the hasher of the disk written from the export or the stream.
+    :return: Hasher expecting the virtual size of the disk, None if the size of the export can not be read.
+    """
+    size = settings.stream_size_mb * 1024**2 if settings.stream_input else get_qemu_image_virtual_size(image_path)
+    if size == -1:
+        loggger.critical(f"Failed to get the size of {image_path}, the write can not be verified")
+        return None
+    return ChunkHasher(size, settings.verify_chunk_size)
+
+
+def verify_write(settings: DeploySettings, block_device_path: str, hasher: ChunkHasher) -> Tuple[bool, Optional[ContentDigest]]:
+    """
+    Read the written block device back and compare it with the digests of the written content.
+    :return: False if the device content differs or can not be verified, and the digests, None if they are incomplete.
+    """
+    digest = hasher.digest()
+    if digest is None:
+        loggger.critical(f"Digests of the written content are incomplete, {block_device_path} can not be verified")
+        return False, None
+    mismatch = verify_digest(block_device_path, digest, settings.verify_workers, settings.write_io_size_kb * 1024)
+    if mismatch is None:
+        return False, digest
+    if mismatch != -1:
+        loggger.critical(f"Content of {block_device_path} differs from the image at offset {mismatch} ({mismatch // 1024**2} MB)")
+        return False, digest
+    return True, digest
+
+
+def create_builder_pool(one: One, settings: DeploySettings) -> BuilderPool:
+    """
+    Create the pool of builder VMs the images are attached to.
+    Hot-plug operations on one VM are serialized between jobs by the per-VM lock.
+    """
+    builders = []
+    for vm_id, dir_dev in settings.builder_vms:
+        vm_lock = LeaseLock(settings.lock_dir, f"vm-{vm_id}", owner=f"{settings.ci_job_id}:hotplug", lease_time=settings.lock_lease_time)
+        hotplug = HotplugCoordinator(one, vm_id, vm_lock, lock_timeout=settings.lock_timeout)
+        last_io_path = os.path.join(settings.lock_dir, f"vm-{vm_id}", "last_io")
+        builders.append(BuilderVM(vm_id, dir_dev, hotplug, last_io_path))
+    return BuilderPool(one, builders)
+
+
+def deploy_image(one: One, settings: DeploySettings, image_name: str, builders: BuilderPool, fanout: Optional[FanoutWrite] = None) -> bool:
+    """
+    Deploy one exported qcow2 image to OpenNebula.
+    Runs create -> attach -> write -> detach -> template for the image, or create -> import -> template
+    if the datastore imports the export (UPLOAD_MODE path or url).
+    The duration of every stage is written as JSON to TIMINGS_DIR, also if the deploy fails.
+    :param one: One instance for OpenNebula connection, can be shared between threads.
+    :param settings: Deploy settings.
+    :param image_name: Name of the image (DISTRO_NAME + DISTRO_VER + DISTRO_EDITION).
+    :param builders: Pool of builder VMs, shared between threads.
+    :param fanout: Shared write if the image is deployed to several datastores at once.
+    :return: True if the image and its VM template were created, False otherwise.
+    """
+    deploy_name = get_deploy_name(settings, image_name)
+    timer = StageTimer(deploy_name)
+    timer.attributes["datastore_id"] = settings.image_datastore_id
+    result = False
+    try:
+        with telemetry.span("deploy", image=image_name, datastore_id=settings.image_datastore_id) as span, contextlib.ExitStack() as leases:
+            result = _deploy_image(one, settings, image_name, builders, timer, leases, fanout)
+            if span is not None:
+                span.set_attribute("success", result)
+        return result
+    finally:
+        timer.attributes["success"] = result
+        timer.write_json(get_timings_path(settings.timings_dir, deploy_name))
+
+
+def deploy_image_to_datastores(one: One, settings: DeploySettings, image_name: str, builders: BuilderPool) -> bool:
+    """
+    Deploy one exported image to every datastore of IMAGE_DATASTORE_ID concurrently.
+    Every datastore gets its own image and VM template and its deploy fails independently of the others.
+    The export is read once and written to the attached images of all datastores at the same time.
+    :return: True if the image was deployed to all datastores, False otherwise.
+    """
+    datastore_ids = settings.image_datastore_ids
+    if len(datastore_ids) == 1:
+        return deploy_image(one, settings, image_name, builders)
+    image_path = settings.stream_input or os.path.join(settings.dir_export, image_name + ".qcow2")
+    fanout = FanoutWrite(settings, image_name, image_path, len(datastore_ids))
+
+    def deploy(datastore_id: int) -> bool:
+        datastore_settings = copy.copy(settings)
+        datastore_settings.image_datastore_id = datastore_id
+        try:
+            return deploy_image(one, datastore_settings, image_name, builders, fanout)
+        except Exception as e:
+            loggger.critical(f"Exception caught while deploying image {image_name} to datastore {datastore_id}: {e}")
+            return False
+        finally:
+            fanout.leave(datastore_id)
+
+    loggger.info(f"Deploying image {image_name} to datastores {', '.join(map(str, datastore_ids))}")
+    with ThreadPoolExecutor(max_workers=len(datastore_ids), thread_name_prefix="datastore") as executor:
+        results = dict(zip(datastore_ids, executor.map(deploy, datastore_ids)))
+    failed = [str(datastore_id) for datastore_id, result in results.items() if not result]
+    if failed:
+        loggger.critical(f"Failed to deploy image {image_name} to datastores {', '.join(failed)}")
+    return not failed
+
+
+def _deploy_image(one: One, settings: DeploySettings, image_name: str, builders: BuilderPool, timer: StageTimer, leases: contextlib.ExitStack, fanout: Optional[FanoutWrite] = None) -> bool:
+    loggger.info(f"Image to deploy: {image_name}, datastore: {settings.image_datastore_id}")
+    image_long_name = get_image_long_name(settings, image_name)
+    loggger.info(f"Full image name: {image_long_name}")
+    if settings.stream_input:
+        # The stream is written while it is produced, its content is not known before the write
+        image_path = settings.stream_input
+        loggger.info(f"Image stream: {image_path}")
+        image_size_mb = settings.stream_size_mb
+        if image_size_mb <= 0:
+            loggger.critical(f"STREAM_SIZE_MB must be set in streaming mode")
+            return False
+        timer.attributes["streamed"] = True
+    else:
+        # get QEMU image size
+        image_path = os.path.join(settings.dir_export, image_name + ".qcow2")
+        loggger.info(f"Image path: {image_path}")
+        image_size_mb = get_qemu_image_size_mb(image_path)
+        if (image_size_mb == -1):
+            return False
+    loggger.info(f"Image size: {image_size_mb} MB")
+    timer.attributes["image_size_mb"] = image_size_mb
+    journal = DeployJournal(get_journal_path(settings.journal_dir, settings.ci_pipeline_id, get_deploy_name(settings, image_name)) if settings.journal_dir else None)
+    source = get_source_fingerprint(settings, image_path)
+    if journal.has("template") and journal.get("source") == source:
+        # The job died after creating the template, before it removed the journal
+        template_id = journal.get("template_id")
+        if template_id is not None and one.get_vm_template(template_id) is not None:
+            loggger.info(f"Image {image_name} was deployed by an earlier run of the job")
+            journal.reset()
+            return True
+        loggger.warning(f"VM template {template_id} of the earlier run of the job does not exist anymore, deploying image {image_name} again")
+        journal.reset()
+    image_id = resume_deploy(one, journal, builders, source)
+    if image_id == -1:
+        return False
+    content_digest = journal.get("content_digest")
+    previous_image_id = journal.get("delta_source_image_id")
+    if image_id is not None:
+        loggger.info(f"Resuming the interrupted deploy of image {image_id}")
+        timer.attributes["resumed_stage"] = journal.stages[-1]
+    else:
+        image_id = create_image(one, settings, image_name, image_long_name, image_path, image_size_mb, journal, timer, leases)
+        if image_id is None:
+            journal.reset()
+            return True
+        if image_id == -1:
+            return False
+        content_digest = journal.get("content_digest")
+        previous_image_id = journal.get("delta_source_image_id")
+        loggger.info(f"Image created with ID: {image_id}")
+    timer.attributes["image_id"] = image_id
+    if previous_image_id is not None:
+        timer.attributes["delta_source_image_id"] = previous_image_id
+    if settings.upload_mode != UploadMode.HOTPLUG:
+        # The datastore imports the export, nothing is attached to a builder VM
+        loggger.info(f"Waiting for the datastore to import image {image_id}")
+        with timer.stage("import"):
+            imported = one.wait_for_image_state(image_id, ImageState.READY, timeout=settings.upload_timeout, fail_states=(ImageState.ERROR,))
+        remove_upload_file(get_upload_file_path(settings, image_name))
+        # The export cache entry can be evicted once the datastore has its copy
+        leases.close()
+        if not imported:
+            loggger.critical(f"Image {image_id} was not imported by the datastore")
+            loggger.info(f"Deleting image...")
+            one.delete_image(image_id)
+            journal.reset()
+            return False
+        if not journal.has("write"):
+            journal.record("write", bytes_written=0)
+    else:
+        # Wait for the image to be ready
+        loggger.info(f"Waiting for image {image_id} to be ready")
+        with timer.stage("ready-wait"):
+            one.wait_for_image_state(image_id, ImageState.READY, timeout=3600 if previous_image_id is not None else 60)
+    if previous_image_id is not None:
+        # Clones are not persistent, writes to an attached non persistent image would be discarded
+        one.set_image_persiency(image_id, persistent=True)
+        one.update_image(image_id, CI_PIPELINE_ID=settings.ci_pipeline_id, CI_JOB_ID=settings.ci_job_id, CI_COMMIT_SHA=settings.ci_commit_sha, CONTENT_DIGEST="", WRITE_MANIFEST="")
+    if journal.has("write"):
+        loggger.info(f"Image {image_id} was written by an earlier run of the job")
+    else:
+        # Place the image on the least loaded builder VM
+        with timer.stage("builder-wait"):
+            builder = builders.reserve(image_id, settings.lock_timeout)
+        if builder is None:
+            return False
+        timer.attributes["vm_id"] = builder.vm_id
+        try:
+            written = write_on_builder(settings, builder, image_name, image_path, image_id, image_size_mb, timer, journal, previous_image_id, fanout)
+        finally:
+            builders.release(builder, image_id)
+        if written is None:
+            return False
+        if not written:
+            one.wait_for_image_state(image_id, ImageState.READY)
+            loggger.info(f"Deleting image...")
+            one.delete_image(image_id)
+            journal.reset()
+            return False
+    if content_digest:
+        # Set only after the write, so the image can not be found by the lookup of other deploys while it is empty
+        one.update_image(image_id, CONTENT_DIGEST=content_digest)
+    if journal.get("write_manifest"):
+        # Chunk digests of the verified disk content, for checking the image later
+        one.update_image(image_id, WRITE_MANIFEST=journal.get("write_manifest"))
+    with timer.stage("template"):
+        vm_template_id = create_template(one, settings, image_long_name, image_id)
+    if (vm_template_id == -1):
+        return False
+    journal.record("template", template_id=vm_template_id)
+    loggger.info(f"VM template created with ID: {vm_template_id}")
+    # The deploy is complete, journals of finished deploys are not kept
+    journal.reset()
+    return True
+
+
+def create_image(one: One, settings: DeploySettings, image_name: str, image_long_name: str, image_path: str, image_size_mb: int, journal: DeployJournal, timer: StageTimer, leases: contextlib.ExitStack) -> Optional[int]:
+    """
+    Create the image the export is written to, either an empty image or a clone of the previous image of the
+    same edition in delta mode, or the image imported from the export in upload mode.
+    An image with the same content is used instead in dedup mode.
+    The created image is recorded in the journal, the export cache entry of an upload is added to the leases.
+    :return: Image ID, -1 if an error occurred, None if the image was deployed from an image with the same content.
+    """
+    digest = None
+    if settings.stream_input and (settings.dedup_mode != DedupMode.OFF or settings.delta_mode):
+        loggger.warning(f"DEDUP_MODE and DELTA_MODE are not used in streaming mode, writing the full image")
+    elif settings.dedup_mode != DedupMode.OFF:
+        with timer.stage("digest"):
+            digest = compute_digest(image_path, settings.digest_chunk_size, settings.digest_workers)
+        if digest is not None:
+            timer.attributes["content_digest"] = digest.value
+            deduplicated = deploy_deduplicated(one, settings, image_long_name, digest, journal, timer)
+            if deduplicated:
+                return None
+            if deduplicated is not None:
+                return -1
+    # Key of the image edition, the same for the images of all pipelines
+    image_key = f"{settings.image_name_prefix}{image_name} {settings.architecture} {settings.language}"
+    previous_image_id = None
+    if settings.delta_mode and settings.upload_mode != UploadMode.HOTPLUG:
+        loggger.warning(f"DELTA_MODE is not used in {settings.upload_mode.value} upload mode, importing the full image")
+    elif settings.delta_mode and not settings.stream_input:
+        with timer.stage("delta-lookup"):
+            previous_image_id = find_previous_image(one, image_key, image_size_mb, settings.image_datastore_id)
+    if previous_image_id is not None:
+        # Clone the previous image, only the changed blocks are written to the clone
+        loggger.info(f"Cloning previous image {previous_image_id} of {image_key}")
+        with timer.stage("clone"):
+            image_id = one.clone_image(previous_image_id, image_long_name, settings.image_datastore_id)
+    elif settings.upload_mode != UploadMode.HOTPLUG:
+        if digest is None and settings.export_cache_dir and get_upload_file_format(settings) is not None:
+            with timer.stage("digest"):
+                digest = compute_digest(image_path, settings.digest_chunk_size, settings.digest_workers)
+        with timer.stage("convert"):
+            upload = prepare_upload(settings, image_name, image_path, image_size_mb, digest, leases)
+        if upload is None:
+            return -1
+        upload_source, upload_format = upload
+        # Create the image from the export, the datastore copies or downloads it
+        loggger.info(f"Creating image in OpenNebula from {upload_source}")
+        with timer.stage("create"):
+            image_id = one.create_image(
+                datastore=settings.image_datastore_id,
+                image_name=image_long_name,
+                image_path=upload_source,
+                image_type=ImageType.OS,
+                image_dev_prefix=ImageDevPrefix.SD,
+                image_format=upload_format,
+                persistent_image=False,
+                CI_PIPELINE_ID=settings.ci_pipeline_id,
+                CI_JOB_ID=settings.ci_job_id,
+                CI_COMMIT_SHA=settings.ci_commit_sha,
+                IMAGE_KEY=image_key
+            )
+        if image_id == -1:
+            remove_upload_file(get_upload_file_path(settings, image_name))
+    else:
+        # Create image
+        loggger.info(f"Creating Empty image in OpenNebula")
+        with timer.stage("create"):
+            image_id = one.create_image(
+                datastore=settings.image_datastore_id,
+                image_name=image_long_name,
+                image_type=ImageType.OS,
+                image_dev_prefix=ImageDevPrefix.SD,
+                image_format=ImageFormat.RAW,
+                image_size_mb=image_size_mb,
+                persistent_image=True,
+                CI_PIPELINE_ID=settings.ci_pipeline_id,
+                CI_JOB_ID=settings.ci_job_id,
+                CI_COMMIT_SHA=settings.ci_commit_sha,
+                IMAGE_KEY=image_key
+            )
+    if (image_id == -1):
+        return -1
+    journal.record("create", image_id=image_id, delta_source_image_id=previous_image_id, content_digest=digest.value if digest is not None else None)
+    return image_id
+
+
+def get_source_fingerprint(settings: DeploySettings, image_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Identify the exported image, a journal of another export is not resumed.
+    :return: Size and modification time of the image, None for a stream.
+    """
+    if settings.stream_input:
+        return None
+    image_stat = os.stat(image_path)
+    return {"size": image_stat.st_size, "mtime_ns": image_stat.st_mtime_ns}
+
+
+def resume_deploy(one: One, journal: DeployJournal, builders: BuilderPool, source: Optional[Dict[str, Any]]) -> Optional[int]:
+    """
+    Clean up after the interrupted deploy recorded in the journal, so it can be continued.
+    The image left attached to a builder VM is detached. The deploy starts from scratch if the export changed,
+    the unfinished image is deleted then, or if the image of the interrupted deploy does not exist any more.
+    :param one: One instance for OpenNebula connection.
+    :param journal: Deploy journal of the image.
+    :param builders: Pool of builder VMs.
+    :param source: Fingerprint of the exported image from get_source_fingerprint.
+    :return: ID of the image of the interrupted deploy, None to start from scratch, -1 if the cleanup failed.
+    """
+    image_id = journal.get("image_id")
+    vm_id = journal.get("attached_vm_id")
+    if image_id is not None and vm_id is not None:
+        loggger.warning(f"Detaching image {image_id} left attached to VM {vm_id} by the interrupted deploy")
+        builder = builders.get(vm_id)
+        detached = builder.hotplug.detach(image_id) if builder is not None else detach_image_by_id(one, vm_id, image_id)
+        if not detached:
+            loggger.critical(f"Failed to detach image {image_id} from VM {vm_id}")
+            return -1
+        journal.record("detach", attached_vm_id=None)
+    if journal.stages and journal.get("source") != source:
+        loggger.warning(f"The export changed since the journal {journal.path} was written, starting from scratch")
+        if image_id is not None and not journal.has("template"):
+            loggger.info(f"Deleting image {image_id} of the interrupted deploy")
+            one.wait_for_image_state(image_id, ImageState.READY)
+            one.delete_image(image_id)
+        journal.reset()
+    elif image_id is not None and not journal.has("template") and one.get_image(image_id) is None:
+        loggger.warning(f"Image {image_id} of the interrupted deploy does not exist, starting from scratch")
+        journal.reset()
+    if not journal.stages:
+        journal.record("start", source=source)
+        return None
+    return image_id
+
+
+def find_previous_image(one: One, image_key: str, image_size_mb: int, datastore_id: int) -> Optional[int]:
+    """
+    Find the newest deployed image of the same edition which can be updated by a delta write.
+    :param one: One instance for OpenNebula connection.
+    :param image_key: IMAGE_KEY attribute of the edition.
+    :param image_size_mb: Size of the new image, images of another size are not used.
+    :param datastore_id: Datastore of the new image, its images are preferred, a clone to another datastore is a full copy.
+    :return: Image ID or None if there is no usable previous image.
+    """
+    all_resources_filter = -2
+    images = one.find_images_by_attributes(all_resources_filter, {"IMAGE_KEY": image_key})
+    candidates = [image for image in images or []
+                  if ImageState(image.STATE) in (ImageState.READY, ImageState.USED) and int(image.SIZE) == image_size_mb and not image.PERSISTENT]
+    if not candidates:
+        loggger.info(f"No previous image of {image_key} with size {image_size_mb} MB, writing the full image")
+        return None
+    previous = max(candidates, key=lambda image: (image.DATASTORE_ID == datastore_id, image.ID))
+    loggger.info(f"Previous image of {image_key}: {previous.ID} ({previous.NAME})")
+    return previous.ID
+
+
+def deploy_deduplicated(one: One, settings: DeploySettings, image_long_name: str, digest: ContentDigest, journal: DeployJournal, timer: StageTimer) -> Optional[bool]:
+    """
+    Deploy the image from a clone of an existing image with the same content digest instead of writing it.
+    The clone is owned by the new template only, deleting the template with its images does not affect the source.
+    The clone is recorded in the journal, it is deleted if the deploy fails.
+    :return: True if the template was created from a clone, False if that failed,
+             None if there is no image with the same content.
+    """
+    all_resources_filter = -2
+    with timer.stage("dedup-lookup"):
+        images = one.find_images_by_attributes(all_resources_filter, {"CONTENT_DIGEST": digest.value})
+    candidates = [image for image in images or [] if ImageState(image.STATE) in (ImageState.READY, ImageState.USED)]
+    if not candidates:
+        loggger.info(f"No existing image with content digest {digest.value}")
+        return None
+    # Prefer images in the target datastore, then the newest one
+    source = max(candidates, key=lambda image: (image.DATASTORE_ID == settings.image_datastore_id, image.ID))
+    loggger.info(f"Image {source.ID} ({source.NAME}) has the same content digest, cloning it instead of writing")
+    timer.attributes["dedup_source_image_id"] = source.ID
+    with timer.stage("clone"):
+        image_id = one.clone_image(source.ID, image_long_name, settings.image_datastore_id)
+        if image_id == -1:
+            return False
+        loggger.info(f"Image cloned with ID: {image_id}")
+        # The clone holds the content once it is ready, a resumed deploy only waits for it and creates the template
+        journal.record("create", image_id=image_id, content_digest=digest.value)
+        journal.record("write", bytes_written=0)
+        if not one.wait_for_image_state(image_id, ImageState.READY, timeout=3600, fail_states=(ImageState.ERROR,)):
+            loggger.critical(f"Cloned image {image_id} did not become ready")
+            loggger.info(f"Deleting image...")
+            one.delete_image(image_id)
+            journal.reset()
+            return False
+        one.update_image(image_id, CI_PIPELINE_ID=settings.ci_pipeline_id, CI_JOB_ID=settings.ci_job_id, CI_COMMIT_SHA=settings.ci_commit_sha, CONTENT_DIGEST=digest.value)
+    timer.attributes["image_id"] = image_id
+    with timer.stage("template"):
+        vm_template_id = create_template(one, settings, image_long_name, image_id)
+    if (vm_template_id == -1):
+        loggger.info(f"Deleting image...")
+        one.delete_image(image_id)
+        journal.reset()
+        return False
+    journal.record("template", template_id=vm_template_id)
+    loggger.info(f"VM template created with ID: {vm_template_id}")
+    return True
+
+
+def write_on_builder(settings: DeploySettings, builder: BuilderVM, image_name: str, image_path: str, image_id: int, image_size_mb: int, timer: StageTimer, journal: DeployJournal, previous_image_id: Optional[int] = None, fanout: Optional[FanoutWrite] = None) -> Optional[bool]:
+    """
+    Attach the image to the builder VM, write the exported image to it and detach it.
+    If previous_image_id is set, the image is a clone of it and only the changed blocks are written.
+    The attach is recorded in the journal before it is done, so a restarted deploy can detach the image.
+    :return: True if the image was written, False if the write failed, None if the attach or detach failed.
+    """
+    vm_id = builder.vm_id
+    # Attach the image to the VM
+    loggger.info(f"Attaching image {image_id} to VM {vm_id}")
+    journal.record("attach", attached_vm_id=vm_id)
+    # Attaches of concurrently deployed images are done together in one lock window
+    image_target = builder.hotplug.attach(image_id, timer)
+    if image_target is None:
+        loggger.critical(f"Failed to attach image {image_id} to VM {vm_id}")
+        return None
+    loggger.info(f"Image target: {image_target}")
+    journal.record("attached", target=image_target)
+    # get the attached block device
+    disk_location = calculate_disk_location(image_target)
+    loggger.info(f"Disk location: {disk_location}")
+    block_device_path = os.path.join(builder.dir_dev, f"disk/by-id/scsi-0QEMU_QEMU_HARDDISK_drive-scsi0-0-{disk_location}-0")
+    loggger.info(f"Block device path: {block_device_path}")
+    # udev creates the link only after the VM is running again, a link of the same target can be left from a previous disk
+    with timer.stage("device-wait"):
+        device_ready = wait_for_device(block_device_path, image_size_mb * 1024**2, settings.device_timeout)
+    manifest = None
+    if not device_ready:
+        written = False
+        if fanout is not None:
+            fanout.leave(settings.image_datastore_id)
+    else:
+        # Write the image to the block device
+        loggger.info(f"Writing image {image_name} to block device...")
+        progress = ProgressReporter(f"Writing {get_deploy_name(settings, image_name)}", image_size_mb * 1024**2, settings.progress_interval)
+        hasher = create_hasher(settings, image_path) if settings.verify_write else None
+        with timer.stage("write"):
+            if settings.verify_write and hasher is None:
+                written = False
+                if fanout is not None:
+                    fanout.leave(settings.image_datastore_id)
+            else:
+                written = write_image(settings, image_path, block_device_path, progress, image_id, journal, previous_image_id, fanout, hasher)
+        builder.touch_io()
+        timer.attributes["bytes_written"] = progress.bytes_done
+        if written and hasher is not None:
+            loggger.info(f"Verifying image {image_name} on the block device...")
+            with timer.stage("verify"):
+                written, manifest = verify_write(settings, block_device_path, hasher)
+            timer.attributes["verified"] = written
+    if written:
+        loggger.info(f"Image {image_name} written to block device")
+        journal.record("write", bytes_written=progress.bytes_done, write_manifest=manifest.serialize() if manifest is not None else None)
+    else:
+        loggger.critical(f"Failed to write image {image_name}")
+    # Detach the image from the VM
+    loggger.info(f"Detaching image from the VM...")
+    if not builder.hotplug.detach(image_id, timer):
+        loggger.critical(f"Failed to detach image {image_id} from VM {vm_id}")
+        return None
+    journal.record("detach", attached_vm_id=None)
+    return written
+
+
+def create_template(one: One, settings: DeploySettings, image_long_name: str, image_id: int) -> int:
+    """
+    Make the written image not persistent and create the VM template using it.
+    :param one: One instance for OpenNebula connection.
+    :param settings: Deploy settings.
+    :param image_long_name: Name of the template.
+    :param image_id: ID of the image used by the template.
+    :return: Template ID if successful, -1 if an error occurred.
+    """
+    # Make image not persistent
+    loggger.info(f"Making image not persistent...")
+    one.set_image_persiency(image_id, persistent=False)
+    # Read the template for the VM
+    loggger.info(f"Reading VM template from {settings.vm_template_path}")
+    with open(settings.vm_template_path, "r") as f:
+        template = f.read()
+    # Substitute placeholders with actual values
+    template = template.replace("${TEMPLATE_NAME}", image_long_name)
+    template = template.replace("${IMAGE_ID}", str(image_id))
+    template += f'\nCI_PIPELINE_ID = "{settings.ci_pipeline_id}"\nCI_JOB_ID = "{settings.ci_job_id}"\nCI_COMMIT_SHA = "{settings.ci_commit_sha}"\n'
+    # Create the VM template
+    loggger.info(f"Creating VM template...")
+    return one.create_vm_template(template)
+
+
+def deploy_images(one: One, settings: DeploySettings, image_names: List[str]) -> Dict[str, bool]:
+    """
+    Deploy several images concurrently using a bounded pool of workers sharing one OpenNebula session.
+    :param one: One instance for OpenNebula connection.
+    :param settings: Deploy settings, DEPLOY_WORKERS limits the number of concurrently deployed images.
+    :param image_names: Names of the images to deploy.
+    :return: Dictionary mapping image name to the deploy result.
+    """
+    workers = max(1, min(settings.deploy_workers, len(image_names)))
+    loggger.info(f"Deploying {len(image_names)} images using {workers} workers")
+    builders = create_builder_pool(one, settings)
+
+    def deploy(image_name: str) -> bool:
+        try:
+            return deploy_image_to_datastores(one, settings, image_name, builders)
+        except Exception as e:
+            loggger.critical(f"Exception caught while deploying image {image_name}: {e}")
+            return False
+
+    export_server = None
+    if settings.upload_mode == UploadMode.URL and settings.upload_serve_port:
+        export_server = ExportServer(settings.dir_export, host=settings.upload_serve_host, port=settings.upload_serve_port,
+                                     served=lambda path: is_upload_file(settings, path))
+        export_server.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deploy") as executor:
+            results = executor.map(deploy, image_names)
+            return dict(zip(image_names, results))
+    finally:
+        if export_server is not None:
+            export_server.stop()
+
+
 if __name__ == "__main__":
     try:
         # Setup logging
@@ -34,161 +1102,43 @@ if __name__ == "__main__":
         loggger = logging.getLogger("main")
         loggger.setLevel(log_level)
         # Create formatter
-        log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
+        log_formatter = logging.Formatter('[%(asctime)s] %(levelname)-8s %(threadName)s %(module)s %(funcName)s -> %(message)s', "%d-%m-%Y %H:%M:%S")
         # Create stream handler (console)
         log_stream_handler = logging.StreamHandler()
         log_stream_handler.setFormatter(log_formatter)
         # Add stream handler to logger
-        loggger.addHandler(log_stream_handler)    
-        # Set up environment variables and determine image name
-        ONE_XMLRPC = os.environ.get("ONE_XMLRPC", "http://localhost:2633/RPC2")
-        loggger.debug(f"ONE_XMLRPC: {ONE_XMLRPC}")
-        ONE_AUTH = os.environ.get("ONE_AUTH", "~/.one/one_auth")
-        loggger.debug(f"ONE_AUTH: {ONE_AUTH}")
-        IMAGE_DATASTORE_ID: int = int(os.environ.get("IMAGE_DATASTORE_ID", "-1"))
-        loggger.debug(f"IMAGE_DATASTORE_ID: {IMAGE_DATASTORE_ID}")
-        VM_ID: int = int(os.environ.get("VM_ID", "-1"))
-        loggger.debug(f"VM_ID: {VM_ID}")
-        CI_PIPELINE_ID = os.environ.get("CI_PIPELINE_ID", "")
-        loggger.debug(f"CI_PIPELINE_ID: {CI_PIPELINE_ID}")
-        CI_JOB_ID = os.environ.get("CI_JOB_ID", "")
-        loggger.debug(f"CI_JOB_ID: {CI_JOB_ID}")
-        CI_COMMIT_SHA = os.environ.get("CI_COMMIT_SHA", "")
-        loggger.debug(f"CI_COMMIT_SHA: {CI_COMMIT_SHA}")
-        DISTRO_NAME = os.environ.get("DISTRO_NAME", "")
-        loggger.debug(f"DISTRO_NAME: {DISTRO_NAME}")
-        DISTRO_VER = os.environ.get("DISTRO_VER", "")
-        loggger.debug(f"DISTRO_VER: {DISTRO_VER}")
-        DISTRO_EDITION = os.environ.get("DISTRO_EDITION", "")
-        loggger.debug(f"DISTRO_EDITION: {DISTRO_EDITION}")
-        IMAGE_NAME_PREFIX = os.environ.get("IMAGE_NAME_PREFIX", "")
-        loggger.debug(f"IMAGE_NAME_PREFIX: {IMAGE_NAME_PREFIX}")
-        IMAGE_NAME_SUFFIX = os.environ.get("IMAGE_NAME_SUFFIX", "")
-        loggger.debug(f"IMAGE_NAME_SUFFIX: {IMAGE_NAME_SUFFIX}")
-        ARCHITECTURE = os.environ.get("ARCHITECTURE", "x64")
-        loggger.debug(f"ARCHITECTURE: {ARCHITECTURE}")
-        LANGUAGE = os.environ.get("LANGUAGE", "en-US")
-        loggger.debug(f"LANGUAGE: {LANGUAGE}")
-        VM_TEMPLATE_PATH = os.environ.get("VM_TEMPLATE_PATH", "template.tmpl")
-        loggger.debug(f"VM_TEMPLATE_PATH: {VM_TEMPLATE_PATH}")
-        DIR_EXPORT = os.environ.get("DIR_EXPORT", ".")
-        loggger.debug(f"DIR_EXPORT: {DIR_EXPORT}")
-        DIR_DEV = os.environ.get("DIR_DEV", "/dev")
-        loggger.debug(f"DIR_DEV: {DIR_DEV}")
-        LOCK_FILE_PATH = os.environ.get("LOCK_FILE_PATH", "/tmp/one.lock")
-        loggger.debug(f"LOCK_FILE_PATH: {LOCK_FILE_PATH}")
-        # Initialize image names
-        image_names = ImageNames(IMAGE_NAME_PREFIX, ARCHITECTURE, LANGUAGE, IMAGE_NAME_SUFFIX)
-        image_name = DISTRO_NAME + DISTRO_VER + DISTRO_EDITION
-        loggger.info(f"Image to deploy: {image_name}")
-        image_long_name = image_names.get_image_name(image_name)
-        loggger.info(f"Full image name: {image_long_name}")
-        # Read credentials from ONE_AUTH file
-        try:
-            loggger.info(f"Reading Opennebula credentials from {ONE_AUTH}")
-            with open(os.path.expanduser(ONE_AUTH), "r") as f:
-                credentials = f.read().strip()
-                if ":" not in credentials:
-                    loggger.critical(f"Error: Invalid credentials format in {ONE_AUTH}. Expected 'username:password'")
-                    exit(1)
-                username, password = credentials.split(":", 1)
-                session = f"{username}:{password}"
-        except FileNotFoundError:
-            loggger.critical(f"ONE_AUTH file not found at {ONE_AUTH}")
+        loggger.addHandler(log_stream_handler)
+        # Set up environment variables
+        settings = DeploySettings()
+        images_to_deploy = get_images_to_deploy(settings)
+        if len(images_to_deploy) == 0:
+            loggger.critical(f"No images to deploy")
             exit(1)
-        # get QEMU image size
-        image_path = os.path.join(DIR_EXPORT, image_name + ".qcow2")
-        loggger.info(f"Image path: {image_path}")
-        image_size_mb = get_qemu_image_size_mb(image_path)
-        if (image_size_mb == -1):
-            exit(1)
-        loggger.info(f"Image size: {image_size_mb} MB")
-        # Inicialize OpenNebula connection
-        one = One(url=ONE_XMLRPC, username=username, password=password)
-        # Create image
-        loggger.info(f"Creating Empty image in OpenNebula")
-        image_id = one.create_image(
-            datastore=IMAGE_DATASTORE_ID,
-            image_name=image_long_name,
-            image_type=ImageType.OS,
-            image_dev_prefix=ImageDevPrefix.SD,
-            image_format=ImageFormat.RAW,
-            image_size_mb=image_size_mb,
-            persistent_image=True,
-            CI_PIPELINE_ID=CI_PIPELINE_ID,
-            CI_JOB_ID=CI_JOB_ID,
-            CI_COMMIT_SHA=CI_COMMIT_SHA
-        )
-        if (image_id == -1):
-            exit(1)
-        loggger.info(f"Image created with ID: {image_id}")
-        # Wait for the image to be ready
-        loggger.info(f"Waiting for image {image_id} to be ready")
-        one.wait_for_image_state(image_id, ImageState.READY)
-        # Attach the image to the VM
-        loggger.info(f"Attaching image {image_id} to VM {VM_ID}")
-        if acquire_lock(LOCK_FILE_PATH, CI_JOB_ID) is False:
-            loggger.critical(f"Failed to acquire lock: {LOCK_FILE_PATH}")
-            exit(1)
-        one.attach_vm_image(vm_id=VM_ID, image_id=image_id, dev_prefix=ImageDevPrefix.SD)
-        # Wait for the VM to be in the RUNNING state
-        one.wait_for_vm_state(VM_ID, VMLCMState.RUNNING)
-        unlock(LOCK_FILE_PATH, CI_JOB_ID)
-        # get the TAGRET of the image
-        loggger.info(f"Getting attached image target")
-        image_target = one.get_vm_image_target(VM_ID, image_id)
-        if image_target is None:
-            exit(1)
-        loggger.info(f"Image target: {image_target}")
-        # get the attached block device
-        disk_location = calculate_disk_location(image_target)
-        loggger.info(f"Disk location: {disk_location}")
-        block_device_path = os.path.join(DIR_DEV, f"disk/by-id/scsi-0QEMU_QEMU_HARDDISK_drive-scsi0-0-{disk_location}-0")
-        loggger.info(f"Block device path: {block_device_path}")
-        # Write the image to the block device
-        loggger.info(f"Writing image to block device...")
-        if convert_image_format(image_path, block_device_path, "raw") is False:
-            loggger.critical(f"Failed to write image")
-            loggger.info(f"Detaching image from the VM...")
-            if acquire_lock(LOCK_FILE_PATH, CI_JOB_ID) is False:
-                loggger.critical(f"Failed to acquire lock: {LOCK_FILE_PATH}")
-                exit(1)
-            detach_image_by_id(one, VM_ID, image_id)
-            one.wait_for_vm_state(VM_ID, VMLCMState.RUNNING)
-            unlock(LOCK_FILE_PATH, CI_JOB_ID)
-            one.wait_for_image_state(image_id, ImageState.READY)
-            loggger.info(f"Deleting image...")
-            one.delete_image(image_id)
-            exit(1)
-        loggger.info(f"Image written to block device")
-        # Detach the image from the VM
-        loggger.info(f"Detaching image from the VM...")
-        if acquire_lock(LOCK_FILE_PATH, CI_JOB_ID) is False:
-            loggger.critical(f"Failed to acquire lock: {LOCK_FILE_PATH}")
+        # Read credentials from ONE_AUTH file
+        credentials = read_one_credentials(settings.one_auth)
+        if credentials is None:
             exit(1)
-        detach_image_by_id(one, VM_ID, image_id)
-        # Wait for the VM to be in the RUNNING state
-        one.wait_for_vm_state(VM_ID, VMLCMState.RUNNING)
-        unlock(LOCK_FILE_PATH, CI_JOB_ID)
-        # Make image not persistent
-        loggger.info(f"Making image not persistent...")
-        one.set_image_persiency(image_id, persistent=False)
-        # Read the template for the VM
-        loggger.info(f"Reading VM template from {VM_TEMPLATE_PATH}")
-        with open(VM_TEMPLATE_PATH, "r") as f:
-            template = f.read()
-        # Substitute placeholders with actual values
-        template = template.replace("${TEMPLATE_NAME}", image_long_name)
-        template = template.replace("${IMAGE_ID}", str(image_id))
-        template += f'\nCI_PIPELINE_ID = "{CI_PIPELINE_ID}"\nCI_JOB_ID = "{CI_JOB_ID}"\nCI_COMMIT_SHA = "{CI_COMMIT_SHA}"\n'
-        # Create the VM template
-        loggger.info(f"Creating VM template...")
-        vm_template_id = one.create_vm_template(template)
-        if (vm_template_id == -1):
+        username, password = credentials
+        if settings.telemetry_otlp_file or settings.telemetry_prometheus_file:
+            telemetry.configure("deploy_image", ci_pipeline_id=settings.ci_pipeline_id, ci_job_id=settings.ci_job_id)
+        # Inicialize OpenNebula connection shared by all deployed images
+        one = One(url=settings.one_xmlrpc, username=username, password=password, timeout=settings.one_timeout,
+                  event_endpoint=settings.one_events_endpoint, cache_ttl=settings.one_cache_ttl, retries=settings.one_retries,
+                  circuit_threshold=settings.one_circuit_threshold, circuit_reset_time=settings.one_circuit_reset_time)
+        try:
+            results = deploy_images(one, settings, images_to_deploy)
+        finally:
+            one.call_stats.log_summary()
+            one.call_stats.write_json(os.path.join(settings.timings_dir, f"one-calls.{settings.ci_job_id or os.getpid()}.json"))
+            if settings.telemetry_otlp_file:
+                telemetry.write_otlp(settings.telemetry_otlp_file)
+            if settings.telemetry_prometheus_file:
+                telemetry.write_prometheus(settings.telemetry_prometheus_file)
+        failed = [image_name for image_name, result in results.items() if not result]
+        loggger.info(f"Deployed {len(results) - len(failed)} of {len(results)} images")
+        if failed:
+            loggger.critical(f"Failed to deploy images: {', '.join(failed)}")
             exit(1)
-        loggger.info(f"VM template created with ID: {vm_template_id}")
     except Exception as e:
         loggger.critical(f"Generall exception caught: {e}")
-        loggger.info(f"Unlocking lock file: {LOCK_FILE_PATH}, key: {CI_JOB_ID}")
-        unlock(LOCK_FILE_PATH, CI_JOB_ID)
-        exit(1)
\ No newline at end of file
+        exit(1)
@@ -0,0 +1,170 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+import logging
+from typing import Optional
+from waiters import AdaptivePoller
+
+logger = logging.getLogger("main." + __name__)
+
+# inotify flags from linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Events of a directory in which udev creates device nodes and links, links are renamed into place
+DEVICE_EVENTS = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+
+class DirectoryWatcher:
+    def __init__(self) -> None:
+        """
+        inotify instance waking up a waiter when an entry appears in a watched directory.
+        :raises OSError: If inotify is not available.
+        """
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.fd = fd
+        self.directory: Optional[str] = None
+        self._watch = -1
+
+    def watch(self, directory: str) -> bool:
+        """
+        Watch the directory instead of the one watched before.
+        :return: True if the directory is watched, False otherwise.
+        """
+        if directory == self.directory:
+            return True
+        libc = _get_libc()
+        if self._watch >= 0:
+            libc.inotify_rm_watch(self.fd, self._watch)
+            self._watch = -1
+            self.directory = None
+        watch = libc.inotify_add_watch(self.fd, os.fsencode(directory), DEVICE_EVENTS)
+        if watch < 0:
+            logger.debug(f"Failed to watch {directory}: {os.strerror(ctypes.get_errno())}")
+            return False
+        self._watch = watch
+        self.directory = directory
+        return True
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until an event of the watched directory arrives, the events are consumed.
+        :return: True if an event arrived, False on timeout.
+        """
+        readable, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def get_device_size(path: str) -> Optional[int]:
+    """
+    Size of the block device (or file) in bytes, None if it does not exist or can not be opened.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        return None
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def _nearest_directory(path: str) -> str:
+    """
+    Deepest existing directory on the way to the path, e.g. DIR_DEV before udev created disk/by-id.
+    """
+    directory = os.path.dirname(path)
+    while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def wait_for_device(path: str, size: int, timeout: float = 60.0) -> bool:
+    """
+    Wait until udev created the device of an attached disk and it has the size of the image.
+    The directories on the way to the device are watched with inotify, so the wait ends as soon as the link
+    appears. A device which exists with another size (no capacity yet, or a stale link of a previous disk on the
+    same target) is polled with a short interval. Without inotify the path is polled the same way.
+    :param path: Path to the device, e.g. the disk/by-id link of the SCSI target.
+    :param size: Expected size of the device in bytes, only whole MB are compared.
+    :param timeout: Timeout in seconds.
+    :return: True if the device is ready, False on timeout.
+    """
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    poller = AdaptivePoller(initial_interval=0.01, max_interval=0.1)
+    try:
+        watcher: Optional[DirectoryWatcher] = DirectoryWatcher()
+    except OSError as e:
+        logger.debug(f"inotify is not available, polling {path}: {e}")
+        watcher = None
+    device_size = None
+    try:
+        while True:
+            # The watch is set before the check, so an entry created after the check wakes the waiter up
+            watched = watcher is not None and watcher.watch(_nearest_directory(path))
+            device_size = get_device_size(path)
+            if device_size is not None and device_size // 1024**2 == size // 1024**2:
+                logger.info(f"Device {path} is ready after {(time.monotonic() - start_time) * 1000:.0f} ms")
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if device_size is None and watched:
+                # Nothing to poll until the entry appears, the interval only guards against missed events
+                watcher.wait(min(remaining, 1.0))
+            else:
+                interval = min(poller.next_interval(), remaining)
+                if watcher is not None:
+                    watcher.wait(interval)
+                else:
+                    time.sleep(interval)
+    finally:
+        if watcher is not None:
+            watcher.close()
+    if device_size is None:
+        logger.error(f"Device {path} did not appear within timeout: {timeout} seconds")
+    else:
+        logger.error(f"Device {path} has {device_size} bytes, expected {size} bytes, within timeout: {timeout} seconds")
+    return False
@@ -0,0 +1,346 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("main." + __name__)
+
+DIGEST_ALGORITHM = "sha256"
+
+
+class ContentDigest:
+    def __init__(self, chunk_size: int, size: int, chunks: List[bytes]) -> None:
+        """
+        Tree digest of a file: digests of fixed size chunks and the digest of their concatenation.
+        Chunks are hashed independently, so the digest can be computed by several threads.
+        :param chunk_size: Size of a chunk in bytes.
+        :param size: Size of the file in bytes.
+        :param chunks: Digests of the chunks in file order.
+        """
+        self.chunk_size = chunk_size
+        self.size = size
+        self.chunks = chunks
+        root = hashlib.new(DIGEST_ALGORITHM)
+        root.update(f"{size}:{chunk_size}:".encode())
+        for chunk in chunks:
+            root.update(chunk)
+        self.root = root.hexdigest()
+
+    @property
+    def value(self) -> str:
+        """
+        Digest stored as the CONTENT_DIGEST image attribute, e.g. "sha256-tree-64M:ab12...".
+        The chunk size is part of the value, digests computed with different chunk sizes never match.
+        """
+        return f"{DIGEST_ALGORITHM}-tree-{self.chunk_size // 1024**2}M:{self.root}"
+
+    def serialize(self) -> str:
+        """
+        Compact form of the manifest for an image attribute, "sha256:<chunk size>:<size>:<chunk digest>,...".
+        """
+        return f"{DIGEST_ALGORITHM}:{self.chunk_size}:{self.size}:{','.join(chunk.hex() for chunk in self.chunks)}"
+
+    @staticmethod
+    def parse(value: str) -> Optional["ContentDigest"]:
+        """
+        Read a manifest written by serialize.
+        :return: Digest or None if the value is invalid.
+        """
+        try:
+            algorithm, chunk_size, size, chunks = value.split(":")
+            if algorithm != DIGEST_ALGORITHM:
+                logger.warning(f"Chunk manifest uses {algorithm}, expected {DIGEST_ALGORITHM}")
+                return None
+            return ContentDigest(int(chunk_size), int(size), [bytes.fromhex(chunk) for chunk in chunks.split(",") if chunk])
+        except ValueError as e:
+            logger.warning(f"Failed to parse chunk manifest: {e}")
+            return None
+
+    def save(self, path: str) -> bool:
+        """
+        Write the chunk digests as a JSON manifest. The file is replaced atomically.
+        :return: True if the manifest was written, False otherwise.
+        """
+        content = {
+            "algorithm": DIGEST_ALGORITHM,
+            "chunk_size": self.chunk_size,
+            "size": self.size,
+            "chunks": [chunk.hex() for chunk in self.chunks],
+        }
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(content, f)
+            os.replace(temporary_path, path)
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write chunk manifest {path}: {e}")
+            return False
+
+    @staticmethod
+    def load(path: str) -> Optional["ContentDigest"]:
+        """
+        Read a manifest written by save.
+        :return: Digest or None if the manifest does not exist or is invalid.
+        """
+        try:
+            with open(path, "r") as f:
+                content = json.load(f)
+            if content["algorithm"] != DIGEST_ALGORITHM:
+                logger.warning(f"Chunk manifest {path} uses {content['algorithm']}, expected {DIGEST_ALGORITHM}")
+                return None
+            return ContentDigest(content["chunk_size"], content["size"], [bytes.fromhex(chunk) for chunk in content["chunks"]])
+        except FileNotFoundError:
+            logger.debug(f"Chunk manifest {path} does not exist")
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to read chunk manifest {path}: {e}")
+            return None
+
+
+def _hash_chunk(fd: int, offset: int, length: int, read_size: int) -> bytes:
+    chunk = hashlib.new(DIGEST_ALGORITHM)
+    done = 0
+    while done < length:
+        # hashlib releases the GIL for large buffers, chunks are hashed in parallel
+        data = os.pread(fd, min(read_size, length - done), offset + done)
+        if not data:
+            raise OSError(f"Unexpected end of file at offset {offset + done}")
+        chunk.update(data)
+        done += len(data)
+    return chunk.digest()
+
+
+def compute_digest(path: str, chunk_size: int = 64 * 1024**2, workers: int = 4, read_size: int = 4 * 1024**2) -> Optional[ContentDigest]:
+    """
+    Compute the tree digest of a file, streaming it in chunks hashed by a pool of threads.
+    :param path: Path to the file.
+    :param chunk_size: Size of an independently hashed chunk in bytes.
+    :param workers: Number of hashing threads.
+    :param read_size: Size of a single read in bytes, bounds the memory used by a thread.
+    :return: Digest of the file or None on error.
+    """
+    logger.debug(f"Computing digest of {path}, chunk size: {chunk_size}, workers: {workers}")
+    start_time = time.monotonic()
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        logger.error(f"Failed to open {path} for hashing: {e}")
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        offsets = range(0, size, chunk_size)
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="digest") as executor:
+            chunks = list(executor.map(lambda offset: _hash_chunk(fd, offset, min(chunk_size, size - offset), read_size), offsets))
+    except OSError as e:
+        logger.error(f"Failed to compute digest of {path}: {e}")
+        return None
+    finally:
+        os.close(fd)
+    digest = ContentDigest(chunk_size, size, chunks)
+    elapsed = max(time.monotonic() - start_time, 1e-9)
+    logger.info(f"Digest of {path}: {digest.value} ({size / 1024**2 / elapsed:.1f} MB/s)")
+    return digest
+
+
+class _ChunkState:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hash = hashlib.new(DIGEST_ALGORITHM)
+        self.position = 0
+        # Ranges which arrived before the ranges preceding them, offset -> (copy of the data or None for zeroes, length)
+        self.pending: Dict[int, Tuple[Optional[bytes], int]] = {}
+
+
+class ChunkHasher:
+    def __init__(self, size: int, chunk_size: int = 64 * 1024**2) -> None:
+        """
+        Computes the tree digest of a disk from the blocks passed to a writer, so the content written to a device
+        can be verified without reading the source again. Blocks can be added by several threads in any order,
+        a block arriving before the blocks preceding it in its chunk is copied until they arrive.
+        Every range of the disk has to be added exactly once.
+        :param size: Size of the disk in bytes, the digest is complete only if exactly this size was added.
+        :param chunk_size: Size of an independently hashed chunk in bytes.
+        """
+        self.chunk_size = chunk_size
+        self.size = size
+        # End of a range added beyond the size of the disk
+        self._overflow: Optional[int] = None
+        self._lock = threading.Lock()
+        self._states: Dict[int, _ChunkState] = {}
+        self._chunks: Dict[int, bytes] = {}
+        self._zero_buffer = bytes(min(chunk_size, 4 * 1024**2))
+        self._zero_chunk: Optional[bytes] = None
+
+    def update(self, offset: int, data) -> None:
+        """
+        Add the block of the disk at the offset.
+        """
+        view = memoryview(data)
+        self._extend(offset + len(view))
+        position = 0
+        while position < len(view):
+            index = (offset + position) // self.chunk_size
+            length = min(len(view) - position, (index + 1) * self.chunk_size - offset - position)
+            self._add(index, offset + position - index * self.chunk_size, view[position:position + length], length)
+            position += length
+
+    def zero(self, offset: int, length: int) -> None:
+        """
+        Add a range of the disk which reads as zeroes.
+        """
+        end = offset + length
+        self._extend(end)
+        while offset < end:
+            index = offset // self.chunk_size
+            chunk_offset = offset - index * self.chunk_size
+            part = min(end - offset, self.chunk_size - chunk_offset)
+            if part == self.chunk_size:
+                # Unallocated ranges span whole chunks, their digest is computed once
+                if self._zero_chunk is None:
+                    self._zero_chunk = self._hash_zeroes(hashlib.new(DIGEST_ALGORITHM), self.chunk_size).digest()
+                with self._lock:
+                    self._chunks[index] = self._zero_chunk
+            else:
+                self._add(index, chunk_offset, None, part)
+            offset += part
+
+    def _extend(self, end: int) -> None:
+        if end > self.size:
+            with self._lock:
+                self._overflow = max(self._overflow or 0, end)
+
+    def copy_from(self, other: "ChunkHasher") -> None:
+        """
+        Take the content added to another hasher, for devices written with the same data.
+        A hasher of another disk size or chunk size leaves this one incomplete.
+        """
+        if (other.size, other.chunk_size) != (self.size, self.chunk_size):
+            logger.warning(f"Chunk digests of a {other.size} bytes disk can not be used for a {self.size} bytes disk")
+            return
+        with other._lock:
+            self._overflow = other._overflow
+            self._chunks = dict(other._chunks)
+            self._states = dict(other._states)
+
+    def _hash_zeroes(self, chunk, length: int):
+        while length > 0:
+            part = min(length, len(self._zero_buffer))
+            chunk.update(self._zero_buffer[:part])
+            length -= part
+        return chunk
+
+    def _add(self, index: int, chunk_offset: int, data, length: int) -> None:
+        with self._lock:
+            state = self._states.get(index)
+            if state is None:
+                state = self._states[index] = _ChunkState()
+        with state.lock:
+            if chunk_offset != state.position:
+                state.pending[chunk_offset] = (bytes(data) if data is not None else None, length)
+                return
+            while True:
+                if data is None:
+                    self._hash_zeroes(state.hash, length)
+                else:
+                    # hashlib releases the GIL for large buffers, different chunks are hashed in parallel
+                    state.hash.update(data)
+                state.position += length
+                if state.position not in state.pending:
+                    break
+                data, length = state.pending.pop(state.position)
+            if state.position < self.chunk_size:
+                return
+            digest = state.hash.digest()
+        with self._lock:
+            self._chunks[index] = digest
+            del self._states[index]
+
+    def digest(self) -> Optional[ContentDigest]:
+        """
+        Digest of the disk after all of its ranges were added.
+        :return: Digest or None if a range of the disk is missing or data was added beyond its end.
+        """
+        chunks = []
+        size = self.size
+        with self._lock:
+            if self._overflow is not None:
+                logger.warning(f"Data up to offset {self._overflow} was added to the digest of a {size} bytes disk")
+                return None
+            for index, offset in enumerate(range(0, size, self.chunk_size)):
+                chunk = self._chunks.get(index)
+                state = self._states.get(index)
+                if chunk is None and state is not None and not state.pending and state.position == min(self.chunk_size, size - offset):
+                    # The last chunk is shorter than the others
+                    chunk = state.hash.digest()
+                if chunk is None:
+                    logger.warning(f"Chunk at offset {offset} was not hashed, the digest is incomplete")
+                    return None
+                chunks.append(chunk)
+        return ContentDigest(self.chunk_size, size, chunks)
+
+
+def verify_digest(path: str, digest: ContentDigest, workers: int = 4, read_size: int = 4 * 1024**2) -> Optional[int]:
+    """
+    Read a written device back in chunks hashed by a pool of threads and compare them with the digest.
+    Cached pages of the device are dropped first, so the content is read from the disk.
+    :param path: Path to the block device or file.
+    :param digest: Digest of the content the device should hold, from ChunkHasher or compute_digest.
+    :param workers: Number of reading threads.
+    :param read_size: Size of a single read in bytes.
+    :return: Offset of the first chunk which differs, -1 if the content matches, None if the device can not be read.
+    """
+    logger.debug(f"Verifying {path}, chunk size: {digest.chunk_size}, workers: {workers}")
+    start_time = time.monotonic()
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        logger.error(f"Failed to open {path} for verification: {e}")
+        return None
+    try:
+        # Pages written through the cache are dropped only when they are clean
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        device_size = os.lseek(fd, 0, os.SEEK_END)
+
+        def hash_chunk(offset: int) -> Optional[bytes]:
+            length = min(digest.chunk_size, digest.size - offset)
+            if offset + length > device_size:
+                return None
+            return _hash_chunk(fd, offset, length, read_size)
+
+        offsets = range(0, digest.size, digest.chunk_size)
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="verify") as executor:
+            chunks = list(executor.map(hash_chunk, offsets))
+    except OSError as e:
+        logger.error(f"Failed to read {path} for verification: {e}")
+        return None
+    finally:
+        os.close(fd)
+    elapsed = max(time.monotonic() - start_time, 1e-9)
+    mismatches = [offset for offset, chunk, expected in zip(offsets, chunks, digest.chunks) if chunk != expected]
+    if device_size < digest.size:
+        logger.error(f"{path} has {device_size} bytes, the written disk has {digest.size} bytes")
+    if mismatches:
+        logger.error(f"Verification of {path} failed: {len(mismatches)} of {len(digest.chunks)} chunks differ, first at offset {mismatches[0]}")
+        return mismatches[0]
+    logger.info(f"Verified {path}: {digest.size / 1024**2:.0f} MB in {elapsed:.1f} s, {digest.size / 1024**2 / elapsed:.1f} MB/s")
+    return -1
@@ -0,0 +1,193 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import os
+import re
+import time
+import logging
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger("main." + __name__)
+
+
+class CacheEntry:
+    def __init__(self, path: str, lock_fd: int, hit: bool) -> None:
+        """
+        Cached file in use. The entry is not evicted until it is released.
+        :param path: Path of the cached file.
+        :param lock_fd: Lock file of the entry, shared-locked while the entry is in use.
+        :param hit: True if the file was in the cache, False if it was created.
+        """
+        self.path = path
+        self.hit = hit
+        self._lock_fd: Optional[int] = lock_fd
+
+    def release(self) -> None:
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def __enter__(self) -> "CacheEntry":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+class ExportCache:
+    def __init__(self, directory: str, max_size: int) -> None:
+        """
+        Cache of converted exports shared by concurrent jobs, keyed by the content digest of the export and
+        the target format. Entries are created once, a job creating an entry blocks the others wanting the same key.
+        The least recently used entries are evicted when the cache grows over max_size, entries in use are kept.
+        All coordination is done with flock on lock files in the directory, so it has to be on a local file system
+        or on NFS with working locks.
+        :param directory: Directory of the cache.
+        :param max_size: Size budget in bytes, measured by the allocated blocks so sparse files count by their data.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._guard_path = os.path.join(directory, ".guard")
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(digest: str, file_format: str) -> str:
+        """
+        File name of the entry, e.g. "sha256-tree-64M-ab12....qcow2-zstd".
+        """
+        return re.sub(r"[^\w.-]", "-", digest) + "." + file_format
+
+    def acquire(self, digest: str, file_format: str, create: Callable[[str], bool]) -> Optional[CacheEntry]:
+        """
+        Get the entry of the export, creating it if it is not cached. The entry is in use until it is released.
+        :param digest: Content digest of the export.
+        :param file_format: Target format, e.g. "raw" or "qcow2-zstd".
+        :param create: Function writing the entry to the given temporary path, returns True on success.
+        :return: Entry or None if it could not be created.
+        """
+        key = self.get_key(digest, file_format)
+        path = os.path.join(self.directory, key)
+        while True:
+            lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                # Exclusive while the entry is looked up or created, creators of the same key wait for each other
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                hit = os.path.exists(path)
+                if hit:
+                    os.utime(path)
+                    logger.info(f"Export cache hit: {key}")
+                else:
+                    logger.info(f"Export cache miss: {key}")
+                    if not self._create(path, create):
+                        os.close(lock_fd)
+                        return None
+                # Converting the lock is not atomic, an eviction in between is detected by the missing file
+                fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            except OSError as e:
+                logger.error(f"Failed to use export cache entry {key}: {e}")
+                os.close(lock_fd)
+                return None
+            if os.path.exists(path):
+                break
+            os.close(lock_fd)
+            logger.debug(f"Export cache entry {key} was evicted before it was used, retrying")
+        if not hit:
+            self.evict()
+        return CacheEntry(path, lock_fd, hit)
+
+    def _create(self, path: str, create: Callable[[str], bool]) -> bool:
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        start_time = time.monotonic()
+        try:
+            if not create(temporary_path):
+                return False
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+        logger.info(f"Export cache entry {os.path.basename(path)} created in {time.monotonic() - start_time:.1f} s, "
+                    f"{os.stat(path).st_blocks * 512 / 1024**2:.0f} MB")
+        return True
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """
+        Cached files as (last use, allocated size, path), least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(".") or name.endswith((".lock", ".tmp")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_blocks * 512, path))
+        return sorted(entries)
+
+    def _remove_stale_files(self) -> None:
+        """
+        Remove temporary files of creators which are gone, their entry lock is not held anymore.
+        """
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"(.+)\.\d+\.tmp", name)
+            if match is None or not self._try_remove(os.path.join(self.directory, match.group(1)), name):
+                continue
+            logger.warning(f"Removed {name} left in the export cache by a failed job")
+
+    def _try_remove(self, entry_path: str, name: Optional[str] = None) -> bool:
+        """
+        Remove the file of the entry, or the given file of it, if the entry is not in use.
+        """
+        try:
+            lock_fd = os.open(entry_path + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(os.path.join(self.directory, name) if name is not None else entry_path)
+            return True
+        except (BlockingIOError, FileNotFoundError):
+            return False
+        finally:
+            os.close(lock_fd)
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries not in use until the cache fits the size budget.
+        :return: Number of bytes freed.
+        """
+        freed = 0
+        guard_fd = os.open(self._guard_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # One evictor at a time, otherwise several jobs would free the same overflow
+            fcntl.flock(guard_fd, fcntl.LOCK_EX)
+            self._remove_stale_files()
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if self._try_remove(path):
+                    logger.info(f"Evicted {os.path.basename(path)} from the export cache, {size / 1024**2:.0f} MB")
+                    total -= size
+                    freed += size
+            if total > self.max_size:
+                logger.warning(f"Export cache {self.directory} uses {total / 1024**2:.0f} MB of {self.max_size / 1024**2:.0f} MB, the other entries are in use")
+        except OSError as e:
+            logger.warning(f"Failed to evict entries from the export cache {self.directory}: {e}")
+        finally:
+            os.close(guard_fd)
+        return freed
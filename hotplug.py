@@ -0,0 +1,201 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import enum
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from typing import List, Optional
+from one import One, ImageDevPrefix
+from states import VMLCMState
+from locking import LeaseLock
+from metrics import StageTimer
+from utils import detach_image_by_id
+
+logger = logging.getLogger("main." + __name__)
+
+
+class HotplugAction(enum.Enum):
+    ATTACH = "attach"
+    DETACH = "detach"
+
+
+class HotplugRequest:
+    def __init__(self, action: HotplugAction, image_id: int) -> None:
+        """
+        Pending attach or detach of one image, resolved by the batch which processes it.
+        """
+        self.action = action
+        self.image_id = image_id
+        self.future: Future = Future()
+        self.queued = time.monotonic()
+        self.started: Optional[float] = None
+        self.batch_size = 0
+
+
+class HotplugCoordinator:
+    def __init__(self, one: One, vm_id: int, lock: LeaseLock, lock_timeout: float = 300, max_batch: int = 16) -> None:
+        """
+        Coalesces disk hot-plug operations of concurrent deploy threads on one VM.
+        Requests submitted while a batch is waiting for the lock or running are processed back to back
+        by the next batch, inside a single lock hold, and the targets of attached images are resolved by one VM read.
+        :param one: One instance for OpenNebula connection.
+        :param vm_id: ID of the VM the images are attached to.
+        :param lock: Lock serializing hot-plug operations on the VM with other processes.
+        :param lock_timeout: Timeout in seconds for acquiring the lock.
+        :param max_batch: Maximal number of operations done in one lock hold, so other processes are not starved.
+        """
+        self.one = one
+        self.vm_id = vm_id
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self.max_batch = max_batch
+        self._condition = threading.Condition()
+        self._pending: List[HotplugRequest] = []
+        self._leading = False
+
+    def attach(self, image_id: int, timer: Optional[StageTimer] = None) -> Optional[str]:
+        """
+        Attach the image to the VM.
+        :param image_id: Image ID.
+        :param timer: Optional stage timer, the queue time is added to the lock-wait stage and the operation to attach.
+        :return: Target of the attached disk (e.g. "sdb") or None if the attach failed.
+        """
+        return self._submit(HotplugRequest(HotplugAction.ATTACH, image_id), timer)
+
+    def detach(self, image_id: int, timer: Optional[StageTimer] = None) -> bool:
+        """
+        Detach all disks of the image from the VM.
+        :param image_id: Image ID.
+        :param timer: Optional stage timer, the queue time is added to the lock-wait stage and the operation to detach.
+        :return: True if the image was detached, False otherwise.
+        """
+        return self._submit(HotplugRequest(HotplugAction.DETACH, image_id), timer)
+
+    def _submit(self, request: HotplugRequest, timer: Optional[StageTimer]):
+        with self._condition:
+            self._pending.append(request)
+            # The thread which finds no batch in progress leads the next one, the others wait for their result
+            while self._leading and not request.future.done():
+                self._condition.wait()
+            lead = not request.future.done()
+            if lead:
+                self._leading = True
+        if lead:
+            try:
+                self._run_batches(request)
+            finally:
+                with self._condition:
+                    self._leading = False
+                    self._condition.notify_all()
+        result = request.future.result()
+        if timer is not None and request.started is not None:
+            timer.add("lock-wait", request.started - request.queued)
+            timer.add(request.action.value, time.monotonic() - request.started)
+            timer.attributes[f"{request.action.value}_batch_size"] = request.batch_size
+        return result
+
+    def _take_pending(self) -> List[HotplugRequest]:
+        with self._condition:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        return batch
+
+    def _fail_pending(self, reason: str) -> None:
+        with self._condition:
+            pending, self._pending = self._pending, []
+            self._fail_requests(pending, reason)
+            self._condition.notify_all()
+
+    def _fail_requests(self, requests: List[HotplugRequest], reason: str) -> None:
+        """
+        Resolve the unfinished requests as failed: attaches with no target, detaches with False.
+        """
+        requests = [request for request in requests if not request.future.done()]
+        if not requests:
+            return
+        logger.error(f"{reason}, {len(requests)} hot-plug operations on VM {self.vm_id} are not done")
+        for request in requests:
+            request.future.set_result(None if request.action == HotplugAction.ATTACH else False)
+
+    def _run_batches(self, request: HotplugRequest) -> None:
+        """
+        Process pending batches until the request of the leading thread is done, then hand the lead over.
+        Every batch holds the lock once.
+        """
+        while not request.future.done():
+            # Requests submitted while waiting in the lock queue join this batch
+            if not self.lock.acquire(self.lock_timeout):
+                self._fail_pending(f"Failed to acquire lock {self.lock.name}")
+                return
+            try:
+                batch = self._take_pending()
+                try:
+                    self._run_batch(batch)
+                except Exception as e:
+                    for unfinished in batch:
+                        if not unfinished.future.done():
+                            unfinished.future.set_exception(e)
+                    raise
+            finally:
+                self.lock.release()
+            with self._condition:
+                self._condition.notify_all()
+
+    def _run_batch(self, batch: List[HotplugRequest]) -> None:
+        logger.info(f"Hot-plugging {len(batch)} disks on VM {self.vm_id} in one lock window")
+        started = time.monotonic()
+        for request in batch:
+            request.started = started
+            request.batch_size = len(batch)
+        # Detach first, so the freed targets can be reused by the attached images
+        batch = sorted(batch, key=lambda r: r.action != HotplugAction.DETACH)
+        attached: List[HotplugRequest] = []
+        for position, request in enumerate(batch):
+            if request.action == HotplugAction.DETACH:
+                result = detach_image_by_id(self.one, self.vm_id, request.image_id)
+            elif not self.one.wait_for_vm_state(self.vm_id, VMLCMState.RUNNING):
+                self._fail_requests(batch[position:], f"VM {self.vm_id} is not RUNNING")
+                break
+            else:
+                result = self.one.attach_vm_image(vm_id=self.vm_id, image_id=request.image_id, dev_prefix=ImageDevPrefix.SD)
+            # The VM accepts the next hot-plug operation only after it returns to RUNNING
+            running = self.one.wait_for_vm_state(self.vm_id, VMLCMState.RUNNING)
+            renewed = self.lock.renew()
+            if request.action == HotplugAction.ATTACH and result:
+                attached.append(request)
+            elif request.action == HotplugAction.ATTACH:
+                logger.error(f"Failed to attach image {request.image_id} to VM {self.vm_id}")
+                request.future.set_result(None)
+            else:
+                request.future.set_result(result)
+            if not running:
+                self._fail_requests(batch[position + 1:], f"VM {self.vm_id} did not return to RUNNING")
+                break
+            if not renewed:
+                # Another process may hot-plug disks on the VM now
+                self._fail_requests(batch[position + 1:], f"Lock {self.lock.name} was lost")
+                break
+        if not attached:
+            return
+        targets = {}
+        disks = self.one.get_vm_disks(self.vm_id)
+        for disk in disks or []:
+            if disk.get("IMAGE_ID") is not None:
+                targets.setdefault(int(disk.get("IMAGE_ID")), disk.get("TARGET", None))
+        for request in attached:
+            target = targets.get(request.image_id)
+            if target is None:
+                logger.error(f"Image {request.image_id} is not attached to VM {self.vm_id}")
+            request.future.set_result(target)
@@ -0,0 +1,110 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("main." + __name__)
+
+
+class DeployJournal:
+    def __init__(self, path: Optional[str]) -> None:
+        """
+        Write-ahead journal of the deploy of one image. Every stage is appended as a JSON line and synced
+        before the deploy continues, so a restarted deploy knows what the interrupted one did.
+        The journal is only kept in memory if path is None.
+        :param path: Path of the journal file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.stages: List[str] = []
+        # Values of all recorded stages, later stages override earlier ones
+        self.state: Dict[str, Any] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Failed to read deploy journal {self.path}, starting from scratch: {e}")
+            return
+        for number, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+                stage = record.pop("stage")
+            except (ValueError, KeyError) as e:
+                # A crash while appending leaves a partial last line, its stage did not complete
+                logger.warning(f"Ignoring invalid line {number} of deploy journal {self.path}: {e}")
+                break
+            record.pop("time", None)
+            self.stages.append(stage)
+            self.state.update(record)
+        if self.stages:
+            logger.info(f"Deploy journal {self.path} found, last stage: {self.stages[-1]}")
+
+    def has(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.state.get(key, default)
+
+    def record(self, stage: str, **values: Any) -> None:
+        """
+        Append a completed stage with its values and wait until it is on disk.
+        A journal which can not be written is only logged, the deploy does not fail because of it.
+        """
+        with self._lock:
+            self.stages.append(stage)
+            self.state.update(values)
+            if self.path is None:
+                return
+            line = json.dumps({"stage": stage, "time": round(time.time(), 3), **values}) + "\n"
+            try:
+                with open(self.path, "a") as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.warning(f"Failed to write stage {stage} to deploy journal {self.path}: {e}")
+
+    def reset(self) -> None:
+        """
+        Forget all stages, the next deploy starts from scratch.
+        """
+        with self._lock:
+            self.stages = []
+            self.state = {}
+            if self.path is None:
+                return
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to remove deploy journal {self.path}: {e}")
+
+
+def get_journal_path(directory: str, pipeline_id: str, name: str) -> str:
+    """
+    Path of the journal of the image. Retried jobs of a pipeline resume the deploys of their images.
+    """
+    return os.path.join(directory, f"{name}.{pipeline_id or 'local'}.journal")
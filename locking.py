@@ -0,0 +1,232 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import socket
+import time
+import logging
+from typing import Iterator, List, Optional
+from waiters import AdaptivePoller
+from telemetry import telemetry
+
+logger = logging.getLogger("main." + __name__)
+
+
+@contextlib.contextmanager
+def _flocked(path: str) -> Iterator[int]:
+    """
+    Hold an exclusive flock on the file for the duration of the block.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class LeaseLock:
+    def __init__(self, lock_dir: str, name: str, owner: str = "", lease_time: float = 600) -> None:
+        """
+        Fair (FIFO) inter-process lock with expiring leases, built on flock.
+        Every waiter enqueues a ticket file and keeps it flocked until it releases the lock, so tickets of crashed
+        processes are detected (the kernel drops their flock) and removed instead of blocking the queue.
+        A holder that keeps the lock longer than lease_time without renewing it loses the lock.
+        :param lock_dir: Directory with the lock queues, must be shared by all the participating processes.
+        :param name: Name of the lock, e.g. "vm-5" for a per-VM lock.
+        :param owner: Description of the owner stored in the ticket, e.g. the CI job ID.
+        :param lease_time: Lease duration in seconds.
+        """
+        self.name = name
+        self.owner = owner
+        self.lease_time = lease_time
+        self.wait_time = 0.0
+        self._queue_dir = os.path.join(lock_dir, name)
+        self._tickets_dir = os.path.join(self._queue_dir, "tickets")
+        self._guard_path = os.path.join(self._queue_dir, "guard")
+        self._counter_path = os.path.join(self._queue_dir, "counter")
+        self._ticket_path: Optional[str] = None
+        self._ticket_fd: Optional[int] = None
+        self._enqueued = 0.0
+        os.makedirs(self._tickets_dir, exist_ok=True)
+
+    def _write_ticket(self, lease_expires: Optional[float]) -> None:
+        content = {
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            "owner": self.owner,
+            "enqueued": self._enqueued,
+            "lease_expires": lease_expires,
+        }
+        os.ftruncate(self._ticket_fd, 0)
+        os.pwrite(self._ticket_fd, json.dumps(content).encode(), 0)
+
+    def _enqueue(self) -> None:
+        with _flocked(self._guard_path):
+            counter_fd = os.open(self._counter_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                counter = int(os.pread(counter_fd, 32, 0) or b"0")
+                os.ftruncate(counter_fd, 0)
+                os.pwrite(counter_fd, str(counter + 1).encode(), 0)
+            finally:
+                os.close(counter_fd)
+            self._enqueued = time.time()
+            self._ticket_path = os.path.join(self._tickets_dir, f"{counter:012d}")
+            self._ticket_fd = os.open(self._ticket_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+            # Locked while still holding the guard, so nobody can consider the new ticket dead
+            fcntl.flock(self._ticket_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._write_ticket(None)
+        logger.debug(f"Lock {self.name}: enqueued ticket {self._ticket_path}")
+
+    def _ticket_alive(self, path: str) -> bool:
+        """
+        Check the ticket of another participant, remove it if its owner is gone or its lease expired.
+        Must be called with the guard held.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Nobody holds the ticket, its process is gone
+                alive = False
+                reason = "owner process is gone"
+            except BlockingIOError:
+                alive = True
+            try:
+                ticket = json.loads(os.pread(fd, 4096, 0) or b"{}")
+            except json.JSONDecodeError:
+                ticket = {}
+        finally:
+            os.close(fd)
+        if alive and ticket.get("host") == socket.gethostname() and ticket.get("pid") and not _pid_alive(ticket["pid"]):
+            alive = False
+            reason = f"PID {ticket['pid']} is not running"
+        if alive and ticket.get("lease_expires") is not None and ticket["lease_expires"] < time.time():
+            alive = False
+            reason = f"lease expired {time.time() - ticket['lease_expires']:.0f} s ago"
+        if not alive:
+            logger.warning(f"Lock {self.name}: removing ticket {os.path.basename(path)} of {ticket.get('owner', 'unknown')}, {reason}")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        return alive
+
+    def _tickets_ahead(self) -> List[str]:
+        """
+        Get the live tickets queued before ours. Must be called with the guard held.
+        """
+        mine = os.path.basename(self._ticket_path)
+        ahead = sorted(ticket for ticket in os.listdir(self._tickets_dir) if ticket < mine)
+        return [ticket for ticket in ahead if self._ticket_alive(os.path.join(self._tickets_dir, ticket))]
+
+    def acquire(self, timeout: float = 300) -> bool:
+        """
+        Wait in the queue until the lock is acquired. Waiters get the lock in the order of their acquire calls.
+        :param timeout: Timeout in seconds.
+        :return: True if the lock was acquired, False on timeout or error.
+        """
+        logger.debug(f"Acquiring lock {self.name} for {self.owner}")
+        start_time = time.monotonic()
+        with telemetry.span("lock acquire", lock=self.name) as span:
+            acquired = self._acquire(start_time, timeout)
+            if span is not None:
+                span.set_attribute("acquired", acquired)
+        telemetry.observe("lock_wait_seconds", time.monotonic() - start_time, lock=self.name, result="acquired" if acquired else "failed")
+        return acquired
+
+    def _acquire(self, start_time: float, timeout: float) -> bool:
+        poller = AdaptivePoller(initial_interval=0.02, max_interval=0.5)
+        try:
+            self._enqueue()
+            while True:
+                with _flocked(self._guard_path):
+                    ahead = self._tickets_ahead()
+                    if not ahead:
+                        self._write_ticket(time.time() + self.lease_time)
+                        self.wait_time = time.monotonic() - start_time
+                        logger.info(f"Lock {self.name} acquired by {self.owner} after {self.wait_time:.2f} s")
+                        return True
+                if time.monotonic() - start_time > timeout:
+                    logger.error(f"Failed to acquire lock {self.name} within timeout: {timeout} seconds, {len(ahead)} waiters ahead")
+                    self._dequeue()
+                    return False
+                time.sleep(poller.next_interval())
+        except OSError as e:
+            logger.error(f"Failed to acquire lock {self.name}: {e}")
+            self._dequeue()
+            return False
+
+    def renew(self) -> bool:
+        """
+        Extend the lease of the held lock by lease_time.
+        :return: True if the lease was extended, False if the lock is not held anymore.
+        """
+        with _flocked(self._guard_path):
+            if not self._owns_ticket():
+                logger.error(f"Lock {self.name} is not held by {self.owner}, can not renew the lease")
+                return False
+            self._write_ticket(time.time() + self.lease_time)
+            return True
+
+    def _owns_ticket(self) -> bool:
+        if self._ticket_fd is None:
+            return False
+        try:
+            return os.stat(self._ticket_path).st_ino == os.fstat(self._ticket_fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _dequeue(self) -> bool:
+        if self._ticket_fd is None:
+            return False
+        owned = False
+        try:
+            with _flocked(self._guard_path):
+                owned = self._owns_ticket()
+                if owned:
+                    os.remove(self._ticket_path)
+        finally:
+            os.close(self._ticket_fd)
+            self._ticket_fd = None
+            self._ticket_path = None
+        return owned
+
+    def release(self) -> bool:
+        """
+        Release the held lock.
+        :return: True if the lock was released, False if it was not held (e.g. the lease expired and was taken over).
+        """
+        logger.debug(f"Releasing lock {self.name} held by {self.owner}")
+        try:
+            if self._dequeue():
+                return True
+        except OSError as e:
+            logger.warning(f"Failed to release lock {self.name}: {e}")
+            return False
+        logger.warning(f"Lock {self.name} was not held by {self.owner} anymore")
+        return False
@@ -0,0 +1,167 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import json
+import os
+import threading
+import time
+import logging
+from typing import Any, Dict, Iterator
+from telemetry import telemetry
+
+logger = logging.getLogger("main." + __name__)
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a duration as e.g. "1h 02m 03s".
+    """
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {seconds:02d}s"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:
+    def __init__(self, name: str, total_bytes: int, interval: float = 10.0) -> None:
+        """
+        Periodically logs progress of a long running copy: bytes done, throughput and ETA.
+        :param name: Name of the operation used in log messages.
+        :param total_bytes: Expected number of bytes.
+        :param interval: Minimal time in seconds between two progress lines.
+        """
+        self.name = name
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.bytes_done = 0
+        self.start_time = time.monotonic()
+        self._last_report = self.start_time
+        self._lock = threading.Lock()
+
+    def update(self, bytes_done: int) -> None:
+        """
+        Set the number of processed bytes, logs a progress line if the interval elapsed.
+        :param bytes_done: Total number of bytes processed so far.
+        """
+        with self._lock:
+            self.bytes_done = bytes_done
+            report = self._should_report()
+        if report:
+            self._log(time.monotonic())
+
+    def add(self, size: int) -> None:
+        """
+        Add processed bytes, can be called from concurrent writers.
+        :param size: Number of newly processed bytes.
+        """
+        with self._lock:
+            self.bytes_done += size
+            report = self._should_report()
+        if report:
+            self._log(time.monotonic())
+
+    def _should_report(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_report < self.interval:
+            return False
+        self._last_report = now
+        return True
+
+    def _log(self, now: float) -> None:
+        mb = 1024**2
+        elapsed = max(now - self.start_time, 1e-9)
+        rate = self.bytes_done / elapsed
+        percent = 100.0 * self.bytes_done / self.total_bytes if self.total_bytes > 0 else 100.0
+        eta = format_duration((self.total_bytes - self.bytes_done) / rate) if rate > 0 else "unknown"
+        logger.info(f"{self.name}: {self.bytes_done / mb:.0f}/{self.total_bytes / mb:.0f} MB ({percent:.1f} %), {rate / mb:.1f} MB/s, ETA {eta}")
+
+    def finish(self) -> None:
+        """
+        Log the final progress line.
+        """
+        self._log(time.monotonic())
+
+
+class StageTimer:
+    def __init__(self, name: str) -> None:
+        """
+        Measures the duration of the stages of a deploy. Repeated stages are summed.
+        :param name: Name of the timed operation, e.g. the image name.
+        """
+        self.name = name
+        self.start_time = time.time()
+        self.stages: Dict[str, float] = {}
+        self.attributes: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        """
+        Add a measured duration to the stage.
+        """
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        telemetry.observe("deploy_stage_seconds", seconds, stage=stage)
+        logger.debug(f"{self.name}: stage {stage} took {seconds:.3f} s")
+
+    @contextlib.contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """
+        Context manager measuring the duration of the enclosed block, also when it raises.
+        The block is traced as a span of the stage.
+        """
+        start = time.monotonic()
+        try:
+            with telemetry.span(stage, deploy=self.name):
+                yield
+        finally:
+            self.add(stage, time.monotonic() - start)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "name": self.name,
+                "start_time": self.start_time,
+                "total_seconds": time.time() - self.start_time,
+                "stages": dict(self.stages),
+                **self.attributes
+            }
+
+    def write_json(self, path: str) -> bool:
+        """
+        Write the timing summary as JSON. The file is replaced atomically.
+        :param path: Output file path.
+        :return: True if the file was written, False otherwise.
+        """
+        logger.debug(f"Writing stage timings of {self.name} to {path}")
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+            os.replace(temporary_path, path)
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write stage timings to {path}: {e}")
+            return False
+
+
+def get_timings_path(directory: str, name: str) -> str:
+    """
+    Path of the timing summary written next to the exported image.
+    """
+    return os.path.join(directory, f"{name}.timings.json")
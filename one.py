@@ -14,13 +14,22 @@
 
 import enum
 import pyone
-from typing import Optional, List, Tuple
+from typing import Iterator, Optional, List, Tuple
 from states import ImageState, VMState, VMLCMState
+from waiters import AdaptivePoller, OneEventListener, EventSubscription, RateLimiter, wait_until
+from pool_cache import PoolCache
+from template_index import TemplateIndex
+from transport import CircuitBreaker, KeepAliveTransport, ResilientOneServer, RetryPolicy, TransportStats
+from telemetry import StateTimeline, telemetry
 import time
 import logging
+import threading
 
 logger = logging.getLogger("main." + __name__)
 
+# Errors after which a repeated request may succeed: oned internal errors, objects in a transient state, network errors
+TRANSIENT_ERRORS = (pyone.OneInternalException, pyone.OneActionException, OSError)
+
 class ImageDevPrefix(enum.Enum):
     HD = "hd"
     SD = "sd"
@@ -36,20 +45,123 @@ class ImageFormat(enum.Enum):
     QCOW2 = "QCOW2"
 
 
+def build_image_template(image_name: str, image_description: Optional[str] = None, image_path: Optional[str] = None, image_type: ImageType = ImageType.DATABLOCK, image_dev_prefix: Optional[ImageDevPrefix] = None, image_format: ImageFormat = ImageFormat.RAW, image_size_mb: Optional[int] = None, persistent_image: bool = False, **kwargs) -> str:
+    """
+    Build the template of a new image, see One.create_image for the parameters.
+    """
+    logger.debug("Building image template")
+    image_template: List[str] = []
+    image_template.append(f'NAME = "{image_name}"')
+    image_template.append(f'TYPE = "{image_type.value}"')
+    image_template.append(f'FORMAT = "{image_format.value}"')
+    if image_dev_prefix is not None:
+        image_template.append(f'DEV_PREFIX = "{image_dev_prefix.value}"')
+    if image_path is not None:
+        image_template.append(f'PATH = "{image_path}"')
+    if image_size_mb is not None:
+        image_template.append(f'SIZE = "{image_size_mb}"')
+    if persistent_image:
+        image_template.append('PERSISTENT = "YES"')
+    else:
+        image_template.append('PERSISTENT = "NO"')
+    if image_description:
+        image_template.append(f'DESCRIPTION = "{image_description}"')
+    for key, value in kwargs.items():
+        image_template.append(f'{key} = "{value}"')
+    return "\n".join(image_template)
+
+
+def build_disk_vector(image_id: int, dev_prefix: Optional[ImageDevPrefix] = None, target: str = "") -> str:
+    """
+    Build the DISK vector attaching the image, see One.attach_vm_image for the parameters.
+    """
+    disk_vector_prefix = "DISK = [ "
+    disk_vector_suffix = " ]"
+    disk_vector_template = list()
+    if dev_prefix:
+        logger.debug(f"Using device prefix: {dev_prefix.value}")
+        disk_vector_template.append(f'DEV_PREFIX = "{dev_prefix.value}"')
+    if target:
+        logger.debug(f"Using target: {target}")
+        disk_vector_template.append(f'TARGET = "{target}"')
+    disk_vector_template.append(f'IMAGE_ID = "{image_id}"')
+    return disk_vector_prefix + ", ".join(disk_vector_template) + disk_vector_suffix
+
+
 class One:
-    def __init__(self, url: str, username: str, password: str, timeout: int = 10) -> None:
+    def __init__(self, url: str, username: str, password: str, timeout: int = 10, event_endpoint: Optional[str] = None, cache_ttl: float = 0.5, max_request_rate: float = 0, retries: int = 3, retry_backoff: float = 0.5, circuit_threshold: int = 5, circuit_reset_time: float = 30.0, pool_size: int = 16) -> None:
         """
         Initialize the OpenNebula connection.
         :param url: URL of the OpenNebula server.
         :param username: Username for OpenNebula authentication.
         :param password: Password for OpenNebula authentication.
         :param timeout: Timeout for OpenNebula requests.
+        :param event_endpoint: Optional ZeroMQ endpoint of the OpenNebula hook manager (e.g. "tcp://opennebula:2101").
+                               State waits are woken up by its events, otherwise only adaptive polling is used.
+        :param cache_ttl: Time in seconds for which VM and image information is answered from a shared pool snapshot.
+                          Set to 0 to disable the cache.
+        :param max_request_rate: Maximal number of XML-RPC requests per second of all threads, 0 for unlimited.
+        :param retries: Number of retries of a failed request. Requests only reading state are repeated after
+                        transient errors, other requests only if they did not reach oned.
+        :param retry_backoff: Delay before the first retry in seconds, doubled after every retry.
+        :param circuit_threshold: Number of consecutive failed requests after which requests fail immediately
+                                  for circuit_reset_time seconds, 0 disables the circuit breaker.
+        :param circuit_reset_time: Seconds after which a probe request is sent to an unavailable oned.
+        :param pool_size: Maximal number of kept alive HTTP connections to oned.
         """
         logger.debug(f"Initializing OpenNebula connection to {url} as user {username}")
-        session = ":".join((username, password))
-        self._one = pyone.OneServer(uri=url, session=session, timeout=timeout)
+        self._url = url
+        self._session = ":".join((username, password))
+        # Server proxies are not thread safe, every thread gets its own proxy. The HTTP connection pool,
+        # the circuit breaker and the latency counters are shared.
+        self._local = threading.local()
+        self._transport = KeepAliveTransport(url.startswith("https"), timeout=timeout, pool_size=pool_size)
+        self.call_stats = TransportStats()
+        self._retry_policy = RetryPolicy(CircuitBreaker(circuit_threshold, circuit_reset_time), self.call_stats, retries, retry_backoff)
+        self._rate_limiter = RateLimiter(max_request_rate) if max_request_rate > 0 else None
+        self._events = OneEventListener.create(event_endpoint)
+        self._vm_cache: Optional[PoolCache] = None
+        self._image_cache: Optional[PoolCache] = None
+        if cache_ttl > 0:
+            all_resources_filter = -2
+            any_state_except_done = -1
+            self._vm_cache = PoolCache(
+                "VM",
+                fetch_range=lambda start, end: self._one.vmpool.infoextended(all_resources_filter, start, end, any_state_except_done).VM,
+                fetch_one=lambda vm_id: self._one.vm.info(vm_id),
+                ttl=cache_ttl
+            )
+            self._image_cache = PoolCache(
+                "image",
+                fetch_range=lambda start, end: self._one.imagepool.info(all_resources_filter, start, end).IMAGE,
+                fetch_one=lambda image_id: self._one.image.info(image_id),
+                ttl=cache_ttl
+            )
         logger.debug(f"OpenNebula connection initialized successfully")
 
+    @property
+    def _one(self) -> pyone.OneServer:
+        """
+        OpenNebula XML-RPC server proxy of the calling thread. Created on first use.
+        Every request goes through this property, so it also applies the request rate limit.
+        """
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+        server = getattr(self._local, "server", None)
+        if server is None:
+            logger.debug(f"Creating OpenNebula XML-RPC proxy for thread {threading.current_thread().name}")
+            server = ResilientOneServer(self._url, self._session, self._transport, self._retry_policy)
+            self._local.server = server
+        return server
+
+    def _invalidate_image(self, image_id: Optional[int] = None) -> None:
+        if self._image_cache is not None:
+            self._image_cache.invalidate(image_id)
+
+    def _invalidate_vm(self, vm_id: int) -> None:
+        if self._vm_cache is not None:
+            self._vm_cache.invalidate(vm_id)
+
     def get_image(self, image_id: int) -> Optional[pyone.bindings.IMAGESub]:
         """
         Get image information by ID.
@@ -58,6 +170,8 @@ class One:
         """
         try:
             logger.debug(f"Getting image info for image ID: {image_id}")
+            if self._image_cache is not None:
+                return self._image_cache.get(image_id)
             return self._one.image.info(image_id)
         except pyone.OneException as e:
             logger.error(f"Failed to get image info for image ID: {image_id}, error: {str(e)}")
@@ -92,27 +206,7 @@ class One:
         :param kwargs: Additional KEY=VALUE parameters for the image.
         :return: Image ID if successful, -1 if an error occurred.
         """
-        logger.debug("Building image template")
-        image_template: List[str] = []
-        image_template.append(f'NAME = "{image_name}"')
-        image_template.append(f'TYPE = "{image_type.value}"')
-        image_template.append(f'FORMAT = "{image_format.value}"')
-        if image_dev_prefix is not None:
-            image_template.append(f'DEV_PREFIX = "{image_dev_prefix.value}"')
-        if image_path is not None:
-            image_template.append(f'PATH = "{image_path}"')
-        if image_size_mb is not None:
-            image_template.append(f'SIZE = "{image_size_mb}"')
-        if persistent_image:
-            image_template.append('PERSISTENT = "YES"')
-        else:
-            image_template.append('PERSISTENT = "NO"')
-        if image_description:
-            image_template.append(f'DESCRIPTION = "{image_description}"')
-        for key, value in kwargs.items():
-            image_template.append(f'{key} = "{value}"')
-
-        image_definition = "\n".join(image_template)
+        image_definition = build_image_template(image_name, image_description, image_path, image_type, image_dev_prefix, image_format, image_size_mb, persistent_image, **kwargs)
         try:
             logger.debug(f"Creating image in datastore {datastore} with definition: {image_definition}")
             return self._one.image.allocate(image_definition, datastore)
@@ -132,6 +226,8 @@ class One:
         except pyone.OneException as e:
             logger.error(f"Failed to delete image with ID: {image_id}, error: {e}")
             return False
+        finally:
+            self._invalidate_image(image_id)
 
     def set_image_persiency(self, image_id: int, persistent: bool) -> int:
         """
@@ -145,6 +241,110 @@ class One:
         except pyone.OneException as e:
             logger.error(f"Failed to set image persisting state to {persistent}, image ID: {image_id} error: {e}")
             return -1
+        finally:
+            self._invalidate_image(image_id)
+
+    def clone_image(self, image_id: int, image_name: str, datastore: int = -1) -> int:
+        """
+        Clone an image.
+        :param image_id: ID of the image to clone.
+        :param image_name: Name of the new image.
+        :param datastore: Datastore of the new image, -1 for the datastore of the source image.
+        :return: ID of the new image if successful, -1 if an error occurred.
+        """
+        logger.debug(f"Cloning image ID: {image_id} to {image_name} in datastore {datastore}")
+        try:
+            return self._one.image.clone(image_id, image_name, datastore)
+        except pyone.OneException as e:
+            logger.error(f"Failed to clone image with ID: {image_id}, error: {e}")
+            return -1
+        finally:
+            self._invalidate_image(image_id)
+
+    def update_image(self, image_id: int, **kwargs) -> bool:
+        """
+        Set attributes of the image template, other attributes are kept.
+        :param image_id: Image ID.
+        :param kwargs: KEY=VALUE attributes to set.
+        :return: True if successful, False if an error occurred.
+        """
+        image_template = "\n".join(f'{key} = "{value}"' for key, value in kwargs.items())
+        logger.debug(f"Updating image ID: {image_id} with: {image_template}")
+        merge = 1
+        try:
+            return self._one.image.update(image_id, image_template, merge) != -1
+        except pyone.OneException as e:
+            logger.error(f"Failed to update image with ID: {image_id}, error: {e}")
+            return False
+        finally:
+            self._invalidate_image(image_id)
+
+    def find_images_by_attributes(self, filter: int, attributes: dict, page_size: int = 500) -> Optional[List[pyone.bindings.IMAGESub]]:
+        """
+        Find images by attributes of their template.
+        :param filter: Ownership filter, see find_templates_by_attributes.
+        :param attributes: Attributes to search for in the image template.
+        :param page_size: Number of images requested by one pool call, at least 2.
+        :return: List of matching images, None if an error occurred.
+        """
+        logger.debug(f"Finding images by attributes: {attributes}")
+        if page_size < 2:
+            raise ValueError(f"page_size must be at least 2, got {page_size}")
+        result = list()
+        start_id = 0
+        try:
+            while True:
+                # -end is the page size if end < -1, pages start at an ID so images deleted meanwhile do not shift them
+                images = self._one.imagepool.info(filter, start_id, -page_size).IMAGE
+                for image in images:
+                    if all(image.TEMPLATE.get(key) == value for key, value in attributes.items()):
+                        logger.debug(f"Found image with ID: {image.ID}")
+                        result.append(image)
+                if len(images) < page_size:
+                    break
+                start_id = int(images[-1].ID) + 1
+        except pyone.OneException as e:
+            logger.error(f"Failed to find images by attributes, error: {e}")
+            return None
+        return result
+
+    def wait_for_image_deleted(self, image_id: int, timeout: int = 60) -> bool:
+        """
+        Wait until the image is removed from its datastore and from the image pool.
+        :param image_id: Image ID.
+        :param timeout: Timeout in seconds.
+        :return: True if the image does not exist anymore, False on timeout or if the image ended in the ERROR state.
+        """
+        logger.debug(f"Waiting for image {image_id} to be deleted")
+        last_state = None
+
+        def check() -> Optional[bool]:
+            nonlocal last_state
+            try:
+                # Not answered from the cache, its snapshot falls back to image.info for missing IDs anyway
+                image = self._one.image.info(image_id)
+            except pyone.OneNoExistsException:
+                return True
+            except pyone.OneException as e:
+                logger.debug(f"Failed to get image {image_id} while waiting for its deletion: {e}")
+                return None
+            last_state = ImageState(image.STATE)
+            if last_state == ImageState.ERROR:
+                logger.error(f"Image {image_id} is in the ERROR state, it was not deleted")
+                return False
+            return None
+
+        # Events only shorten the wait, a change before the topic reaches the event stream is found by the next poll
+        subscription = self._subscribe(f"EVENT IMAGE {image_id}/")
+        try:
+            deleted = wait_until(check, timeout, self._state_poller(), subscription)
+        finally:
+            if subscription is not None:
+                subscription.close()
+        if not deleted and last_state != ImageState.ERROR:
+            logger.warning(f"Timeout waiting for image {image_id} to be deleted, last state: {last_state.name if last_state else 'unknown'}")
+        self._invalidate_image(image_id)
+        return deleted
 
     def get_vm_template(self, id: int) -> Optional[pyone.bindings.TEMPLATETypeSub]:
         logger.debug(f"Getting VM template with ID: {id}")
@@ -167,18 +367,42 @@ class One:
             logger.error(f"Failed to create new VM template: {e}")
             return -1
 
-    def delete_vm_template(self, template_id: int, delete_images: bool = False) -> bool:
+    def delete_vm_template(self, template_id: int, delete_images: bool = False, retries: int = 0, backoff: float = 1.0) -> bool:
         """
         Delete a VM template by ID.
         :param template_id: Template ID.
+        :param delete_images: Delete also the images used by the template.
+        :param retries: Number of retries after transient errors.
+        :param backoff: Delay before the first retry in seconds, doubled after every retry.
         :return: True if successful, False if an error occurred.  
         """
         logger.debug(f"Deleting VM template with ID: {template_id}")
+        attempt = 0
         try:
-            return self._one.template.delete(template_id, delete_images) != -1
-        except pyone.OneException as e:
-            logger.error(f"Failed to delete VM template with ID: {template_id}: {e}")
-            return False
+            while True:
+                try:
+                    return self._one.template.delete(template_id, delete_images) != -1
+                except pyone.OneNoExistsException as e:
+                    if attempt > 0:
+                        # The failed attempt was processed by oned before the error
+                        logger.debug(f"VM template {template_id} was already deleted")
+                        return True
+                    logger.error(f"Failed to delete VM template with ID: {template_id}: {e}")
+                    return False
+                except TRANSIENT_ERRORS as e:
+                    if attempt >= retries:
+                        logger.error(f"Failed to delete VM template with ID: {template_id} after {attempt + 1} attempts: {e}")
+                        return False
+                    delay = backoff * 2**attempt
+                    attempt += 1
+                    logger.warning(f"Failed to delete VM template with ID: {template_id}: {e}, retry {attempt}/{retries} in {delay:.1f} s")
+                    time.sleep(delay)
+                except pyone.OneException as e:
+                    logger.error(f"Failed to delete VM template with ID: {template_id}: {e}")
+                    return False
+        finally:
+            if delete_images:
+                self._invalidate_image()
 
     def get_vm(self, vm_id: int) -> Optional[pyone.bindings.VMSub]:
         """
@@ -188,6 +412,8 @@ class One:
         """
         logger.debug(f"Getting VM info for VM with ID: {vm_id}")
         try:
+            if self._vm_cache is not None:
+                return self._vm_cache.get(vm_id)
             return self._one.vm.info(vm_id)
         except pyone.OneException as e:
             logger.error(f"Failed to get VM with ID: {vm_id}, error: {e}")
@@ -244,17 +470,7 @@ class One:
         :return: True if successful, False if an error occurred.
         """
         logger.debug(f"Attaching image ID: {image_id} to VM ID: {vm_id}")
-        disk_vector_prefix = "DISK = [ "
-        disk_vector_suffix = " ]"
-        disk_vector_template = list()
-        if dev_prefix:
-            logger.debug(f"Using device prefix: {dev_prefix.value}")
-            disk_vector_template.append(f'DEV_PREFIX = "{dev_prefix.value}"')
-        if target:
-            logger.debug(f"Using target: {target}")
-            disk_vector_template.append(f'TARGET = "{target}"')
-        disk_vector_template.append(f'IMAGE_ID = "{image_id}"')
-        disk_vector = disk_vector_prefix + ", ".join(disk_vector_template) + disk_vector_suffix
+        disk_vector = build_disk_vector(image_id, dev_prefix, target)
         logger.debug(f"Disk vector: {disk_vector}")
         try:
             logger.debug(f"Attaching image to VM")
@@ -262,6 +478,9 @@ class One:
         except pyone.OneException as e:
             logger.error(f"Failed to attach image with ID: {image_id} to VM with ID: {vm_id}, error: {e}")
             return False
+        finally:
+            self._invalidate_vm(vm_id)
+            self._invalidate_image(image_id)
 
     def detach_vm_image(self, vm_id: int, disk_id: int) -> bool:
         """
@@ -276,6 +495,10 @@ class One:
         except pyone.OneException as e:
             logger.error(f"Failed to detach disk with ID: {disk_id} from VM with ID: {vm_id}, error: {e}")
             return False
+        finally:
+            # Detach changes the state of the image of the disk, its ID is not known here
+            self._invalidate_vm(vm_id)
+            self._invalidate_image()
 
     def get_vm_image_target(self, vm_id: int, image_id: int) -> Optional[str]:
         """
@@ -291,36 +514,80 @@ class One:
                 return disk.get("TARGET", None)
         return None
 
-    def wait_for_image_state(self, image_id: int, target_state: ImageState, timeout: int = 60) -> bool:
+    def _subscribe(self, topic: str) -> Optional[EventSubscription]:
+        """
+        Subscribe to OpenNebula events if the event stream is available.
+        The topic is applied asynchronously, events published right after the call can be missed.
+        :param topic: Event key prefix.
+        :return: Subscription or None if events are not used.
+        """
+        if self._events is None:
+            return None
+        return self._events.subscribe(topic)
+
+    def _state_poller(self) -> AdaptivePoller:
+        """
+        Poll interval generator for state waits. Polling is only a safety net when events are received.
+        """
+        if self._events is None:
+            return AdaptivePoller(initial_interval=0.1, max_interval=2.0)
+        return AdaptivePoller(initial_interval=0.5, max_interval=10.0)
+
+    def wait_for_image_state(self, image_id: int, target_state: ImageState, timeout: int = 60, fail_states: Tuple[ImageState, ...] = ()) -> bool:
         """
         Wait for the image to reach the target state. Timeout is in seconds.
-        Function checks the image state every second.
+        Function checks the image state on every OpenNebula event of the image, or with an exponentially growing interval.
         :param image_id: Image ID.
         :param target_state: Target state to wait for.
         :param timeout: Timeout in seconds.
-        :return: True if the image reached the target state, False if timeout occurred or error happened.
+        :param fail_states: States from which the target state is not reached anymore, e.g. ERROR, the wait fails immediately in them.
+        :return: True if the image reached the target state, False if timeout occurred, a fail state was reached or error happened.
         """
         logger.debug(f"Waiting for image ID: {image_id} to reach state: {target_state.name}")
         start_time = time.time()
         logger.debug(f"Start time: {start_time}")
-        while True:
+        last_state: List[ImageState] = []
+        timeline = StateTimeline(telemetry, "image")
+
+        def check() -> Optional[bool]:
             current_state = self.get_image_state(image_id)
             if (current_state is None):
                 logger.error(f"Can not retrieve image state for image ID: {image_id}")
+                last_state.clear()
                 return False
             logger.debug(f"Current state: {current_state.name}")
+            timeline.observe(current_state)
+            last_state[:] = [current_state]
             if current_state == target_state:
                 logger.debug(f"Image ID: {image_id} reached target state: {target_state.name}")
                 return True
-            if time.time() - start_time > timeout:
-                logger.warning(f"Timeout waiting for image {image_id} to reach state {target_state.name}, last state: {current_state.name}")
+            if current_state in fail_states:
+                logger.error(f"Image ID: {image_id} reached state {current_state.name} instead of {target_state.name}")
                 return False
-            time.sleep(1)
+            return None
+
+        # Events only shorten the wait, a change before the topic reaches the event stream is found by the next poll
+        subscription = self._subscribe(f"EVENT IMAGE {image_id}/")
+        try:
+            with telemetry.span("wait image state", image_id=image_id, target_state=target_state) as span:
+                reached = wait_until(check, timeout, self._state_poller(), subscription)
+                if span is not None:
+                    span.set_attribute("reached", reached)
+        finally:
+            if subscription is not None:
+                subscription.close()
+        telemetry.observe("one_state_wait_seconds", time.time() - start_time, kind="image", target_state=target_state,
+                          result="reached" if reached else "failed")
+        if reached:
+            return True
+        if last_state and last_state[0] != target_state and last_state[0] not in fail_states:
+            logger.warning(f"Timeout waiting for image {image_id} to reach state {target_state.name}, last state: {last_state[0].name}")
+        return False
 
     def wait_for_vm_state(self, vm_id: int, target_state: VMState | VMLCMState, timeout: int = 60) -> bool:
         """
         Wait for the VM to reach the target state. Timeout is in seconds.
-        Function checks the VM state every second.
+        Function checks the VM state on every OpenNebula event of the VM, or with an exponentially growing interval.
         :param vm_id: VM ID.
         :param target_state: Target VM or LCM state to wait for.
         :param timeout: Timeout in seconds.
@@ -331,25 +598,71 @@ class One:
         logger.debug(f"Start time: {start_time}")
 
         state_index = 0 if isinstance(target_state, VMState) else 1
+        last_state: List[VMState | VMLCMState] = []
+        timeline = StateTimeline(telemetry, "vm")
 
-        while True:
+        def check() -> Optional[bool]:
             current_state = self.get_vm_state(vm_id)
             if current_state is None:
                 logger.error(f"Cannot retrieve VM state for VM ID: {vm_id}")
+                last_state.clear()
                 return False
 
             logger.debug(f"Current state: {current_state[state_index].name}")
+            timeline.observe(current_state[state_index])
+            last_state[:] = [current_state[state_index]]
             if current_state[state_index] == target_state:
                 logger.debug(f"VM ID: {vm_id} reached target state: {target_state.name}")
                 return True
-            current_time = time.time()
-            logger.debug(f"Current time: {current_time}")
-            if current_time - start_time > timeout:
-                logger.warning(f"Timeout waiting for VM {vm_id} to reach state {target_state.name}, last state: {current_state[state_index].name}")
-                return False
-            time.sleep(1)
+            return None
 
-    def find_templates_by_attributes(self, filter: int, attributes: dict) -> Optional[List[int]]:
+        # Events only shorten the wait, a change before the topic reaches the event stream is found by the next poll
+        subscription = self._subscribe(f"EVENT VM {vm_id}/")
+        try:
+            with telemetry.span("wait vm state", vm_id=vm_id, target_state=target_state) as span:
+                reached = wait_until(check, timeout, self._state_poller(), subscription)
+                if span is not None:
+                    span.set_attribute("reached", reached)
+        finally:
+            if subscription is not None:
+                subscription.close()
+        telemetry.observe("one_state_wait_seconds", time.time() - start_time, kind="vm", target_state=target_state,
+                          result="reached" if reached else "failed")
+        if reached:
+            return True
+        if last_state and last_state[0] != target_state:
+            logger.warning(f"Timeout waiting for VM {vm_id} to reach state {target_state.name}, last state: {last_state[0].name}")
+        return False
+
+    def get_vm_templates(self, filter: int, page_size: int = 500, min_id: int = -1) -> Iterator[pyone.bindings.VMTEMPLATESub]:
+        """
+        Iterate over the VM template pool page by page, so large pools are not transferred in one response.
+        :param filter: Ownership filter, see find_templates_by_attributes.
+        :param page_size: Number of templates requested by one call, at least 2 (-1 would be a range query).
+        :param min_id: Only templates with ID >= min_id are returned if set.
+        :return: Iterator of VM templates ordered by ID. Raises pyone.OneException on error.
+        """
+        if page_size < 2:
+            raise ValueError(f"page_size must be at least 2, got {page_size}")
+        start_id = 0
+        while True:
+            if min_id >= 0:
+                # ID range query, used for incremental refresh, newly created templates are few
+                logger.debug(f"Getting VM templates with ID >= {min_id}")
+                templates = self._one.templatepool.info(filter, min_id, -1).VMTEMPLATE
+            else:
+                # -end is the page size if end < -1, pages start at an ID so templates deleted meanwhile
+                # (e.g. by a bulk delete) do not shift them
+                logger.debug(f"Getting VM templates page from ID {start_id}, page size {page_size}")
+                templates = self._one.templatepool.info(filter, start_id, -page_size).VMTEMPLATE
+            yield from templates
+            if min_id >= 0:
+                return
+            if len(templates) < page_size:
+                return
+            start_id = int(templates[-1].ID) + 1
+
+    def find_templates_by_attributes(self, filter: int, attributes: dict, index: Optional[TemplateIndex] = None, page_size: int = 500) -> Optional[List[int]]:
         """
         Find a VM template by its attributes.
         :param filter: The filter values dictate which resources to search:
@@ -359,13 +672,17 @@ class One:
                         -1: Resources belonging to the user and any of his groups.
                         >= 0: Resources belonging to the UID (User’s Resources).
         :param **kwargs: Attributes to search for in the template.
+        :param index: Optional on-disk index used if it stores all the searched attributes.
+        :param page_size: Number of templates requested by one pool call.
         :return: Template ID if found, None otherwise.
         """
         logger.debug(f"Finding VM template by attributes: {attributes}")
+        if index is not None and index.covers(attributes):
+            return self._find_indexed_templates(filter, attributes, index, page_size)
         result = list()
         try:
-            templates = self._one.templatepool.info(filter, -1, -1)
-            for template in templates.VMTEMPLATE:
+            # oned does not filter the template pool by attributes, only by ownership
+            for template in self.get_vm_templates(filter, page_size):
                 match = all(template.TEMPLATE.get(key) == value for key, value in attributes.items())
                 if match:
                     logger.debug(f"Found VM template with ID: {template.ID}")
@@ -376,3 +693,47 @@ class One:
         if len(result) == 0:
             logger.warning(f"No VM templates found with the given attributes")
         return result
+
+    def _find_indexed_templates(self, filter: int, attributes: dict, index: TemplateIndex, page_size: int, verify_gap: int = 64) -> Optional[List[int]]:
+        """
+        Refresh the index with templates created since the last refresh and look the attributes up in it.
+        Matches are verified by reading them from the pool again, deleted templates are dropped from the index.
+        """
+        if index.filter != filter:
+            index.reset(filter)
+        result = list()
+        try:
+            refreshed = 0
+            for template in self.get_vm_templates(filter, page_size, min_id=index.max_id + 1 if index.max_id >= 0 else -1):
+                index.add(template)
+                refreshed += 1
+            logger.debug(f"Indexed {refreshed} new VM templates, highest ID: {index.max_id}")
+            candidates = index.find(attributes)
+            # Candidates close to each other are verified by one ID range query
+            ranges: List[List[int]] = []
+            for template_id in candidates:
+                if ranges and template_id - ranges[-1][1] <= verify_gap:
+                    ranges[-1][1] = template_id
+                else:
+                    ranges.append([template_id, template_id])
+            found = dict()
+            for start, end in ranges:
+                for template in self._one.templatepool.info(filter, start, end).VMTEMPLATE:
+                    index.add(template)
+                    found[int(template.ID)] = template
+            for template_id in candidates:
+                template = found.get(template_id)
+                if template is None:
+                    logger.debug(f"Indexed VM template {template_id} does not exist anymore")
+                    index.remove(template_id)
+                elif all(template.TEMPLATE.get(key) == value for key, value in attributes.items()):
+                    logger.debug(f"Found VM template with ID: {template.ID}")
+                    result.append(template.ID)
+        except pyone.OneException as e:
+            logger.error(f"Failed to find VM template by attributes, error: {e}")
+            return None
+        finally:
+            index.save()
+        if len(result) == 0:
+            logger.warning(f"No VM templates found with the given attributes")
+        return result
@@ -0,0 +1,131 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("main." + __name__)
+
+
+class PoolCache:
+    def __init__(self, name: str, fetch_range: Callable[[int, int], List[Any]], fetch_one: Callable[[int], Any], ttl: float = 0.5, max_gap: int = 64, watch_time: float = 30.0) -> None:
+        """
+        TTL bounded cache of OpenNebula pool objects (VMs, images) answering all callers from one pool snapshot.
+        A refresh fetches every recently requested ID at once, so concurrent waiters cost one pool call per tick.
+        :param name: Name of the pool used in log messages.
+        :param fetch_range: Callable returning pool objects with ID in the inclusive range (start, end).
+        :param fetch_one: Callable returning a single object, used for IDs missing in the pool snapshot.
+        :param ttl: Time in seconds for which a snapshot is considered fresh.
+        :param max_gap: IDs further apart than max_gap are fetched by separate pool calls to keep the responses small.
+        :param watch_time: IDs not requested for this many seconds are no longer refreshed.
+        """
+        self._name = name
+        self._fetch_range = fetch_range
+        self._fetch_one = fetch_one
+        self._ttl = ttl
+        self._max_gap = max_gap
+        self._watch_time = watch_time
+        self._condition = threading.Condition()
+        self._refreshing = False
+        # ID -> (fetch time, object)
+        self._entries: Dict[int, Tuple[float, Any]] = {}
+        # ID -> last request time
+        self._watched: Dict[int, float] = {}
+        # ID -> last invalidation time, snapshots fetched before it are not stored
+        self._invalidated: Dict[int, float] = {}
+        self._invalidated_all = 0.0
+
+    def _store(self, object_id: int, pool_object: Any, fetch_start: float) -> None:
+        if fetch_start < max(self._invalidated.get(object_id, 0.0), self._invalidated_all):
+            logger.debug(f"{self._name} {object_id} was invalidated during the refresh, not caching it")
+            return
+        self._entries[object_id] = (time.monotonic(), pool_object)
+
+    def _fresh(self, object_id: int, now: float) -> bool:
+        entry = self._entries.get(object_id)
+        return entry is not None and now - entry[0] < self._ttl
+
+    def get(self, object_id: int) -> Any:
+        """
+        Get the object from the current snapshot, refreshing the snapshot if it is older than the TTL.
+        Exceptions of the fetch callables are propagated to the caller which triggered the refresh.
+        :param object_id: Object ID.
+        :return: Pool object.
+        """
+        with self._condition:
+            self._watched[object_id] = time.monotonic()
+            # Another thread refreshing the snapshot may already fetch this ID
+            while self._refreshing and not self._fresh(object_id, time.monotonic()):
+                self._condition.wait()
+            if self._fresh(object_id, time.monotonic()):
+                logger.debug(f"Using cached {self._name} {object_id}")
+                return self._entries[object_id][1]
+            self._refreshing = True
+            now = time.monotonic()
+            object_ids = sorted(i for i, last_request in self._watched.items() if now - last_request < self._watch_time)
+            self._watched = {i: self._watched[i] for i in object_ids}
+            # No fetch is running, so invalidations older than the TTL cannot affect the coming one, and expired
+            # snapshots are never returned. Dropping both keeps long runs and bulk deletes from growing the cache.
+            self._invalidated = {i: t for i, t in self._invalidated.items() if now - t < self._ttl}
+            self._entries = {i: entry for i, entry in self._entries.items() if now - entry[0] < self._ttl}
+        try:
+            self._refresh(object_ids)
+            with self._condition:
+                entry = self._entries.get(object_id)
+            if entry is None or time.monotonic() - entry[0] >= self._ttl:
+                logger.debug(f"{self._name} {object_id} not found in the pool snapshot, fetching it separately")
+                fetch_start = time.monotonic()
+                result = self._fetch_one(object_id)
+                with self._condition:
+                    self._store(object_id, result, fetch_start)
+                return result
+            return entry[1]
+        finally:
+            with self._condition:
+                self._refreshing = False
+                self._condition.notify_all()
+
+    def _refresh(self, object_ids: List[int]) -> None:
+        """
+        Fetch the given IDs using as few pool calls as possible.
+        :param object_ids: Sorted list of IDs to refresh.
+        """
+        ranges: List[List[int]] = []
+        for object_id in object_ids:
+            if ranges and object_id - ranges[-1][1] <= self._max_gap:
+                ranges[-1][1] = object_id
+            else:
+                ranges.append([object_id, object_id])
+        for start, end in ranges:
+            logger.debug(f"Refreshing {self._name} pool snapshot for IDs {start}-{end}")
+            fetch_start = time.monotonic()
+            objects = self._fetch_range(start, end)
+            with self._condition:
+                for pool_object in objects:
+                    self._store(int(pool_object.ID), pool_object, fetch_start)
+
+    def invalidate(self, object_id: Optional[int] = None) -> None:
+        """
+        Drop cached objects after a write operation.
+        :param object_id: Object ID to invalidate, or None to invalidate the whole cache.
+        """
+        with self._condition:
+            if object_id is None:
+                self._entries.clear()
+                self._invalidated_all = time.monotonic()
+            else:
+                self._entries.pop(object_id, None)
+                self._invalidated[object_id] = time.monotonic()
@@ -0,0 +1,294 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import enum
+import mmap
+import os
+import struct
+import sys
+import zlib
+import logging
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger("main." + __name__)
+
+QCOW2_MAGIC = b"QFI\xfb"
+# Version 2 header, version 3 adds feature bitmaps, refcount order and header length
+HEADER_V2 = struct.Struct(">4sIQIIQIIQQIIQ")
+HEADER_V3 = struct.Struct(">QQQII")
+# Offset of the compression type byte in a version 3 header longer than 104 bytes
+COMPRESSION_TYPE_OFFSET = 104
+
+# Incompatible feature bits
+INCOMPAT_DIRTY = 1 << 0
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_DATA_FILE = 1 << 2
+INCOMPAT_COMPRESSION = 1 << 3
+INCOMPAT_EXTL2 = 1 << 4
+
+# L1 and standard L2 entries store a cluster aligned host offset in bits 9-55
+OFFSET_MASK = 0x00fffffffffffe00
+L2_COMPRESSED = 1 << 62
+L2_ZERO = 1 << 0
+SECTOR_SIZE = 512
+
+
+class ClusterKind(enum.Enum):
+    UNALLOCATED = "unallocated"  # Reads as zeroes, the image has no backing file
+    ZERO = "zero"                # Explicitly zeroed cluster (version 3)
+    DATA = "data"                # Stored uncompressed in the image file
+    COMPRESSED = "compressed"    # Stored deflate compressed in the image file
+
+
+class ClusterRun(NamedTuple):
+    start: int            # Offset in the guest disk
+    length: int           # Length in bytes, the last run is cut at the virtual size
+    kind: ClusterKind
+    offset: Optional[int]  # Offset in the image file of DATA and COMPRESSED runs, DATA runs are contiguous there
+
+
+class Qcow2Image:
+    def __init__(self, path: str) -> None:
+        """
+        Read only qcow2 image, the header and the L1/L2 tables are parsed in Python from a memory map of the file.
+        :param path: Path to the qcow2 image file.
+        :raises ValueError: If the file is not a valid qcow2 image.
+        :raises OSError: If the file can not be opened.
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.file_size = os.fstat(self.fd).st_size
+            if self.file_size < HEADER_V2.size:
+                raise ValueError("file is too small for a qcow2 header")
+            self._map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            self._parse_header()
+        except BaseException:
+            os.close(self.fd)
+            raise
+        # Last decompressed cluster, clusters are mostly read in order. Replaced as a whole, so threads can share it.
+        self._cache: Tuple[int, bytes] = (-1, b"")
+
+    def _parse_header(self) -> None:
+        (magic, self.version, backing_file_offset, backing_file_size, self.cluster_bits, self.virtual_size,
+         self.crypt_method, self.l1_size, self.l1_table_offset, _, _, _, _) = HEADER_V2.unpack_from(self._map, 0)
+        if magic != QCOW2_MAGIC:
+            raise ValueError("file is not a qcow2 image")
+        if self.version not in (2, 3):
+            raise ValueError(f"unsupported qcow2 version {self.version}")
+        if not 9 <= self.cluster_bits <= 21:
+            raise ValueError(f"invalid cluster bits {self.cluster_bits}")
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.incompatible_features = 0
+        self.compression_type = 0
+        if self.version == 3:
+            self.incompatible_features, _, _, _, header_length = HEADER_V3.unpack_from(self._map, HEADER_V2.size)
+            if header_length > COMPRESSION_TYPE_OFFSET:
+                self.compression_type = self._map[COMPRESSION_TYPE_OFFSET]
+        self.backing_file: Optional[str] = None
+        if backing_file_offset:
+            self.backing_file = self._map[backing_file_offset:backing_file_offset + backing_file_size].decode(errors="replace")
+        l1_needed = -(-self.virtual_size // (self.cluster_size * self.l2_entries))
+        if self.l1_size < l1_needed:
+            raise ValueError(f"L1 table has {self.l1_size} entries, the virtual size needs {l1_needed}")
+        if self.l1_table_offset % self.cluster_size or self.l1_table_offset + self.l1_size * 8 > self.file_size:
+            raise ValueError(f"invalid L1 table offset {self.l1_table_offset}")
+        self.l1_table = self._read_table(self.l1_table_offset, l1_needed)
+        logger.debug(f"qcow2 image {self.path}: version {self.version}, virtual size {self.virtual_size}, "
+                     f"cluster size {self.cluster_size}, L1 entries {l1_needed}")
+
+    def _read_table(self, offset: int, entries: int) -> array.array:
+        """
+        Read a table of big endian 64 bit entries.
+        """
+        table = array.array("Q")
+        table.frombytes(self._map[offset:offset + entries * 8])
+        if sys.byteorder == "little":
+            table.byteswap()
+        return table
+
+    def unsupported_reason(self) -> Optional[str]:
+        """
+        Check if the guest data can be read from the image file alone.
+        :return: None if it can, otherwise the reason why not.
+        """
+        if self.backing_file is not None:
+            return f"image has a backing file {self.backing_file}"
+        if self.crypt_method != 0:
+            return "image is encrypted"
+        if self.incompatible_features & INCOMPAT_CORRUPT:
+            return "image is marked corrupt"
+        if self.incompatible_features & INCOMPAT_DATA_FILE:
+            return "image stores data in an external data file"
+        if self.incompatible_features & INCOMPAT_EXTL2:
+            return "image uses extended L2 entries"
+        if self.compression_type != 0:
+            return f"image uses compression type {self.compression_type}, only deflate is supported"
+        unknown = self.incompatible_features & ~(INCOMPAT_DIRTY | INCOMPAT_COMPRESSION)
+        if unknown:
+            return f"image has unknown incompatible features {unknown:#x}"
+        return None
+
+    def _decode_compressed(self, entry: int) -> Tuple[int, int]:
+        """
+        Get the host offset and the maximal length of the compressed data of an L2 entry.
+        """
+        offset_bits = 62 - (self.cluster_bits - 8)
+        offset = entry & ((1 << offset_bits) - 1)
+        sectors = (entry & ((1 << 62) - 1)) >> offset_bits
+        return offset, (sectors + 1) * SECTOR_SIZE - offset % SECTOR_SIZE
+
+    def clusters(self) -> Iterator[Tuple[int, ClusterKind, Optional[int]]]:
+        """
+        Walk the L1/L2 tables.
+        :return: Iterator of (guest offset, kind, host offset) for every cluster of the virtual disk.
+        """
+        clusters_per_table = self.l2_entries
+        total_clusters = -(-self.virtual_size // self.cluster_size)
+        for l1_index, l1_entry in enumerate(self.l1_table):
+            first = l1_index * clusters_per_table
+            count = min(clusters_per_table, total_clusters - first)
+            l2_offset = l1_entry & OFFSET_MASK
+            if l2_offset == 0:
+                for index in range(first, first + count):
+                    yield index * self.cluster_size, ClusterKind.UNALLOCATED, None
+                continue
+            if l2_offset + self.cluster_size > self.file_size:
+                raise ValueError(f"L2 table at {l2_offset} is beyond the end of the file")
+            l2_table = self._read_table(l2_offset, count)
+            for index, entry in enumerate(l2_table, first):
+                start = index * self.cluster_size
+                if entry & L2_COMPRESSED:
+                    offset, _ = self._decode_compressed(entry)
+                    yield start, ClusterKind.COMPRESSED, offset
+                elif self.version == 3 and entry & L2_ZERO:
+                    yield start, ClusterKind.ZERO, None
+                elif entry & OFFSET_MASK:
+                    offset = entry & OFFSET_MASK
+                    if offset + min(self.cluster_size, self.virtual_size - start) > self.file_size:
+                        raise ValueError(f"Cluster at guest offset {start} is beyond the end of the file")
+                    yield start, ClusterKind.DATA, offset
+                else:
+                    yield start, ClusterKind.UNALLOCATED, None
+
+    def runs(self) -> List[ClusterRun]:
+        """
+        Get the cluster map with adjacent clusters of the same kind merged. DATA clusters are merged only if they
+        are also contiguous in the image file, each COMPRESSED cluster is a separate run.
+        :return: List of runs covering the whole virtual disk.
+        """
+        runs: List[ClusterRun] = []
+        for start, kind, offset in self.clusters():
+            length = min(self.cluster_size, self.virtual_size - start)
+            if runs and kind != ClusterKind.COMPRESSED:
+                last = runs[-1]
+                if last.kind == kind and (kind != ClusterKind.DATA or last.offset + last.length == offset):
+                    runs[-1] = last._replace(length=last.length + length)
+                    continue
+            runs.append(ClusterRun(start, length, kind, offset))
+        return runs
+
+    def _read_compressed(self, guest_offset: int, entry: int) -> bytes:
+        """
+        Decompress the cluster starting at guest_offset described by the L2 entry.
+        """
+        host_offset, length = self._decode_compressed(entry)
+        cached_offset, data = self._cache
+        if cached_offset == host_offset:
+            return data
+        compressed = self._map[host_offset:min(host_offset + length, self.file_size)]
+        # Raw deflate stream without zlib header, as written by qemu
+        data = zlib.decompressobj(-12).decompress(compressed, self.cluster_size)
+        if len(data) < min(self.cluster_size, self.virtual_size - guest_offset):
+            raise ValueError(f"Compressed cluster at guest offset {guest_offset} is truncated")
+        self._cache = (host_offset, data)
+        return data
+
+    def _find_entry(self, guest_offset: int) -> int:
+        """
+        Get the L2 entry of the cluster containing the guest offset.
+        """
+        cluster = guest_offset >> self.cluster_bits
+        l1_index, l2_index = divmod(cluster, self.l2_entries)
+        l2_offset = self.l1_table[l1_index] & OFFSET_MASK
+        if l2_offset == 0:
+            return 0
+        return struct.unpack_from(">Q", self._map, l2_offset + l2_index * 8)[0]
+
+    def read_into(self, buffer, guest_offset: int) -> None:
+        """
+        Read guest data into the whole buffer, unallocated and zero clusters read as zeroes.
+        Safe to call from several threads.
+        :param buffer: Writable buffer, e.g. a memoryview.
+        :param guest_offset: Offset in the guest disk.
+        """
+        view = memoryview(buffer)
+        if guest_offset + len(view) > self.virtual_size:
+            raise ValueError(f"Read of {len(view)} bytes at {guest_offset} is beyond the virtual size {self.virtual_size}")
+        done = 0
+        while done < len(view):
+            position = guest_offset + done
+            in_cluster = position & (self.cluster_size - 1)
+            length = min(self.cluster_size - in_cluster, len(view) - done)
+            target = view[done:done + length]
+            entry = self._find_entry(position)
+            if entry & L2_COMPRESSED:
+                target[:] = self._read_compressed(position - in_cluster, entry)[in_cluster:in_cluster + length]
+            elif (self.version == 3 and entry & L2_ZERO) or not entry & OFFSET_MASK:
+                target[:] = bytes(length)
+            else:
+                offset = (entry & OFFSET_MASK) + in_cluster
+                target[:] = self._map[offset:offset + length]
+            done += length
+
+    def read(self, guest_offset: int, length: int) -> bytes:
+        """
+        Read guest data, see read_into.
+        """
+        buffer = bytearray(length)
+        self.read_into(buffer, guest_offset)
+        return bytes(buffer)
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self.fd)
+
+
+def is_qcow2(path: str) -> bool:
+    """
+    Check the magic of the file.
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC
+    except OSError:
+        return False
+
+
+def open_qcow2_image(path: str) -> Optional[Qcow2Image]:
+    """
+    Open a qcow2 image for reading.
+    :param path: Path to the image file.
+    :return: Image or None if the file is not a qcow2 image or can not be parsed.
+    """
+    if not is_qcow2(path):
+        logger.debug(f"{path} is not a qcow2 image")
+        return None
+    try:
+        return Qcow2Image(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to parse qcow2 image {path}: {e}")
+        return None
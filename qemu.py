@@ -15,19 +15,59 @@
 import subprocess
 import json
 import logging
+import re
+import time
+from typing import List, Optional
+from metrics import ProgressReporter
+from qcow2 import open_qcow2_image
+from telemetry import telemetry
 
 logger = logging.getLogger("main." + __name__)
 
+
+def _run_qemu_img(qemu_img_command: List[str]) -> subprocess.CompletedProcess:
+    """
+    Run a qemu-img command and capture its output. The command is traced and its duration recorded.
+    """
+    logger.debug(f"Command: {" ".join(qemu_img_command)}")
+    start_time = time.monotonic()
+    with telemetry.span(f"qemu-img {qemu_img_command[1]}", path=qemu_img_command[-1]) as span:
+        result = subprocess.run(qemu_img_command, capture_output=True, text=True)
+        if span is not None:
+            span.set_attribute("returncode", result.returncode)
+    telemetry.observe("qemu_img_seconds", time.monotonic() - start_time, command=qemu_img_command[1])
+    return result
+
+
 def get_qemu_image_size_mb(path: str) -> int:
     """
-    Get the size of a QEMU image in MB using qemu-img. Does not work for images less than 1MB in size.
+    Get the size of a QEMU image in MB. The size of qcow2 images is read from their header, other formats
+    are inspected by qemu-img. Does not work for images less than 1MB in size.
     :param path: Path to the QEMU image file.
     :return: Size of the image in MB, or -1 if an error occurs.
     """
+    size = get_qemu_image_virtual_size(path)
+    if size == -1:
+        return -1
+    result = size // (1024**2)
+    logger.debug(f"QEMU image size is {result} MB")
+    return result
+
+
+def get_qemu_image_virtual_size(path: str) -> int:
+    """
+    Get the virtual size of a QEMU image in bytes, see get_qemu_image_size_mb.
+    :param path: Path to the QEMU image file.
+    :return: Size of the guest disk in bytes, or -1 if an error occurs.
+    """
     logger.debug(f"Getting size of QEMU image, path: {path}")
-    qemu_img_command = ['qemu-img', 'info', '--output', 'json', path]
-    logger.debug(f"Command: {" ".join(qemu_img_command)}")
-    result = subprocess.run(qemu_img_command, capture_output=True, text=True)
+    image = open_qcow2_image(path)
+    if image is not None:
+        result = image.virtual_size
+        image.close()
+        logger.debug(f"qcow2 image size is {result} bytes")
+        return result
+    result = _run_qemu_img(['qemu-img', 'info', '--output', 'json', path])
     if result.returncode != 0:
         logger.error(f"qemu-img exited with error: {result.stderr}")
         return -1
@@ -41,26 +81,76 @@ def get_qemu_image_size_mb(path: str) -> int:
     size = info.get("virtual-size", -1)
     if size == -1:
         logger.error("'virtual-size' not found in qemu-img output.")
-        return -1
-    result = size // (1024**2)
-    logger.debug(f"QEMU image size is {result} MB")
-    return result
+    return size
 
 
-def convert_image_format(input_path: str, output_path: str, output_format: str) -> bool:
+def convert_image_format(input_path: str, output_path: str, output_format: str, progress: Optional[ProgressReporter] = None, compress: bool = False, compression_type: Optional[str] = None) -> bool:
     """
     Convert a QEMU image to a different format using qemu-img.
     :param input_path: Path to the input QEMU image file.
     :param output_path: Path to the output QEMU image file.
     :param output_format: Desired output format (e.g., 'qcow2', 'raw').
+    :param progress: Optional progress reporter, qemu-img progress output is streamed to it.
+    :param compress: Compress the clusters of the output image, only supported by qcow2.
+    :param compression_type: Compression algorithm of a compressed qcow2 image, "zlib" or "zstd", the qemu-img default if None.
     :return: True if conversion is successful, False otherwise.
     """
     logger.debug(f"Converting image from {input_path} to {output_path} with format {output_format}")
     qemu_img_command = ['qemu-img', 'convert', '-O', output_format, input_path, output_path]
+    if compress:
+        qemu_img_command.insert(2, '-c')
+        if compression_type is not None:
+            qemu_img_command[2:2] = ['-o', f'compression_type={compression_type}']
+    if progress is not None:
+        qemu_img_command.insert(2, '-p')
     logger.debug(f"Command: {" ".join(qemu_img_command)}")
-    result = subprocess.run(qemu_img_command, capture_output=True, text=True)
-    if result.returncode != 0:
-        logger.error(f"qemu-img failed: {result.stderr}")
+    start_time = time.monotonic()
+    with telemetry.span("qemu-img convert", path=input_path, output=output_path, format=output_format) as span:
+        # stderr goes to the same pipe, a separate one could fill up with warnings while only stdout is read
+        process = subprocess.Popen(qemu_img_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        # Progress lines look like "    (12.34/100%)" and are separated by carriage returns
+        output = ""
+        messages = []
+        for chunk in iter(lambda: process.stdout.read(64), ""):
+            output += chunk
+            *lines, output = re.split(r"[\r\n]", output)
+            percents = [float(match) for line in lines for match in re.findall(r"\(([\d.]+)/100%\)", line)]
+            messages += [line for line in lines if line.strip() and not re.search(r"\([\d.]+/100%\)", line)]
+            if progress is not None and percents:
+                progress.update(int(progress.total_bytes * percents[-1] / 100))
+        if output.strip():
+            messages.append(output)
+        stderr = "\n".join(messages)
+        returncode = process.wait()
+        if span is not None:
+            span.set_attribute("returncode", returncode)
+    telemetry.observe("qemu_img_seconds", time.monotonic() - start_time, command="convert")
+    if returncode != 0:
+        logger.error(f"qemu-img failed: {stderr}")
         return False
+    if progress is not None:
+        progress.update(progress.total_bytes)
+        progress.finish()
     logger.debug(f"Image converted successfully")
     return True
+
+
+def get_qemu_image_map(path: str) -> Optional[List[dict]]:
+    """
+    Get the allocation map of a QEMU image using qemu-img map.
+    :param path: Path to the QEMU image file.
+    :return: List of extents as reported by qemu-img (keys: start, length, depth, present, zero, data and offset
+             for data stored in the image file), or None if an error occurs.
+    """
+    logger.debug(f"Getting allocation map of QEMU image, path: {path}")
+    result = _run_qemu_img(['qemu-img', 'map', '--output', 'json', path])
+    if result.returncode != 0:
+        logger.error(f"qemu-img exited with error: {result.stderr}")
+        return None
+    try:
+        extents = json.loads(result.stdout)
+    except json.JSONDecodeError as e:
+        logger.error(f"Unable to parse JSON qemu-img output: {e}")
+        return None
+    logger.debug(f"QEMU image has {len(extents)} extents")
+    return extents
@@ -0,0 +1,293 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import contextlib
+import contextvars
+import enum
+import json
+import os
+import threading
+import time
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("main." + __name__)
+
+# Upper bounds in seconds of the histogram buckets, from XML-RPC calls to image writes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Histograms recorded by the instrumented modules
+HISTOGRAMS = {
+    "one_xmlrpc_request_seconds": "Duration of a single XML-RPC request to oned, retries are separate requests",
+    "one_state_seconds": "Time an image or VM was observed in a state while waiting for another state",
+    "one_state_wait_seconds": "Duration of a wait for an image or VM state",
+    "lock_wait_seconds": "Time spent waiting for a hot-plug lock",
+    "deploy_stage_seconds": "Duration of a deploy stage",
+    "qemu_img_seconds": "Duration of a qemu-img command",
+}
+
+# Span kinds of OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: int, attributes: Dict[str, Any]) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 1},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        """
+        Cumulative histogram with fixed buckets for every label set.
+        """
+        self.buckets = buckets
+        # Sorted label items -> (bucket counts with the +Inf bucket last, sum, count)
+        self.series: Dict[Tuple[Tuple[str, str], ...], List[Any]] = {}
+
+    def observe(self, value: float, labels: Dict[str, str]) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _label_value(value: Any) -> str:
+    if isinstance(value, enum.Enum):
+        return value.name
+    return str(value)
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+class Telemetry:
+    def __init__(self, max_spans: int = 100000) -> None:
+        """
+        Collects spans and histograms of the process and writes them to files, so no tracing backend has to be
+        reachable from the runner. Nothing is collected until configure is called.
+        The current span is kept in a context variable, so spans of asyncio tasks nest like spans of threads.
+        Threads started by a pool begin new traces.
+        :param max_spans: Spans above this number are dropped, the histograms are kept complete.
+        """
+        self.enabled = False
+        self.max_spans = max_spans
+        self.resource: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._spans: List[Span] = []
+        self._dropped_spans = 0
+        self._histograms: Dict[str, Histogram] = {}
+        self._start_ns = time.time_ns()
+        self._current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+    def configure(self, service_name: str, **resource: Any) -> None:
+        """
+        Start collecting.
+        :param service_name: Name of the traced service, e.g. the script name.
+        :param resource: Attributes of the process, e.g. the CI job ID, added to all spans and metrics.
+        """
+        self.resource = {"service.name": service_name, **resource}
+        self._start_ns = time.time_ns()
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes: Any) -> Iterator[Optional[Span]]:
+        """
+        Context manager tracing the enclosed block as a child of the current span. An exception marks the span
+        as failed and is raised again.
+        :return: The span, None if telemetry is not enabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = self._current.get()
+        span = Span(name, parent.trace_id if parent is not None else os.urandom(16).hex(), parent.span_id if parent is not None else None, kind,
+                    {key: _label_value(value) if isinstance(value, enum.Enum) else value for key, value in attributes.items()})
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._current.reset(token)
+            span.end_ns = time.time_ns()
+            with self._lock:
+                if len(self._spans) < self.max_spans:
+                    self._spans.append(span)
+                else:
+                    self._dropped_spans += 1
+
+    def observe(self, metric: str, value: float, **labels: Any) -> None:
+        """
+        Add a value to the histogram, label values which are enums are recorded by their name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(metric)
+            if histogram is None:
+                histogram = self._histograms[metric] = Histogram()
+            histogram.observe(value, {key: _label_value(label) for key, label in labels.items()})
+
+    def _snapshot(self) -> Tuple[List[Span], Dict[str, Dict[Tuple[Tuple[str, str], ...], List[Any]]], Dict[str, Tuple[float, ...]]]:
+        with self._lock:
+            series = {metric: {key: [list(values[0]), values[1], values[2]] for key, values in histogram.series.items()}
+                      for metric, histogram in self._histograms.items()}
+            buckets = {metric: histogram.buckets for metric, histogram in self._histograms.items()}
+            return list(self._spans), series, buckets
+
+    def write_otlp(self, path: str) -> bool:
+        """
+        Append the spans and histograms in the OTLP/JSON file format, one trace and one metrics request per line,
+        as read by the otlpjsonfile receiver of the OpenTelemetry collector.
+        :return: True if the file was written, False otherwise.
+        """
+        spans, series, buckets = self._snapshot()
+        resource = {"attributes": _otlp_attributes(self.resource)}
+        scope = {"name": "one-apps-builder"}
+        now = str(time.time_ns())
+        metrics = []
+        for metric, metric_series in sorted(series.items()):
+            data_points = [{
+                "attributes": _otlp_attributes(dict(key)),
+                "startTimeUnixNano": str(self._start_ns),
+                "timeUnixNano": now,
+                "count": str(count),
+                "sum": total,
+                "bucketCounts": [str(bucket_count) for bucket_count in counts],
+                "explicitBounds": list(buckets[metric]),
+            } for key, (counts, total, count) in sorted(metric_series.items())]
+            # Cumulative temporality, every export contains the totals since the start
+            metrics.append({"name": metric, "description": HISTOGRAMS.get(metric, ""), "unit": "s",
+                            "histogram": {"aggregationTemporality": 2, "dataPoints": data_points}})
+        lines = []
+        if spans:
+            lines.append(json.dumps({"resourceSpans": [{"resource": resource, "scopeSpans": [{"scope": scope, "spans": [span.to_otlp() for span in spans]}]}]}))
+        if metrics:
+            lines.append(json.dumps({"resourceMetrics": [{"resource": resource, "scopeMetrics": [{"scope": scope, "metrics": metrics}]}]}))
+        if self._dropped_spans:
+            logger.warning(f"{self._dropped_spans} spans were dropped, more than {self.max_spans} spans were recorded")
+        try:
+            with open(path, "a") as f:
+                f.write("".join(line + "\n" for line in lines))
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write telemetry to {path}: {e}")
+            return False
+
+    def write_prometheus(self, path: str) -> bool:
+        """
+        Write the histograms in the Prometheus text format for the textfile collector of the node exporter.
+        The resource attributes are added as labels. The file is replaced atomically.
+        :return: True if the file was written, False otherwise.
+        """
+        _, series, buckets = self._snapshot()
+        resource_labels = {key.replace(".", "_"): _label_value(value) for key, value in self.resource.items()}
+        lines = []
+        for metric, metric_series in sorted(series.items()):
+            lines.append(f"# HELP {metric} {HISTOGRAMS.get(metric, metric)}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, (counts, total, count) in sorted(metric_series.items()):
+                labels = {**resource_labels, **dict(key)}
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets[metric]) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric}_bucket{_prometheus_labels({**labels, 'le': str(bound)})} {cumulative}")
+                lines.append(f"{metric}_sum{_prometheus_labels(labels)} {total}")
+                lines.append(f"{metric}_count{_prometheus_labels(labels)} {count}")
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                f.write("".join(line + "\n" for line in lines))
+            os.replace(temporary_path, path)
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write metrics to {path}: {e}")
+            return False
+
+
+class StateTimeline:
+    def __init__(self, telemetry: Telemetry, kind: str) -> None:
+        """
+        Records how long an object stayed in every state observed by a wait loop in the one_state_seconds histogram.
+        The durations are measured between the observations, so they are as precise as the poll interval.
+        :param telemetry: Telemetry the durations are recorded in.
+        :param kind: Kind of the object, e.g. "image" or "vm".
+        """
+        self.telemetry = telemetry
+        self.kind = kind
+        self._state: Optional[enum.Enum] = None
+        self._since = 0.0
+
+    def observe(self, state: enum.Enum) -> None:
+        now = time.monotonic()
+        if state == self._state:
+            return
+        if self._state is not None:
+            self.telemetry.observe("one_state_seconds", now - self._since, kind=self.kind, state=self._state)
+        self._state = state
+        self._since = now
+
+
+# Telemetry of the process, configured by the scripts
+telemetry = Telemetry()
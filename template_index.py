@@ -0,0 +1,111 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import logging
+from typing import Any, Dict, Iterable, List
+
+logger = logging.getLogger("main." + __name__)
+
+DEFAULT_INDEX_KEYS = ("CI_PIPELINE_ID", "CI_COMMIT_SHA")
+
+
+class TemplateIndex:
+    def __init__(self, path: str, keys: Iterable[str] = DEFAULT_INDEX_KEYS) -> None:
+        """
+        On-disk index of VM template attributes. Only templates with ID above the highest indexed ID are
+        fetched on refresh, lookups by the indexed attributes do not download the whole template pool.
+        :param path: Path of the JSON index file.
+        :param keys: Template attributes stored in the index.
+        """
+        self.path = path
+        self.keys = list(keys)
+        self.filter = None
+        self.max_id = -1
+        # Template ID -> indexed attributes
+        self.templates: Dict[int, Dict[str, str]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            logger.debug(f"Template index {self.path} does not exist yet")
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read template index {self.path}, rebuilding it: {e}")
+            return
+        if content.get("keys") != self.keys:
+            logger.info(f"Template index {self.path} was built for other attributes, rebuilding it")
+            return
+        self.filter = content.get("filter")
+        self.max_id = content.get("max_id", -1)
+        self.templates = {int(template_id): attributes for template_id, attributes in content.get("templates", {}).items()}
+        logger.debug(f"Loaded template index {self.path} with {len(self.templates)} templates up to ID {self.max_id}")
+
+    def covers(self, attributes: Dict[str, Any]) -> bool:
+        """
+        Check if a lookup by the attributes can be answered by the index.
+        """
+        return len(attributes) > 0 and all(key in self.keys for key in attributes)
+
+    def reset(self, filter: int) -> None:
+        """
+        Drop all entries, e.g. when the index was built for another ownership filter.
+        """
+        self.filter = filter
+        self.max_id = -1
+        self.templates = {}
+
+    def add(self, template: Any) -> None:
+        """
+        Index a template from the template pool.
+        """
+        template_id = int(template.ID)
+        self.templates[template_id] = {key: template.TEMPLATE[key] for key in self.keys if key in template.TEMPLATE}
+        self.max_id = max(self.max_id, template_id)
+
+    def remove(self, template_id: int) -> None:
+        self.templates.pop(template_id, None)
+
+    def find(self, attributes: Dict[str, Any]) -> List[int]:
+        """
+        Get IDs of indexed templates matching all the attributes.
+        """
+        return sorted(template_id for template_id, indexed in self.templates.items()
+                      if all(indexed.get(key) == value for key, value in attributes.items()))
+
+    def save(self) -> bool:
+        """
+        Write the index. The file is replaced atomically, so concurrent jobs read either the old or the new index.
+        :return: True if the index was written, False otherwise.
+        """
+        content = {
+            "keys": self.keys,
+            "filter": self.filter,
+            "max_id": self.max_id,
+            "templates": {str(template_id): attributes for template_id, attributes in self.templates.items()},
+        }
+        temporary_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(content, f)
+            os.replace(temporary_path, self.path)
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write template index {self.path}: {e}")
+            return False
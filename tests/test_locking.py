@@ -0,0 +1,109 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from locking import LeaseLock
+
+# Forked children inherit the test module, nothing has to be pickled
+context = multiprocessing.get_context("fork")
+
+
+def count_tickets(lock_dir: str) -> int:
+    return len(os.listdir(os.path.join(lock_dir, "vm-1", "tickets")))
+
+
+def wait_for_tickets(lock_dir: str, count: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while count_tickets(lock_dir) < count:
+        assert time.monotonic() < deadline, f"{count} tickets were not enqueued"
+        time.sleep(0.01)
+
+
+def take_turn(lock_dir: str, index: int, order_path: str) -> None:
+    lock = LeaseLock(lock_dir, "vm-1", owner=f"job-{index}")
+    if not lock.acquire(timeout=30):
+        os._exit(1)
+    with open(order_path, "a") as f:
+        f.write(f"{index}\n")
+    time.sleep(0.02)
+    lock.release()
+    os._exit(0)
+
+
+def hold(lock_dir: str, acquired) -> None:
+    lock = LeaseLock(lock_dir, "vm-1", owner="holder", lease_time=600)
+    if lock.acquire(timeout=10):
+        acquired.set()
+    time.sleep(600)
+
+
+def test_waiters_get_the_lock_in_ticket_order(tmp_path):
+    lock_dir = str(tmp_path)
+    order_path = str(tmp_path / "order")
+    first = LeaseLock(lock_dir, "vm-1", owner="first")
+    assert first.acquire(timeout=5)
+    processes = []
+    for index in range(8):
+        process = context.Process(target=take_turn, args=(lock_dir, index, order_path))
+        process.start()
+        processes.append(process)
+        # The next process is started only after this one queued its ticket
+        wait_for_tickets(lock_dir, index + 2)
+    assert first.release()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    with open(order_path) as f:
+        assert [int(line) for line in f] == list(range(8))
+
+
+def test_killed_holder_is_taken_over_without_waiting_for_the_lease(tmp_path):
+    lock_dir = str(tmp_path)
+    acquired = context.Event()
+    holder = context.Process(target=hold, args=(lock_dir, acquired))
+    holder.start()
+    try:
+        assert acquired.wait(10)
+        # The holder is killed while the waiter is queued behind it
+        killer = threading.Timer(0.3, os.kill, (holder.pid, signal.SIGKILL))
+        killer.start()
+        start_time = time.monotonic()
+        waiter = LeaseLock(lock_dir, "vm-1", owner="waiter", lease_time=600)
+        assert waiter.acquire(timeout=10)
+        # The lease of the killed holder would last 600 s
+        assert 0.3 <= time.monotonic() - start_time < 5
+        assert waiter.release()
+        killer.join()
+    finally:
+        if holder.is_alive():
+            holder.kill()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    lock_dir = str(tmp_path)
+    holder = LeaseLock(lock_dir, "vm-1", owner="holder", lease_time=0.5)
+    assert holder.acquire(timeout=5)
+    start_time = time.monotonic()
+    waiter = LeaseLock(lock_dir, "vm-1", owner="waiter", lease_time=600)
+    assert waiter.acquire(timeout=10)
+    assert 0.4 < time.monotonic() - start_time < 5
+    # The holder lost the lock with its lease
+    assert not holder.renew()
+    assert not holder.release()
+    assert waiter.release()
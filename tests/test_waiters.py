@@ -0,0 +1,119 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import threading
+import time
+import pytest
+
+zmq = pytest.importorskip("zmq")
+
+from waiters import AdaptivePoller, OneEventListener, wait_until
+
+
+@pytest.fixture
+def publisher():
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.setsockopt(zmq.LINGER, 0)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    yield socket, f"tcp://127.0.0.1:{port}"
+    socket.close()
+
+
+@pytest.fixture
+def listener(publisher):
+    return OneEventListener(publisher[1])
+
+
+def publish(socket, key: str) -> None:
+    socket.send_multipart([key.encode(), base64.b64encode(b"<VM/>")])
+
+
+def publish_until_received(socket, subscription, key: str, timeout: float = 5.0) -> str:
+    """
+    Publish the event until the subscription receives it, the subscription reaches the publisher asynchronously.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        publish(socket, key)
+        received = subscription.wait(0.05)
+        if received is not None:
+            return received
+    pytest.fail(f"{key} was not received")
+
+
+def drain(subscription) -> list:
+    events = []
+    while True:
+        event = subscription.wait(0.1)
+        if event is None:
+            return events
+        events.append(event)
+
+
+def test_events_are_dispatched_by_prefix(publisher, listener):
+    socket, _ = publisher
+    vm5 = listener.subscribe("EVENT VM 5/")
+    vm6 = listener.subscribe("EVENT VM 6/")
+    assert publish_until_received(socket, vm5, "EVENT VM 5/ACTIVE/RUNNING") == "EVENT VM 5/ACTIVE/RUNNING"
+    publish_until_received(socket, vm6, "EVENT VM 6/ACTIVE/HOTPLUG")
+    publish(socket, "EVENT VM 55/ACTIVE/RUNNING")
+    publish(socket, "EVENT IMAGE 5/READY")
+    publish_until_received(socket, vm6, "EVENT VM 6/ACTIVE/RUNNING")
+    # Repeated publications of the received events can still be queued, the other keys must not be
+    assert set(drain(vm5)) <= {"EVENT VM 5/ACTIVE/RUNNING"}
+    assert set(drain(vm6)) <= {"EVENT VM 6/ACTIVE/HOTPLUG", "EVENT VM 6/ACTIVE/RUNNING"}
+
+
+def test_closed_subscription_receives_no_events(publisher, listener):
+    socket, _ = publisher
+    vm5 = listener.subscribe("EVENT VM 5/")
+    vm6 = listener.subscribe("EVENT VM 6/")
+    publish_until_received(socket, vm5, "EVENT VM 5/ACTIVE/RUNNING")
+    vm5.close()
+    drain(vm5)
+    publish(socket, "EVENT VM 5/ACTIVE/HOTPLUG")
+    # Events are delivered in order, the VM 5 event was dispatched before the VM 6 event arrives
+    publish_until_received(socket, vm6, "EVENT VM 6/ACTIVE/RUNNING")
+    assert vm5.wait(0.1) is None
+    vm6.close()
+
+
+def test_wait_until_wakes_up_on_event(publisher, listener):
+    socket, _ = publisher
+    subscription = listener.subscribe("EVENT VM 5/")
+    publish_until_received(socket, subscription, "EVENT VM 5/ACTIVE/HOTPLUG")
+    drain(subscription)
+    done = threading.Event()
+
+    def change_state() -> None:
+        time.sleep(0.2)
+        done.set()
+        while not stop.is_set():
+            publish(socket, "EVENT VM 5/ACTIVE/RUNNING")
+            time.sleep(0.05)
+
+    stop = threading.Event()
+    thread = threading.Thread(target=change_state)
+    thread.start()
+    start_time = time.monotonic()
+    try:
+        # The first check fails immediately, the next poll would be 10 s later
+        result = wait_until(lambda: True if done.is_set() else None, 30, AdaptivePoller(initial_interval=10, max_interval=10, jitter=0), subscription)
+    finally:
+        stop.set()
+        thread.join()
+        subscription.close()
+    assert result is True
+    assert time.monotonic() - start_time < 5
@@ -0,0 +1,321 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+import threading
+import time
+import xmlrpc.client
+import logging
+from typing import Dict, Optional
+import pyone
+import requests
+import requests.adapters
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from telemetry import SPAN_KIND_CLIENT, telemetry
+
+logger = logging.getLogger("main." + __name__)
+
+# Last component of the XML-RPC methods which only read state and can be repeated safely
+IDEMPOTENT_ACTIONS = ("info", "infoextended", "monitoring", "version", "config")
+
+
+class CircuitOpenError(pyone.OneException):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    Derived from OneException, so callers handle it as any other failed request.
+    """
+
+
+class RequestNotSentError(ConnectionError):
+    """
+    Raised by a transport if the request failed before it was sent to oned, e.g. the connection was refused.
+    """
+
+
+class CallStats:
+    def __init__(self) -> None:
+        """
+        Latency counters of one XML-RPC method.
+        """
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "total_seconds": round(self.total_seconds, 6),
+            "max_seconds": round(self.max_seconds, 6),
+            "mean_seconds": round(self.total_seconds / self.calls, 6) if self.calls else 0.0,
+        }
+
+
+class TransportStats:
+    def __init__(self) -> None:
+        """
+        Per-method latency counters shared by the connections of all threads.
+        """
+        self._lock = threading.Lock()
+        self._methods: Dict[str, CallStats] = {}
+
+    def record(self, method: str, seconds: float, error: bool) -> None:
+        """
+        Record one attempt of a call.
+        """
+        with self._lock:
+            stats = self._methods.setdefault(method, CallStats())
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def record_retry(self, method: str) -> None:
+        with self._lock:
+            self._methods.setdefault(method, CallStats()).retries += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get a copy of the counters.
+        :return: Dictionary mapping method name to its counters.
+        """
+        with self._lock:
+            return {method: stats.as_dict() for method, stats in sorted(self._methods.items())}
+
+    def log_summary(self) -> None:
+        """
+        Log one line with the counters of every method.
+        """
+        for method, stats in self.snapshot().items():
+            logger.info(f"{method}: {stats['calls']} calls, {stats['errors']} errors, {stats['retries']} retries, "
+                        f"mean {stats['mean_seconds'] * 1000:.1f} ms, max {stats['max_seconds'] * 1000:.1f} ms")
+
+    def write_json(self, path: str) -> bool:
+        """
+        Write the counters as JSON. The file is replaced atomically.
+        :return: True if the file was written, False otherwise.
+        """
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(temporary_path, path)
+            return True
+        except OSError as e:
+            logger.warning(f"Failed to write OpenNebula call statistics to {path}: {e}")
+            return False
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_time: float = 30.0) -> None:
+        """
+        Stops sending requests to an unavailable oned. After failure_threshold consecutive failures the circuit
+        opens and requests fail immediately. After reset_time one probe request is let through, the circuit
+        closes if it succeeds and opens again otherwise.
+        :param failure_threshold: Number of consecutive failures opening the circuit, 0 disables the breaker.
+        :param reset_time: Seconds after which an open circuit lets a probe request through.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        """
+        Check if a request may be sent. Lets a single probe request through a circuit open for reset_time.
+        """
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_time:
+                return False
+            self._probing = True
+            logger.info(f"Circuit half open, sending a probe request to OpenNebula")
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"OpenNebula is responding again, circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and 0 < self.failure_threshold <= self._failures):
+                logger.error(f"OpenNebula failed {self._failures} consecutive requests, circuit open for {self.reset_time:.0f} s")
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class KeepAliveTransport(pyone.RequestsTransport):
+    def __init__(self, https: bool, https_verify: bool = True, timeout: float = 10.0, pool_size: int = 16) -> None:
+        """
+        XML-RPC transport reusing HTTP connections. The pyone transport opens a new connection for every request.
+        A single instance is shared by the connections of all threads, the connection pool is thread safe.
+        :param https: Use HTTPS.
+        :param https_verify: Verify the server certificate.
+        :param timeout: Connect and read timeout of a request in seconds.
+        :param pool_size: Maximal number of kept alive connections.
+        """
+        super().__init__()
+        self.set_https(https)
+        self.set_https_verify(https_verify)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, host, handler, request_body, verbose=False):
+        url = self._build_url(host, handler)
+        headers = {"User-Agent": self.user_agent, "Content-Type": "text/xml", "Accept": "*/*"}
+        response = self.session.post(url, data=request_body, headers=headers, verify=self.https_verify, timeout=self.timeout)
+        try:
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise xmlrpc.client.ProtocolError(url, response.status_code, str(e), response.headers)
+        return self.parse_response(response)
+
+
+def _not_sent(error: Exception) -> bool:
+    """
+    Check if the request failed before it reached oned, so even a not idempotent call can be repeated.
+    """
+    if isinstance(error, (RequestNotSentError, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], "reason", error.args[0])
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def is_retryable(method: str, error: Exception) -> bool:
+    """
+    Check if a failed call may be repeated.
+    Calls only reading state are repeated after any transient error, other calls only if they were not sent.
+    :param method: XML-RPC method name, e.g. "one.vm.info".
+    :param error: Error raised by the call.
+    """
+    if method.rsplit(".", 1)[-1] in IDEMPOTENT_ACTIONS:
+        if isinstance(error, xmlrpc.client.ProtocolError):
+            return error.errcode >= 500
+        return isinstance(error, (pyone.OneInternalException, OSError))
+    return _not_sent(error)
+
+
+def _is_failure(error: Exception) -> bool:
+    """
+    Check if the error means that oned is unavailable, as opposed to a rejected request.
+    """
+    return isinstance(error, (pyone.OneInternalException, OSError, xmlrpc.client.ProtocolError))
+
+
+class RetryPolicy:
+    def __init__(self, breaker: CircuitBreaker, stats: TransportStats, retries: int = 3, backoff: float = 0.5, max_backoff: float = 30.0) -> None:
+        """
+        Decides about retries of failed calls and records their outcome in the circuit breaker and the counters.
+        Does not sleep itself, so it is shared by the blocking and the asyncio clients.
+        :param breaker: Circuit breaker shared by all connections.
+        :param stats: Latency counters shared by all connections.
+        :param retries: Number of retries of a failed call.
+        :param backoff: Delay before the first retry in seconds, doubled after every retry.
+        :param max_backoff: Maximal delay between two retries in seconds.
+        """
+        self.breaker = breaker
+        self.stats = stats
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def check(self, method: str) -> None:
+        """
+        Raise CircuitOpenError if the call must not be sent.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"OpenNebula is unavailable, {method} not sent")
+
+    def succeeded(self, method: str, seconds: float) -> None:
+        self.stats.record(method, seconds, error=False)
+        telemetry.observe("one_xmlrpc_request_seconds", seconds, method=method, result="ok")
+        self.breaker.success()
+
+    def failed(self, method: str, seconds: float, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Record a failed attempt.
+        :param attempt: Number of the failed attempt, 0 for the first one.
+        :return: Delay in seconds before the next attempt, None if the call must not be repeated.
+        """
+        self.stats.record(method, seconds, error=True)
+        telemetry.observe("one_xmlrpc_request_seconds", seconds, method=method, result="error")
+        if _is_failure(error):
+            self.breaker.failure()
+        else:
+            # oned responded, e.g. the object does not exist
+            self.breaker.success()
+        if attempt >= self.retries or not is_retryable(method, error):
+            return None
+        # Full jitter, callers failing together do not retry together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        self.stats.record_retry(method)
+        logger.warning(f"{method} failed: {error}, retry {attempt + 1}/{self.retries} in {delay:.1f} s")
+        return delay
+
+
+class ResilientOneServer(pyone.OneServer):
+    def __init__(self, uri: str, session: str, transport: KeepAliveTransport, policy: RetryPolicy) -> None:
+        """
+        OpenNebula XML-RPC server proxy with a shared keep-alive transport, retries of idempotent calls with
+        exponential backoff, a circuit breaker and per-method latency counters.
+        :param uri: URL of the OpenNebula server.
+        :param session: OpenNebula session "username:password".
+        :param transport: Transport shared by the proxies of all threads.
+        :param policy: Retry policy shared by the proxies of all threads.
+        """
+        # No timeout, pyone would set it as the default timeout of all sockets of the process
+        super().__init__(uri, session)
+        self._ServerProxy__transport = transport
+        self._policy = policy
+
+    def _ServerProxy__request(self, methodname, params):
+        attempt = 0
+        method = "one." + methodname
+        with telemetry.span(method, kind=SPAN_KIND_CLIENT, **{"rpc.system": "xmlrpc", "rpc.method": method}) as span:
+            while True:
+                if span is not None:
+                    span.set_attribute("attempts", attempt + 1)
+                self._policy.check(method)
+                start_time = time.monotonic()
+                try:
+                    result = pyone.OneServer._ServerProxy__request(self, methodname, params)
+                except Exception as e:
+                    delay = self._policy.failed(method, time.monotonic() - start_time, e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                self._policy.succeeded(method, time.monotonic() - start_time)
+                return result
@@ -0,0 +1,101 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import enum
+import functools
+import http.server
+import os
+import threading
+import urllib.parse
+import logging
+from http import HTTPStatus
+from typing import Callable, Optional
+
+logger = logging.getLogger("main." + __name__)
+
+
+class UploadMode(enum.Enum):
+    HOTPLUG = "hotplug"  # Attach an empty image to a builder VM and write the export to it
+    PATH = "path"        # Create the image from the export path, the datastore reads it from a shared file system
+    URL = "url"          # Create the image from the export URL, the datastore downloads it over HTTP
+
+
+def get_upload_source(mode: UploadMode, location: str, file_name: str) -> str:
+    """
+    PATH or URL attribute of an image created from a file of DIR_EXPORT.
+    :param mode: PATH or URL upload mode.
+    :param location: Directory under which the datastore sees DIR_EXPORT, or the base URL serving DIR_EXPORT.
+    :param file_name: Name of the file in DIR_EXPORT.
+    :return: Path or URL of the file.
+    """
+    if mode == UploadMode.URL:
+        return urllib.parse.urljoin(location.rstrip("/") + "/", urllib.parse.quote(file_name))
+    return os.path.join(location, file_name)
+
+
+class _ExportRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, served: Callable[[str], bool], **kwargs) -> None:
+        # The request is handled by the constructor of the base class
+        self.served = served
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        path = os.path.realpath(self.translate_path(self.path))
+        if not os.path.isfile(path) or not self.served(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        return super().send_head()
+
+    def list_directory(self, path):
+        self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+        return None
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class ExportServer:
+    def __init__(self, directory: str, host: str = "", port: int = 0, served: Optional[Callable[[str], bool]] = None) -> None:
+        """
+        HTTP server serving the exported images to the datastore in URL upload mode, for runners without a
+        web server in front of DIR_EXPORT. Every request is served by its own thread, range requests are not supported.
+        Directories are not listed, requests for other files than the served ones are answered with 404.
+        :param directory: Directory to serve, DIR_EXPORT.
+        :param host: Address to listen on, all addresses by default.
+        :param port: Port to listen on, 0 selects a free port.
+        :param served: Predicate on the real path of a requested file, all files inside the directory are served if None.
+        """
+        self.directory = directory
+        if served is None:
+            root = os.path.join(os.path.realpath(directory), "")
+            served = lambda path: path.startswith(root)
+        handler = functools.partial(_ExportRequestHandler, directory=directory, served=served)
+        self._server = http.server.ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="export-server", daemon=True)
+        self._thread.start()
+        host = self._server.server_address[0]
+        logger.info(f"Serving {self.directory} on {host or 'all addresses'} port {self.port}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        logger.debug(f"Stopped serving {self.directory}")
@@ -14,9 +14,10 @@
 
 from one import One
 from states import VMLCMState
+from telemetry import telemetry
 import logging
 import os
-import time
+from typing import Optional, Tuple
 
 loggger = logging.getLogger("main." + __name__)
 
@@ -38,77 +39,38 @@ def detach_image_by_id(one: One, vm_id: int, image_id: int) -> bool:
     :param image_id: ID of the image to detach.
     :return: True if the image was detached successfully, False otherwise.
     """
-    loggger.debug(f"Detaching image with ID {image_id} from VM {vm_id}")
-    vm_disks = one.get_vm_disks(vm_id)
-    if vm_disks is None:
-        loggger.error(f"Failed to get VM disks for VM ID {vm_id}")
-        return False
-    loggger.debug(f"VM has {vm_disks.count} disks")
-    for disk in vm_disks:
-        if (vm_image_id := disk.get("IMAGE_ID")) and image_id == int(vm_image_id):
-            disk_id = int(disk.get("DISK_ID"))
-            loggger.debug(f"Trying to detach disk {disk_id} from VM")
-            one.wait_for_vm_state(vm_id, VMLCMState.RUNNING)
-            if one.detach_vm_image(vm_id, disk_id) is False:
-                loggger.error(f"Failed to detach disk {disk_id} from VM {vm_id}")
-                return False
-    return True
-
-def lock(lock_file_path: str, key: str = "") -> bool:
-    """
-    Creates a lock using a exclusive file creation.
-    :param path: Path to the lock file.
-    :return: True if the file was created successfully, False otherwise.
-    """
-    loggger.debug(f"Creating lock file: {lock_file_path}")
-    try:
-        with open(lock_file_path, 'x') as f:
-            loggger.debug(f"Lock file opened successfully")
-            loggger.debug(f"Writing key to lock file, value: {key}")
-            f.write(key)
-            f.flush()
-            loggger.debug(f"Lock file created successfully")
-            return True
-    except Exception as e:
-        loggger.debug(f"Failed to create lock file: {e}")
-        return False
-
-def unlock(lock_file_path: str, key: str = "") -> bool:
-    """
-    Removes a lock by deleting the lock file.
-    :param path: Path to the lock file.
-    :return: True if the file wasremoved successfully, False otherwise.
-    """
-    loggger.debug(f"Releasing lock file: {lock_file_path}, key: {key}")
-    try:
-        with open(lock_file_path, 'r') as f:
-            loggger.debug(f"Lock file opened successfully")
-            loggger.debug(f"Reading key from lock file")
-            file_key = f.read()
-            if file_key != key:
-                loggger.error(f"Key mismatch: expected: {key}, found: {file_key}")
-                return False
-        loggger.debug(f"Key matched, removing lock file")
-        os.remove(lock_file_path)
-        loggger.debug(f"Lock file removed successfully")
+    with telemetry.span("detach image", vm_id=vm_id, image_id=image_id):
+        loggger.debug(f"Detaching image with ID {image_id} from VM {vm_id}")
+        vm_disks = one.get_vm_disks(vm_id)
+        if vm_disks is None:
+            loggger.error(f"Failed to get VM disks for VM ID {vm_id}")
+            return False
+        loggger.debug(f"VM has {vm_disks.count} disks")
+        for disk in vm_disks:
+            if (vm_image_id := disk.get("IMAGE_ID")) and image_id == int(vm_image_id):
+                disk_id = int(disk.get("DISK_ID"))
+                loggger.debug(f"Trying to detach disk {disk_id} from VM")
+                one.wait_for_vm_state(vm_id, VMLCMState.RUNNING)
+                if one.detach_vm_image(vm_id, disk_id) is False:
+                    loggger.error(f"Failed to detach disk {disk_id} from VM {vm_id}")
+                    return False
         return True
-    except Exception as e:
-        loggger.warning(f"Failed to remove lock file: {e}")
-        return False
 
-def acquire_lock(lock_file_path: str, key: str = "", timeout: int = 300) -> bool:
+def read_one_credentials(one_auth_path: str) -> Optional[Tuple[str, str]]:
     """
-    Tryies to acquire a lock using the exclusively openned file.
-    :param path: Path to the lock file.
-    :return: True if the lock was acquired, False otherwise.
+    Reads OpenNebula credentials from the ONE_AUTH file.
+    :param one_auth_path: Path to the file with credentials in the format 'username:password'.
+    :return: Tuple of username and password, or None if the file is missing or invalid.
     """
-    loggger.debug(f"Acquiring lock using file: {lock_file_path} and key: {key}")
-    start_time = time.time()
-    while True:
-        if lock(lock_file_path, key):
-            loggger.debug(f"Lock acquired")
-            return True
-        if time.time() - start_time > timeout:
-            loggger.error(f"Failed to acquire lock using file: {lock_file_path}, key: {key} within timeout: {timeout} seconds")
-            return False
-        time.sleep(1)
+    loggger.info(f"Reading Opennebula credentials from {one_auth_path}")
+    try:
+        with open(os.path.expanduser(one_auth_path), "r") as f:
+            credentials = f.read().strip()
+    except FileNotFoundError:
+        loggger.critical(f"ONE_AUTH file not found at {one_auth_path}")
+        return None
+    if ":" not in credentials:
+        loggger.critical(f"Error: Invalid credentials format in {one_auth_path}. Expected 'username:password'")
+        return None
+    username, password = credentials.split(":", 1)
+    return (username, password)
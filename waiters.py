@@ -0,0 +1,242 @@
+# Copyright 2025 Lukáš Fázik
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+import logging
+from typing import Dict, List, Optional
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+logger = logging.getLogger("main." + __name__)
+
+
+class AdaptivePoller:
+    def __init__(self, initial_interval: float = 0.1, max_interval: float = 5.0, multiplier: float = 2.0, jitter: float = 0.2) -> None:
+        """
+        Poll interval generator with exponential backoff and jitter.
+        The first checks are done quickly, the interval then grows up to max_interval.
+        :param initial_interval: First poll interval in seconds.
+        :param max_interval: Maximal poll interval in seconds.
+        :param multiplier: Interval multiplier applied after every poll.
+        :param jitter: Relative random jitter (0.2 means +-20 %) so concurrent waiters do not poll in lockstep.
+        """
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._interval = initial_interval
+
+    def reset(self) -> None:
+        """
+        Start again from the initial interval, e.g. after an observed state change.
+        """
+        self._interval = self._initial_interval
+
+    def next_interval(self) -> float:
+        """
+        Get the next poll interval and advance the backoff.
+        :return: Interval in seconds.
+        """
+        interval = self._interval
+        self._interval = min(self._interval * self._multiplier, self._max_interval)
+        return max(0.0, interval * (1 + random.uniform(-self._jitter, self._jitter)))
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """
+        Token bucket limiting the rate of requests of all threads sharing it.
+        :param rate: Maximal sustained number of requests per second.
+        :param burst: Number of requests which can be done at once after an idle period.
+        """
+        self._interval = 1.0 / rate
+        self._burst = burst
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def acquire(self) -> float:
+        """
+        Wait until a request is allowed.
+        :return: Time in seconds the caller waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # Unused capacity of an idle period is kept only up to the burst size
+            self._next_free = max(self._next_free, now - (self._burst - 1) * self._interval)
+            delay = self._next_free - now
+            self._next_free += self._interval
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+
+class EventSubscription:
+    def __init__(self, listener: "OneEventListener", topic: str) -> None:
+        """
+        Subscription to OpenNebula events with the given topic prefix.
+        :param listener: Listener delivering the events.
+        :param topic: Event key prefix, e.g. "EVENT VM 5/".
+        """
+        self.topic = topic
+        self._listener = listener
+        self._condition = threading.Condition()
+        self._events: List[str] = []
+
+    def _deliver(self, key: str) -> None:
+        with self._condition:
+            self._events.append(key)
+            self._condition.notify_all()
+
+    def wait(self, timeout: float) -> Optional[str]:
+        """
+        Wait for the next event.
+        :param timeout: Timeout in seconds.
+        :return: Key of the event (e.g. "EVENT VM 5/ACTIVE/RUNNING") or None on timeout.
+        """
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            if self._events:
+                return self._events.pop(0)
+            return None
+
+    def close(self) -> None:
+        self._listener.unsubscribe(self)
+
+    def __enter__(self) -> "EventSubscription":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class OneEventListener:
+    def __init__(self, endpoint: str) -> None:
+        """
+        Listener of the OpenNebula hook manager ZeroMQ event stream.
+        One background thread receives all events and dispatches them to subscriptions by key prefix.
+        :param endpoint: ZeroMQ publisher endpoint, e.g. "tcp://opennebula:2101".
+        """
+        self.endpoint = endpoint
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, List[EventSubscription]] = {}
+        self._context = zmq.Context.instance()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(endpoint)
+        # SUB sockets are not thread safe, (un)subscribe requests are passed to the receiving thread
+        self._pending_topics: List[tuple] = []
+        self._thread = threading.Thread(target=self._run, name="one-events", daemon=True)
+        self._thread.start()
+        logger.debug(f"Listening for OpenNebula events on {endpoint}")
+
+    @staticmethod
+    def create(endpoint: Optional[str]) -> Optional["OneEventListener"]:
+        """
+        Create an event listener if an endpoint is configured and pyzmq is installed.
+        :param endpoint: ZeroMQ publisher endpoint or None.
+        :return: Event listener or None if events are not available.
+        """
+        if not endpoint:
+            return None
+        if zmq is None:
+            logger.warning(f"pyzmq is not installed, OpenNebula events from {endpoint} are not used")
+            return None
+        try:
+            return OneEventListener(endpoint)
+        except zmq.ZMQError as e:
+            logger.warning(f"Failed to subscribe to OpenNebula events on {endpoint}: {e}")
+            return None
+
+    def subscribe(self, topic: str) -> EventSubscription:
+        """
+        Subscribe to events with the given key prefix.
+        The topic is set on the socket by the receiving thread within one receive tick and then has to reach
+        the publisher, events published until then are not delivered. Waiters have to poll as well.
+        :param topic: Event key prefix, e.g. "EVENT IMAGE 12/".
+        :return: Subscription, close it when done.
+        """
+        subscription = EventSubscription(self, topic)
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(topic, [])
+            if not subscriptions:
+                self._pending_topics.append((zmq.SUBSCRIBE, topic))
+            subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions and subscription.topic in self._subscriptions:
+                del self._subscriptions[subscription.topic]
+                self._pending_topics.append((zmq.UNSUBSCRIBE, subscription.topic))
+
+    def _run(self) -> None:
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        while True:
+            with self._lock:
+                pending_topics, self._pending_topics = self._pending_topics, []
+            for option, topic in pending_topics:
+                self._socket.setsockopt_string(option, topic)
+            if not poller.poll(50):
+                continue
+            try:
+                # Messages are multipart: event key and base64 encoded object XML
+                message = self._socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                logger.debug(f"Failed to receive OpenNebula event: {e}")
+                continue
+            key = message[0].decode(errors="replace")
+            logger.debug(f"Received OpenNebula event: {key}")
+            with self._lock:
+                subscriptions = [s for topic, subs in self._subscriptions.items() if key.startswith(topic) for s in subs]
+            for subscription in subscriptions:
+                subscription._deliver(key)
+
+
+def wait_until(check, timeout: float, poller: Optional[AdaptivePoller] = None, subscription: Optional[EventSubscription] = None) -> bool:
+    """
+    Repeatedly call check until it returns True or False.
+    Between the checks waits for the next poll interval or for an event of the subscription, whichever comes first.
+    The poll interval bounds the wait if an event is missed, e.g. one published before the subscription was applied.
+    :param check: Callable returning True (done), False (failed) or None (not yet).
+    :param timeout: Timeout in seconds.
+    :param poller: Poll interval generator, AdaptivePoller() if not specified.
+    :param subscription: Optional event subscription waking the waiter up on state changes.
+    :return: Result of check, False on timeout.
+    """
+    if poller is None:
+        poller = AdaptivePoller()
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        interval = min(poller.next_interval(), remaining)
+        if subscription is None:
+            time.sleep(interval)
+        elif subscription.wait(interval) is not None:
+            poller.reset()